@@ -1,6 +1,7 @@
 import logging
 from fastapi import Depends, HTTPException, status, Request, Form, Header
 from fastapi.security import APIKeyHeader
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.ext.asyncio import AsyncSession
 import redis.asyncio as redis
 import time
@@ -10,6 +11,9 @@ from app.schema.settings import AppSettingsModel # <-- NEW
 from app.database.session import get_db
 from app.crud import apikey_crud
 from app.core.security import verify_api_key
+from app.core.auth_cache import api_key_cache
+from app.core import metrics
+from app.core.rate_limit import RateLimiter
 from app.database.models import APIKey
 
 logger = logging.getLogger(__name__)
@@ -103,6 +107,12 @@ async def get_valid_api_key(
             detail="Invalid API key format",
         )
 
+    # Fast path: this prefix/secret pair was already verified recently.
+    cached_key = api_key_cache.get(prefix, secret)
+    if cached_key is not None:
+        request.state.api_key = cached_key
+        return cached_key
+
     db_api_key = await apikey_crud.get_api_key_by_prefix(db, prefix=prefix)
 
     if not db_api_key:
@@ -123,24 +133,34 @@ async def get_valid_api_key(
             status_code=status.HTTP_403_FORBIDDEN, detail="API Key is disabled"
         )
 
-    if not verify_api_key(secret, db_api_key.hashed_key):
+    # bcrypt is CPU-bound; keep it off the event loop so streams aren't stalled.
+    if not await run_in_threadpool(verify_api_key, secret, db_api_key.hashed_key):
         logger.warning(f"Invalid secret for API key with prefix '{prefix}'.")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key"
         )
 
+    # Detach the key so it can be shared safely across requests from the cache.
+    db.expunge(db_api_key)
+    app_settings: AppSettingsModel = request.app.state.settings
+    api_key_cache.put(prefix, secret, db_api_key, ttl_seconds=app_settings.api_key_cache_ttl_seconds)
+
     request.state.api_key = db_api_key
     return db_api_key
 
 # --- Rate Limiting Dependency ---
+def token_limits_for(api_key: APIKey, settings: AppSettingsModel) -> tuple[int, int]:
+    """The key's (per-minute, per-day) token quotas, falling back to the defaults; 0 = unlimited."""
+    per_minute = api_key.token_limit_per_minute if api_key.token_limit_per_minute is not None else settings.token_limit_per_minute
+    per_day = api_key.token_limit_per_day if api_key.token_limit_per_day is not None else settings.token_limit_per_day
+    return per_minute, per_day
+
 async def rate_limiter(
     request: Request,
     api_key: APIKey = Depends(get_valid_api_key),
     settings: AppSettingsModel = Depends(get_settings),
 ):
-    redis_client: redis.Redis = request.app.state.redis
-    if not redis_client:
-        return True
+    limiter: RateLimiter = request.app.state.rate_limits
 
     if api_key.rate_limit_requests is not None and api_key.rate_limit_window_minutes is not None:
         limit = api_key.rate_limit_requests
@@ -148,23 +168,31 @@ async def rate_limiter(
     else:
         limit = settings.rate_limit_requests
         window_minutes = settings.rate_limit_window_minutes
-    
-    window = window_minutes * 60
-    key = f"rate_limit:{api_key.key_prefix}"
 
-    try:
-        current_requests = await redis_client.incr(key)
-        if current_requests == 1:
-            await redis_client.expire(key, window)
+    result = await limiter.check(api_key.key_prefix, limit, window_minutes * 60)
+    # Picked up by the middleware that adds the X-RateLimit-* headers to the response
+    request.state.rate_limit_headers = result.headers()
 
-        if current_requests > limit:
-            logger.warning(f"Rate limit exceeded for API key prefix: {api_key.key_prefix}")
-            ttl = await redis_client.ttl(key)
+    if not result.allowed:
+        logger.warning(f"Rate limit exceeded for API key prefix: {api_key.key_prefix}")
+        metrics.REJECTIONS.labels("rate_limit").inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Rate limit exceeded. Try again in {result.retry_after_seconds} seconds.",
+            headers=result.headers(),
+        )
+
+    # Token quotas are charged after each response, so they only refuse once already used up
+    per_minute, per_day = token_limits_for(api_key, settings)
+    if per_minute > 0 or per_day > 0:
+        quota = await limiter.check_tokens(api_key.key_prefix, per_minute, per_day)
+        request.state.rate_limit_headers.update(quota.headers())
+        if not quota.allowed:
+            logger.warning(f"Token quota exceeded for API key prefix: {api_key.key_prefix}")
+            metrics.REJECTIONS.labels("token_quota").inc()
             raise HTTPException(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail=f"Rate limit exceeded. Try again in {ttl} seconds.",
-                headers={"Retry-After": str(ttl)}
+                detail=f"Token quota exceeded. Try again in {quota.retry_after_seconds} seconds.",
+                headers=request.state.rate_limit_headers,
             )
-    except Exception as e:
-        logger.error(f"Could not connect to Redis for rate limiting: {e}")
-    return True
\ No newline at end of file
+    return True
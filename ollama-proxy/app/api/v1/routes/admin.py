@@ -20,6 +20,10 @@ from sqlalchemy.exc import IntegrityError
 
 from app.core.config import settings
 from app.core.security import verify_password
+from app.core.circuit_breaker import CircuitBreakerConfig
+from app.core.admission import PRIORITY_CLASSES, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from app.core.rate_limit import usage_from_tat
+from app.core.connection_pools import backend_pools
 from app.database.session import get_db
 from app.database.models import User
 from app.crud import user_crud, apikey_crud, log_crud, server_crud, settings_crud, model_metadata_crud
@@ -83,9 +87,8 @@ async def get_active_rate_limits(
         try:
             pipe = redis_client.pipeline()
             pipe.get(key)
-            pipe.ttl(key)
-            results = await pipe.execute()
-            count, ttl = results
+            pipe.time()
+            tat, (now_seconds, now_microseconds) = await pipe.execute()
             
             prefix = key.split(":", 1)[1]
 
@@ -101,7 +104,10 @@ async def get_active_rate_limits(
                 if api_key.rate_limit_window_minutes is not None:
                     key_window = api_key.rate_limit_window_minutes
 
-            if count is not None and ttl is not None:
+            if tat is not None and key_limit > 0 and key_window > 0:
+                # The key holds the GCRA theoretical arrival time, not a counter
+                now_ms = int(now_seconds) * 1000 + int(now_microseconds) / 1000
+                count, ttl = usage_from_tat(float(tat), now_ms, key_limit, key_window * 60)
                 limits.append({
                     "prefix": prefix,
                     "count": int(count),
@@ -235,14 +241,30 @@ async def get_system_and_ollama_info(
     
     # Combine server health and load data into a single structure
     server_load_map = {row.server_name: row.request_count for row in server_load}
+    server_ids = [server["server_id"] for server in server_health]
+    live_load = await request.app.state.load_balancer.stats(server_ids)
+    circuits = request.app.state.circuit_breakers.stats(server_ids) if app_settings.circuit_breaker_enabled else {}
     for server in server_health:
         server["request_count"] = server_load_map.get(server["name"], 0)
+        server_live_load = live_load.get(server["server_id"], {})
+        server["in_flight"] = server_live_load.get("in_flight", 0)
+        server["ewma_ttfb_ms"] = server_live_load.get("ewma_ttfb_ms")
+        server["circuit"] = circuits.get(server["server_id"])
         
     return {
         "system_info": system_info, 
         "running_models": running_models,
+        "load_balancing_strategy": app_settings.load_balancing_strategy,
+        "load_balancing_shared": request.app.state.load_balancer.shared_state_active,
         "load_balancer_status": server_health,
-        "queue_status": rate_limits
+        "queue_status": rate_limits,
+        "usage_log_writer": request.app.state.usage_log_writer.stats(),
+        "retry_budget": request.app.state.retry_budgets.stats(server_ids),
+        "admission": dict(
+            request.app.state.admission.stats(server_ids),
+            enabled=app_settings.admission_control_enabled,
+        ),
+        "connection_pools": backend_pools.stats(),
     }
     
 @router.get("/stats", response_class=HTMLResponse, name="admin_stats")
@@ -259,8 +281,10 @@ async def admin_stats(
     hourly_stats = await log_crud.get_hourly_usage_stats(db)
     server_stats = await log_crud.get_server_load_stats(db)
     model_stats = await log_crud.get_model_usage_stats(db)
+    latency_stats = await log_crud.get_latency_percentiles(db, hours=24)
     context.update({
         "key_usage_stats": key_usage_stats,
+        "latency_stats": latency_stats,
         "daily_labels": [row.date.strftime('%Y-%m-%d') for row in daily_stats],
         "daily_data": [row.request_count for row in daily_stats],
         "hourly_labels": [row['hour'] for row in hourly_stats],
@@ -446,6 +470,8 @@ async def admin_load_model(
 
     http_client: httpx.AsyncClient = request.app.state.http_client
     result = await server_crud.load_model_on_server(http_client, server, model_name)
+    if result["success"]:
+        request.app.state.resident_models.mark_loaded(server.id, model_name)
 
     flash(request, result["message"], "success" if result["success"] else "error")
     
@@ -465,6 +491,8 @@ async def admin_unload_model(
 
     http_client: httpx.AsyncClient = request.app.state.http_client
     result = await server_crud.unload_model_on_server(http_client, server, model_name)
+    if result["success"]:
+        request.app.state.resident_models.forget(server.id, model_name)
 
     flash(request, result["message"], "success" if result["success"] else "error")
     
@@ -486,6 +514,8 @@ async def admin_unload_model_dashboard(
 
     http_client: httpx.AsyncClient = request.app.state.http_client
     result = await server_crud.unload_model_on_server(http_client, server, model_name)
+    if result["success"]:
+        request.app.state.resident_models.forget(server.id, model_name)
 
     flash(request, result["message"], "success" if result["success"] else "error")
     
@@ -667,8 +697,39 @@ async def admin_settings_post(
         "redis_port": int(form_data.get("redis_port", 6379)),
         "redis_username": form_data.get("redis_username") or None,
         "model_update_interval_minutes": int(form_data.get("model_update_interval_minutes", 10)),
+        "load_balancing_strategy": form_data.get("load_balancing_strategy", current_settings.load_balancing_strategy),
+        "load_balancing_shared_state": form_data.get("load_balancing_shared_state") == "on",
+        "affinity_routing_enabled": form_data.get("affinity_routing_enabled") == "on",
+        "circuit_breaker_enabled": form_data.get("circuit_breaker_enabled") == "on",
+        "circuit_breaker_failure_threshold": int(form_data.get("circuit_breaker_failure_threshold", current_settings.circuit_breaker_failure_threshold)),
+        "circuit_breaker_open_seconds": int(form_data.get("circuit_breaker_open_seconds", current_settings.circuit_breaker_open_seconds)),
+        "token_limit_per_minute": int(form_data.get("token_limit_per_minute") or 0),
+        "token_limit_per_day": int(form_data.get("token_limit_per_day") or 0),
+        "admission_control_enabled": form_data.get("admission_control_enabled") == "on",
+        "backend_max_concurrency": int(form_data.get("backend_max_concurrency", current_settings.backend_max_concurrency)),
+        "admission_max_queue_seconds": int(form_data.get("admission_max_queue_seconds", current_settings.admission_max_queue_seconds)),
+        "embed_fanout_chunk_size": int(form_data.get("embed_fanout_chunk_size", current_settings.embed_fanout_chunk_size)),
+        "embed_fanout_max_parallel": int(form_data.get("embed_fanout_max_parallel", current_settings.embed_fanout_max_parallel)),
+        "embed_batching_enabled": form_data.get("embed_batching_enabled") == "on",
+        "embed_batching_legacy_enabled": form_data.get("embed_batching_legacy_enabled") == "on",
+        "embed_batch_max_size": int(form_data.get("embed_batch_max_size", current_settings.embed_batch_max_size)),
+        "embed_batch_max_wait_ms": int(form_data.get("embed_batch_max_wait_ms", current_settings.embed_batch_max_wait_ms)),
+        "embedding_cache_enabled": form_data.get("embedding_cache_enabled") == "on",
+        "embedding_cache_max_entries": int(form_data.get("embedding_cache_max_entries", current_settings.embedding_cache_max_entries)),
+        "embedding_cache_redis_enabled": form_data.get("embedding_cache_redis_enabled") == "on",
+        "embedding_cache_redis_ttl_hours": int(form_data.get("embedding_cache_redis_ttl_hours", current_settings.embedding_cache_redis_ttl_hours)),
+        "response_cache_enabled": form_data.get("response_cache_enabled") == "on",
+        "response_cache_max_entries": int(form_data.get("response_cache_max_entries", current_settings.response_cache_max_entries)),
+        "response_cache_ttl_seconds": int(form_data.get("response_cache_ttl_seconds", current_settings.response_cache_ttl_seconds)),
+        "backend_pool_max_connections": int(form_data.get("backend_pool_max_connections", current_settings.backend_pool_max_connections)),
+        "backend_pool_max_keepalive": int(form_data.get("backend_pool_max_keepalive", current_settings.backend_pool_max_keepalive)),
+        "backend_pool_keepalive_expiry_seconds": int(form_data.get("backend_pool_keepalive_expiry_seconds", current_settings.backend_pool_keepalive_expiry_seconds)),
+        "backend_pool_timeout_seconds": int(form_data.get("backend_pool_timeout_seconds", current_settings.backend_pool_timeout_seconds)),
+        "backend_pool_prewarm_connections": int(form_data.get("backend_pool_prewarm_connections", current_settings.backend_pool_prewarm_connections)),
+        "vllm_http2_enabled": form_data.get("vllm_http2_enabled") == "on",
         "allowed_ips": form_data.get("allowed_ips", ""),
         "denied_ips": form_data.get("denied_ips", ""),
+        "metrics_require_api_key": form_data.get("metrics_require_api_key") == "on",
         "blocked_ollama_endpoints": form_data.get("blocked_ollama_endpoints", ""),
     })
     if new_redis_password:
@@ -678,6 +739,34 @@ async def admin_settings_post(
         updated_settings_data = current_settings.model_copy(update=update_data)
         await settings_crud.update_app_settings(db, settings_data=updated_settings_data)
         request.app.state.settings = updated_settings_data
+        request.app.state.load_balancer.configure_shared_state(
+            request.app.state.redis, updated_settings_data.load_balancing_shared_state
+        )
+        request.app.state.circuit_breakers.config = CircuitBreakerConfig.from_settings(updated_settings_data)
+        request.app.state.retry_budgets.configure(
+            updated_settings_data.retry_budget_ratio, updated_settings_data.retry_budget_min_per_second
+        )
+        request.app.state.admission.configure(
+            updated_settings_data.backend_max_concurrency, updated_settings_data.admission_max_queue_seconds
+        )
+        request.app.state.embed_batcher.configure(
+            updated_settings_data.embed_batch_max_size, updated_settings_data.embed_batch_max_wait_ms
+        )
+        request.app.state.embedding_cache.configure(
+            updated_settings_data.embedding_cache_max_entries,
+            updated_settings_data.embedding_cache_redis_enabled,
+            updated_settings_data.embedding_cache_redis_ttl_hours * 3600,
+        )
+        request.app.state.response_cache.configure(
+            updated_settings_data.response_cache_max_entries, updated_settings_data.response_cache_ttl_seconds
+        )
+        backend_pools.configure(
+            updated_settings_data.backend_pool_max_connections,
+            updated_settings_data.backend_pool_max_keepalive,
+            updated_settings_data.backend_pool_keepalive_expiry_seconds,
+            updated_settings_data.backend_pool_timeout_seconds,
+            updated_settings_data.vllm_http2_enabled,
+        )
         flash(request, "Settings updated successfully. A restart is required for some changes (like HTTPS) to take effect.", "success")
     except (ValueError, TypeError) as e:
         logger.error(f"Invalid form data for settings: {e}")
@@ -800,7 +889,13 @@ async def create_user_api_key(
     key_name: str = Form(...),
     rate_limit_requests: Optional[int] = Form(None),
     rate_limit_window_minutes: Optional[int] = Form(None),
+    priority_class: str = Form(PRIORITY_INTERACTIVE),
+    token_limit_per_minute: Optional[int] = Form(None),
+    token_limit_per_day: Optional[int] = Form(None),
 ):
+    if priority_class not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail="Invalid priority class")
+
     # --- FIX: Check for existing key with the same name for this user ---
     existing_key = await apikey_crud.get_api_key_by_name_and_user_id(db, key_name=key_name, user_id=user_id)
     if existing_key:
@@ -815,7 +910,10 @@ async def create_user_api_key(
         user_id=user_id, 
         key_name=key_name,
         rate_limit_requests=rate_limit_requests,
-        rate_limit_window_minutes=rate_limit_window_minutes
+        rate_limit_window_minutes=rate_limit_window_minutes,
+        priority_class=priority_class,
+        token_limit_per_minute=token_limit_per_minute,
+        token_limit_per_day=token_limit_per_day
     )
     
     context = get_template_context(request)
@@ -839,6 +937,22 @@ async def toggle_key_active_status(
     flash(request, f"API Key '{key.key_name}' has been {new_status}.", "success")
     return RedirectResponse(url=request.url_for("get_user_details", user_id=key.user_id), status_code=status.HTTP_303_SEE_OTHER)
 
+@router.post("/keys/{key_id}/toggle-priority", name="admin_toggle_key_priority", dependencies=[Depends(validate_csrf_token)])
+async def toggle_key_priority_class(
+    request: Request,
+    key_id: int,
+    db: AsyncSession = Depends(get_db),
+    admin_user: User = Depends(require_admin_user),
+):
+    key = await apikey_crud.get_api_key_by_id(db, key_id=key_id)
+    if not key or key.is_revoked:
+        raise HTTPException(status_code=404, detail="API Key not found or already revoked")
+
+    new_class = PRIORITY_INTERACTIVE if key.priority_class == PRIORITY_BATCH else PRIORITY_BATCH
+    key = await apikey_crud.set_api_key_priority_class(db, key_id=key_id, priority_class=new_class)
+    flash(request, f"API Key '{key.key_name}' is now in the {new_class} priority class.", "success")
+    return RedirectResponse(url=request.url_for("get_user_details", user_id=key.user_id), status_code=status.HTTP_303_SEE_OTHER)
+
 @router.post("/keys/{key_id}/revoke", name="admin_revoke_key", dependencies=[Depends(validate_csrf_token)])
 async def revoke_user_api_key(
     request: Request,
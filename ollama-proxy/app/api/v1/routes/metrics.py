@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.api.v1.dependencies import api_key_header, get_settings, get_valid_api_key, ip_filter
+from app.core import metrics
+from app.database.session import get_db
+from app.schema.settings import AppSettingsModel
+
+
+async def metrics_auth(
+    request: Request,
+    settings: AppSettingsModel = Depends(get_settings),
+    db: AsyncSession = Depends(get_db),
+    auth_header: str = Depends(api_key_header),
+) -> None:
+    """Asks the scraper for an API key when the administrator turned that on."""
+    if settings.metrics_require_api_key:
+        await get_valid_api_key(request, db, auth_header)
+
+
+router = APIRouter(dependencies=[Depends(ip_filter), Depends(metrics_auth)])
+
+
+@router.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """
+    Prometheus scrape endpoint, aggregated over every gunicorn worker.
+    Subject to the proxy's IP allow/deny lists and, if enabled in the
+    settings, to a valid API key.
+    """
+    body, content_type = metrics.render(request.headers.get("accept"))
+    return Response(content=body, media_type=content_type)
@@ -2,22 +2,60 @@ import asyncio
 import json
 import logging
 import datetime
-from typing import List, Tuple, Optional, Dict, Any
+import time
+from typing import List, Tuple, Optional, Dict, Any, Awaitable, Callable
 from fastapi import APIRouter, Depends, Request, Response, HTTPException, status
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
+import httpx
+import orjson
 from httpx import AsyncClient
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database.session import get_db
-from app.api.v1.dependencies import get_valid_api_key, rate_limiter, ip_filter, get_settings
-from app.database.models import APIKey, OllamaServer
-from app.crud import log_crud, server_crud, model_metadata_crud
-from app.core.retry import retry_with_backoff, RetryConfig
+from app.api.v1.dependencies import get_valid_api_key, rate_limiter, ip_filter, get_settings, token_limits_for
+from app.database.models import APIKey
+from app.crud import server_crud, model_metadata_crud
+from app.core.retry import (
+    retry_with_backoff,
+    RetryConfig,
+    RetryBudgets,
+    BackendUnavailableError,
+    RETRY_SAFE_EXCEPTIONS,
+)
 from app.schema.settings import AppSettingsModel
-from app.core.encryption import decrypt_data
+from app.core.routing_table import routing_table, BackendServer
+from app.core.load_balancer import LoadBalancer, InFlightGuard
+from app.core.affinity import affinity_key
+from app.core.embed_fanout import split_embed_body, merge_embed_responses
+from app.core.embed_batcher import EmbeddingBatcher
+from app.core.embedding_cache import EmbeddingCache, EmbeddingLookup
+from app.core.response_cache import ResponseCache, deterministic_key
+from app.core.model_info import show_cache, version_cache
+from app.core.connection_pools import backend_pools
+from app.core.resident_models import ResidentModelTracker
+from app.core.json_scan import (
+    JsonMember,
+    array_elements,
+    is_empty_value,
+    member_value,
+    object_members,
+    remove_member,
+    replace_value,
+    set_member,
+)
+from app.core.circuit_breaker import CircuitBreakerRegistry, STATE_CLOSED, STATE_HALF_OPEN
+from app.core.admission import AdmissionController, AdmissionTicket, AdmissionRejected
+from app.core.rate_limit import RateLimiter
+from app.core import metrics
+from app.core.token_accounting import tap_response_usage, RequestTimings, ResponseUsage
 from app.core.vllm_translator import (
     translate_ollama_to_vllm_chat,
+    translate_ollama_to_vllm_generate,
     translate_ollama_to_vllm_embeddings,
+    translate_vllm_to_ollama_chat,
+    translate_vllm_to_ollama_generate,
+    translate_vllm_to_ollama_embed,
     translate_vllm_to_ollama_embeddings,
     vllm_stream_to_ollama_stream
 )
@@ -25,10 +63,19 @@ from app.core.vllm_translator import (
 logger = logging.getLogger(__name__)
 router = APIRouter(dependencies=[Depends(ip_filter), Depends(rate_limiter)])
 
+# Endpoints that run a model; these go through admission control
+INFERENCE_PATHS = ("generate", "chat", "embed", "embeddings")
+
+# /api/ps answers come from a resident model poll at most this old
+PS_MAX_AGE_SECONDS = 2.0
+
+# Fields an /api/show request may have and still be answered from the cache
+SHOW_CACHEABLE_FIELDS = {"model", "name", "verbose"}
+
 # --- Dependency to get active servers ---
-async def get_active_servers(db: AsyncSession = Depends(get_db)) -> List[OllamaServer]:
-    servers = await server_crud.get_servers(db)
-    active_servers = [s for s in servers if s.is_active]
+async def get_active_servers() -> List[BackendServer]:
+    snapshot = await routing_table.get()
+    active_servers = snapshot.servers
     if not active_servers:
         logger.error("No active Ollama backend servers are configured in the database.")
         raise HTTPException(
@@ -66,7 +113,7 @@ async def extract_model_from_request(request: Request) -> Optional[str]:
 
 async def _send_backend_request(
     http_client: AsyncClient,
-    server: OllamaServer,
+    server: BackendServer,
     path: str,
     method: str,
     headers: dict,
@@ -77,14 +124,10 @@ async def _send_backend_request(
     Internal function to send a single request to a backend server.
     This function is wrapped by retry logic.
     """
-    normalized_url = server.url.rstrip('/')
-    backend_url = f"{normalized_url}/api/{path}"
+    backend_url = f"{server.url}/api/{path}"
 
     request_headers = headers.copy()
-    if server.encrypted_api_key:
-        api_key = decrypt_data(server.encrypted_api_key)
-        if api_key:
-            request_headers["Authorization"] = f"Bearer {api_key}"
+    request_headers.update(server.auth_headers)
 
     backend_request = http_client.build_request(
         method=method,
@@ -97,10 +140,11 @@ async def _send_backend_request(
     try:
         backend_response = await http_client.send(backend_request, stream=True)
 
-        # Consider 5xx errors as failures that should be retried
-        if backend_response.status_code >= 500:
+        # A 503 before any body means the request was not processed and can be retried.
+        # Other 5xx responses are passed through: the backend may already have done the work.
+        if backend_response.status_code == 503:
             await backend_response.aclose()  # Clean up the response
-            raise Exception(
+            raise BackendUnavailableError(
                 f"Backend server returned {backend_response.status_code}: "
                 f"{backend_response.reason_phrase}"
             )
@@ -113,13 +157,163 @@ async def _send_backend_request(
         raise
 
 
-async def _reverse_proxy(request: Request, path: str, servers: List[OllamaServer], body_bytes: bytes = b"") -> Tuple[Response, OllamaServer]:
+async def _track_in_flight(
+    response: Response,
+    guard: InFlightGuard,
+    ticket: Optional[AdmissionTicket] = None,
+    upstream: Optional[httpx.Response] = None,
+) -> Response:
+    """
+    Keeps the backend's in-flight slot (and admission slot, if any) held until
+    the response body is fully sent (or the client disconnects), recording
+    TTFB on the first chunk.
+
+    The slots (and the `upstream` response, if given) are released when the
+    body ends and again, as a no-op by then, from the response's background
+    hook, which Starlette runs even when the client went away before the
+    first chunk and the body was never iterated. The admission and local
+    slots are freed before anything is awaited, since a cancelled release
+    cannot await anything else. Error responses do not feed the TTFB average.
+    """
+    if not 200 <= response.status_code < 300:
+        guard.record_ttfb = False
+    if not isinstance(response, StreamingResponse):
+        guard.first_byte()
+        if ticket:
+            ticket.release()
+        await guard.release()
+        return response
+
+    async def release() -> None:
+        if ticket:
+            ticket.release()
+        try:
+            await guard.release()
+        finally:
+            if upstream is not None:
+                await asyncio.shield(upstream.aclose())
+
+    body_iterator = response.body_iterator
+
+    async def tracked_body():
+        try:
+            async for chunk in body_iterator:
+                guard.first_byte()
+                yield chunk
+        finally:
+            await release()
+
+    previous_background = response.background
+
+    async def background() -> None:
+        try:
+            await release()
+        finally:
+            if previous_background is not None:
+                await previous_background()
+
+    response.body_iterator = tracked_body()
+    response.background = BackgroundTask(background)
+    return response
+
+
+async def _stream_backend_body(backend_response):
+    try:
+        async for chunk in backend_response.aiter_raw():
+            yield chunk
+    finally:
+        await backend_response.aclose()
+
+
+async def _reverse_proxy(
+    request: Request,
+    path: str,
+    servers: List[BackendServer],
+    body_bytes: bytes = b"",
+    model_name: Optional[str] = None,
+    conversation_key: Optional[str] = None,
+    api_key: Optional[APIKey] = None,
+    timings: Optional[RequestTimings] = None,
+) -> Tuple[Response, BackendServer]:
     """
     Core reverse proxy logic with retry support. Forwards the request to a backend
     Ollama server and streams the response back. Returns the response and the chosen server.
+    Servers are tried in the order chosen by the configured load balancing strategy,
+    or by conversation affinity when it is enabled and the request has a conversation key.
+    Inference requests first wait for a backend slot in the admission queue.
     """
-    http_client: AsyncClient = request.app.state.http_client
     app_settings: AppSettingsModel = request.app.state.settings
+    load_balancer: LoadBalancer = request.app.state.load_balancer
+
+    # Load statistics are kept per model only for models a server lists, so
+    # names chosen by clients cannot grow them without bound
+    load_model = model_name
+    if model_name and not (await routing_table.get()).knows_model(model_name):
+        load_model = None
+    record_ttfb = load_model is not None or not model_name
+
+    if conversation_key and app_settings.affinity_routing_enabled:
+        # Pin the conversation to one backend so its prompt cache is reused
+        ordered_servers = await load_balancer.order_by_affinity(
+            servers, conversation_key, load_model, app_settings.affinity_load_factor
+        )
+    else:
+        # Prefer servers that already have the model loaded
+        warm_server_ids = request.app.state.resident_models.warm_server_ids(servers, model_name)
+        ordered_servers = await load_balancer.order(
+            servers,
+            app_settings.load_balancing_strategy,
+            load_model,
+            warm_server_ids=warm_server_ids,
+            warm_max_in_flight=app_settings.warm_routing_max_in_flight,
+        )
+
+    ticket: Optional[AdmissionTicket] = None
+    if api_key is not None and app_settings.admission_control_enabled and path in INFERENCE_PATHS:
+        admission: AdmissionController = request.app.state.admission
+        try:
+            ticket = await admission.admit(ordered_servers, api_key.id, api_key.priority_class)
+        except AdmissionRejected as e:
+            metrics.REJECTIONS.labels("admission").inc()
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="All backend servers are busy. Please retry later.",
+                headers={"Retry-After": str(e.retry_after_seconds)},
+            )
+        # Start with the server the slot was granted on
+        ordered_servers = sorted(ordered_servers, key=lambda s: s.id != ticket.server_id)
+
+    try:
+        return await _forward_to_servers(
+            request, path, ordered_servers, body_bytes, load_model, ticket, timings, record_ttfb
+        )
+    except BaseException:
+        if ticket:
+            ticket.release()
+        raise
+
+
+async def _forward_to_servers(
+    request: Request,
+    path: str,
+    ordered_servers: List[BackendServer],
+    body_bytes: bytes,
+    load_model: Optional[str],
+    ticket: Optional[AdmissionTicket],
+    timings: Optional[RequestTimings] = None,
+    record_ttfb: bool = True,
+) -> Tuple[Response, BackendServer]:
+    """
+    Tries `ordered_servers` in order, with retries, circuit breakers and
+    retry budgets. On success the in-flight and admission slots are handed
+    over to the response body. Load is tracked under `load_model`, and TTFB
+    only averaged if `record_ttfb`.
+    """
+    app_settings: AppSettingsModel = request.app.state.settings
+    load_balancer: LoadBalancer = request.app.state.load_balancer
+    breakers: CircuitBreakerRegistry = request.app.state.circuit_breakers
+    use_breakers = app_settings.circuit_breaker_enabled
+    retry_budgets: RetryBudgets = request.app.state.retry_budgets
 
     # Get retry configuration from app settings
     retry_config = RetryConfig(
@@ -127,60 +321,120 @@ async def _reverse_proxy(request: Request, path: str, servers: List[OllamaServer
         total_timeout_seconds=app_settings.retry_total_timeout_seconds,
         base_delay_ms=app_settings.retry_base_delay_ms
     )
+    # A half-open circuit gets exactly one trial request
+    trial_config = RetryConfig(
+        max_retries=0,
+        total_timeout_seconds=app_settings.retry_total_timeout_seconds,
+        base_delay_ms=app_settings.retry_base_delay_ms
+    )
 
-    if not hasattr(request.app.state, 'backend_server_index'):
-        request.app.state.backend_server_index = 0
-
-    # Prepare request headers (exclude 'host' header)
-    headers = {k: v for k, v in request.headers.items() if k.lower() != 'host'}
+    # Prepare request headers (exclude 'host', and 'content-length' since the body may have been rewritten)
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in ('host', 'content-length')}
 
-    # Try each server in round-robin fashion
-    num_servers = len(servers)
+    num_servers = len(ordered_servers)
     servers_tried = []
+    servers_skipped = []
+    retry_budget_exhausted = False
+
+    for server_attempt, chosen_server in enumerate(ordered_servers):
+        circuit_state = breakers.allow_request(chosen_server.id, chosen_server.name) if use_breakers else STATE_CLOSED
+        if circuit_state is None:
+            logger.info(f"Skipping server '{chosen_server.name}': circuit is open")
+            servers_skipped.append(chosen_server)
+            continue
 
-    for server_attempt in range(num_servers):
-        # Select next server using round-robin
-        index = request.app.state.backend_server_index
-        chosen_server = servers[index]
-        request.app.state.backend_server_index = (index + 1) % len(servers)
+        # Failing over to another server re-sends the request, so it spends retry budget too
+        if servers_tried and not retry_budgets.try_retry():
+            logger.warning("Retry budget exhausted, not failing over to another server")
+            retry_budget_exhausted = True
+            break
 
+        if servers_tried:
+            metrics.UPSTREAM_RETRIES.labels(chosen_server.name, "failover").inc()
         servers_tried.append(chosen_server.name)
+        if ticket:
+            ticket.move_to(chosen_server.id)
 
         logger.info(
             f"Attempting request to server '{chosen_server.name}' "
             f"({server_attempt + 1}/{num_servers})"
         )
 
+        guard = await load_balancer.acquire(
+            chosen_server.id, load_model, chosen_server.name, record_ttfb=record_ttfb
+        )
+        if timings:
+            timings.upstream_at = guard.started_at
+
         # --- BRANCH: Handle vLLM servers differently ---
         if chosen_server.server_type == 'vllm':
             try:
                 # vLLM translation doesn't use the retry logic wrapper in the same way
                 response = await _proxy_to_vllm(request, chosen_server, path, body_bytes)
-                return response, chosen_server
-            except HTTPException:
+                if use_breakers:
+                    breakers.record_success(chosen_server.id)
+                retry_budgets.record_success(chosen_server.id)
+                return await _track_in_flight(response, guard, ticket), chosen_server
+            except HTTPException as e:
+                await guard.release()
+                if use_breakers:
+                    if e.status_code >= 500:
+                        breakers.record_failure(chosen_server.id)
+                    else:
+                        breakers.record_success(chosen_server.id)
                 raise # Re-raise HTTP exceptions from the vLLM proxy
             except Exception as e:
+                await guard.release()
+                if use_breakers:
+                    breakers.record_failure(chosen_server.id)
                 logger.warning(f"vLLM server '{chosen_server.name}' failed: {e}. Trying next server.")
                 continue # Try next server
 
         # --- Ollama server logic (with retries) ---
-        retry_result = await retry_with_backoff(
-            _send_backend_request,
-            http_client=http_client,
-            server=chosen_server,
-            path=path,
-            method=request.method,
-            headers=headers,
-            query_params=request.query_params,
-            body_bytes=body_bytes,
-            config=retry_config,
-            retry_on_exceptions=(Exception,),
-            operation_name=f"Request to {chosen_server.name}"
-        )
+        try:
+            retry_result = await retry_with_backoff(
+                _send_backend_request,
+                http_client=backend_pools.client_for(chosen_server),
+                server=chosen_server,
+                path=path,
+                method=request.method,
+                headers=headers,
+                query_params=request.query_params,
+                body_bytes=body_bytes,
+                config=trial_config if circuit_state == STATE_HALF_OPEN else retry_config,
+                retry_on_exceptions=RETRY_SAFE_EXCEPTIONS,
+                operation_name=f"Request to {chosen_server.name}",
+                should_retry=lambda: retry_budgets.try_retry(chosen_server.id),
+            )
+        except Exception as e:
+            # The backend may have started processing the request: neither retry nor fail over
+            await guard.release()
+            retry_budgets.not_retried += 1
+            if use_breakers:
+                breakers.record_failure(chosen_server.id)
+            logger.warning(f"Request to '{chosen_server.name}' failed and is not safe to retry: {type(e).__name__}: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail=f"Backend server '{chosen_server.name}' failed while handling the request."
+            )
+        except BaseException:
+            await guard.release()
+            raise
+
+        if retry_result.attempts > 1:
+            metrics.UPSTREAM_RETRIES.labels(chosen_server.name, "retry").inc(retry_result.attempts - 1)
 
         if retry_result.success:
             # Success! Create streaming response
             backend_response = retry_result.result
+            if backend_response.status_code >= 500:
+                # Passed through as is, but it still counts against the server's health
+                if use_breakers:
+                    breakers.record_failure(chosen_server.id)
+            else:
+                if use_breakers:
+                    breakers.record_success(chosen_server.id)
+                retry_budgets.record_success(chosen_server.id)
 
             logger.info(
                 f"Successfully proxied to '{chosen_server.name}' "
@@ -189,18 +443,41 @@ async def _reverse_proxy(request: Request, path: str, servers: List[OllamaServer
             )
 
             response = StreamingResponse(
-                backend_response.aiter_raw(),
+                _stream_backend_body(backend_response),
                 status_code=backend_response.status_code,
                 headers=backend_response.headers,
             )
-            return response, chosen_server
+            return await _track_in_flight(response, guard, ticket, backend_response), chosen_server
         else:
+            await guard.release()
+            if use_breakers:
+                breakers.record_failure(chosen_server.id)
             # This server failed after all retries, try next server
             logger.warning(
                 f"Server '{chosen_server.name}' failed after {retry_result.attempts} "
-                f"attempts. Trying next server if available."
+                f"attempts{' (retry budget exhausted)' if retry_result.budget_exhausted else ''}. "
+                f"Trying next server if available."
             )
 
+    if not servers_tried:
+        # Every candidate's circuit is open: fail fast instead of waiting on dead servers
+        retry_after = min(
+            (breakers.get(s.id).stats(breakers.config)["retry_in_seconds"] or 1) for s in servers_skipped
+        )
+        logger.warning(f"All {num_servers} candidate server(s) have an open circuit")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="All backend servers are temporarily unavailable.",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
+
+    if retry_budget_exhausted:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Backend servers are failing and the retry budget is exhausted. Tried: {', '.join(servers_tried)}",
+            headers={"Retry-After": "1"},
+        )
+
     # All servers exhausted
     logger.error(
         f"All {num_servers} backend server(s) failed after retries. "
@@ -212,16 +489,167 @@ async def _reverse_proxy(request: Request, path: str, servers: List[OllamaServer
     )
 
 
+async def _read_body(response: Response) -> bytes:
+    """The whole body of a proxied response; reading a streamed one to the end releases its slots."""
+    if isinstance(response, StreamingResponse):
+        try:
+            return b"".join([chunk async for chunk in response.body_iterator])
+        finally:
+            if response.background is not None:
+                await response.background()
+    return bytes(response.body)
+
+
+async def _fan_out_embed(
+    request: Request,
+    chunks: List[bytes],
+    servers: List[BackendServer],
+    model_name: Optional[str],
+    api_key: APIKey,
+    timings: RequestTimings,
+) -> Tuple[Response, BackendServer]:
+    """
+    Sends the chunks of a large /api/embed request in parallel, each routed
+    like a request of its own, and merges the results in input order.
+    Returns the merged response and the server that embedded the first chunk.
+    """
+    app_settings: AppSettingsModel = request.app.state.settings
+    semaphore = asyncio.Semaphore(app_settings.embed_fanout_max_parallel)
+    timings.upstream_at = time.perf_counter()
+
+    async def embed_chunk(chunk: bytes) -> Tuple[int, bytes, BackendServer]:
+        async with semaphore:
+            response, server = await _reverse_proxy(request, "embed", servers, chunk, model_name, None, api_key)
+            return response.status_code, await _read_body(response), server
+
+    tasks = [asyncio.create_task(embed_chunk(chunk)) for chunk in chunks]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    servers_used = {server.id: server for _, _, server in results}
+    logger.info(
+        f"Embedding fan-out: {len(chunks)} chunk(s) of model '{model_name}' "
+        f"over {len(servers_used)} server(s): {', '.join(s.name for s in servers_used.values())}"
+    )
+
+    failed = next((result for result in results if result[0] != 200), None)
+    if failed:
+        status_code, body, server = failed
+        return Response(content=body, status_code=status_code, media_type="application/json"), server
+
+    if model_name:
+        for server in servers_used.values():
+            request.app.state.resident_models.mark_loaded(server.id, model_name)
+
+    total_duration_ns = int((time.perf_counter() - timings.received_at) * 1_000_000_000)
+    merged = merge_embed_responses([body for _, body, _ in results], total_duration_ns)
+    return Response(content=merged, media_type="application/json"), results[0][2]
+
+
+# Fields a request may have to join a batch, and the field holding its text, per endpoint
+BATCHABLE_EMBEDDING_FIELDS = {
+    "embeddings": ({"model", "prompt", "options", "keep_alive", "truncate"}, "prompt"),
+    "embed": ({"model", "input", "options", "keep_alive", "truncate", "dimensions"}, "input"),
+}
+
+
+def _batchable_embedding(path: str, body_bytes: bytes, members: Dict[str, JsonMember]) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """The text and the other fields of a single-text /api/embed or /api/embeddings request that can join a batch, or None."""
+    allowed, text_field = BATCHABLE_EMBEDDING_FIELDS[path]
+    if text_field not in members or not set(members) <= allowed:
+        return None
+    try:
+        prompt = member_value(body_bytes, members[text_field])
+        extra = {name: member_value(body_bytes, member) for name, member in members.items() if name not in ("model", text_field)}
+    except ValueError:
+        return None
+    if isinstance(prompt, list) and len(prompt) == 1 and path == "embed":
+        prompt = prompt[0]
+    if not isinstance(prompt, str):
+        return None
+    return prompt, extra
+
+
+async def _batched_embedding(
+    request: Request,
+    path: str,
+    prompt: str,
+    extra: Dict[str, Any],
+    servers: List[BackendServer],
+    model_name: str,
+    api_key: APIKey,
+    timings: RequestTimings,
+) -> Tuple[Response, BackendServer]:
+    """Embeds the text as part of a micro-batch sent to /api/embed with other concurrent requests."""
+    batcher: EmbeddingBatcher = request.app.state.embed_batcher
+
+    async def send_batch(prompts: List[str]) -> Tuple[int, bytes, BackendServer]:
+        body = orjson.dumps({"model": model_name, "input": prompts, **extra})
+        response, server = await _reverse_proxy(request, "embed", servers, body, model_name, None, api_key)
+        return response.status_code, await _read_body(response), server
+
+    batch_key = (path, model_name, orjson.dumps(extra, option=orjson.OPT_SORT_KEYS))
+    timings.upstream_at = time.perf_counter()
+    status_code, body, server = await batcher.embed(batch_key, path, prompt, send_batch)
+    return Response(content=body, status_code=status_code, media_type="application/json"), server
+
+
+async def _cached_embedding(
+    request: Request,
+    lookup: EmbeddingLookup,
+    forward: Callable[[bytes, Dict[str, JsonMember]], Awaitable[Tuple[Response, BackendServer]]],
+    model_name: str,
+    timings: RequestTimings,
+) -> Tuple[Response, Optional[BackendServer]]:
+    """
+    Answers an embedding request from the cache, sending upstream (with
+    `forward`) only the texts that were not cached. The server is None when
+    nothing had to be sent.
+    """
+    cache: EmbeddingCache = request.app.state.embedding_cache
+    if lookup.miss_body is None:
+        total_duration_ns = int((time.perf_counter() - timings.received_at) * 1_000_000_000)
+        logger.info(f"Embedding cache: all {len(lookup.keys)} text(s) for model '{model_name}' served from cache")
+        return Response(content=lookup.cached_response(model_name, total_duration_ns), media_type="application/json"), None
+
+    missing = len(lookup.missing)
+    if missing < len(lookup.keys):
+        logger.info(f"Embedding cache: {len(lookup.keys) - missing} of {len(lookup.keys)} text(s) for model '{model_name}' served from cache")
+    response, server = await forward(lookup.miss_body, object_members(lookup.miss_body))
+    if response.status_code != 200:
+        return response, server
+
+    body = await _read_body(response)
+    total_duration_ns = int((time.perf_counter() - timings.received_at) * 1_000_000_000)
+    try:
+        merged = await cache.fill(lookup, body, total_duration_ns)
+    except ValueError as e:
+        logger.error(f"Could not cache the embeddings returned by '{server.name}': {e}")
+        if missing < len(lookup.keys):
+            error = orjson.dumps({"error": "Backend returned an incomplete embedding response"})
+            return Response(content=error, status_code=status.HTTP_502_BAD_GATEWAY, media_type="application/json"), server
+        merged = body
+    return Response(content=merged, media_type="application/json"), server
+
+
 async def _proxy_to_vllm(
     request: Request,
-    server: OllamaServer,
+    server: BackendServer,
     path: str,
     body_bytes: bytes
 ) -> Response:
     """
     Handles proxying a request to a vLLM server, including payload and response translation.
+    /api/chat and /api/generate (streamed or not) go to the OpenAI chat or
+    completions endpoints; /api/embed and /api/embeddings to /v1/embeddings.
     """
-    http_client: AsyncClient = request.app.state.http_client
+    http_client: AsyncClient = backend_pools.client_for(server)
+    started_at = time.perf_counter()
     
     try:
         ollama_payload = json.loads(body_bytes) if body_bytes else {}
@@ -230,139 +658,217 @@ async def _proxy_to_vllm(
 
     model_name = ollama_payload.get("model")
     
-    headers = {}
-    if server.encrypted_api_key:
-        api_key = decrypt_data(server.encrypted_api_key)
-        if api_key:
-            headers["Authorization"] = f"Bearer {api_key}"
+    headers = dict(server.auth_headers)
 
     # Translate path and payload based on the endpoint
     if path == "chat":
         vllm_path = "v1/chat/completions"
         vllm_payload = translate_ollama_to_vllm_chat(ollama_payload)
-    elif path == "embeddings":
+    elif path == "generate":
+        vllm_path, vllm_payload = translate_ollama_to_vllm_generate(ollama_payload)
+    elif path in ("embed", "embeddings"):
         vllm_path = "v1/embeddings"
         vllm_payload = translate_ollama_to_vllm_embeddings(ollama_payload)
     else:
         raise HTTPException(status_code=404, detail=f"Endpoint '/api/{path}' not supported for vLLM servers.")
         
-    backend_url = f"{server.url.rstrip('/')}/{vllm_path}"
+    backend_url = f"{server.url}/{vllm_path}"
     is_streaming = vllm_payload.get("stream", False)
 
     try:
         if is_streaming:
+            # Opened here rather than in the body, so that connect errors and error
+            # statuses reach the caller's circuit breaker and failover
+            vllm_request = http_client.build_request("POST", backend_url, json=vllm_payload, headers=headers, timeout=600.0)
+            vllm_response = await http_client.send(vllm_request, stream=True)
+            if not vllm_response.is_success:
+                await vllm_response.aread()
+                await vllm_response.aclose()
+                vllm_response.raise_for_status()
+
             async def stream_generator():
-                async with http_client.stream("POST", backend_url, json=vllm_payload, timeout=600.0, headers=headers) as vllm_response:
-                    if vllm_response.status_code != 200:
-                        error_body = await vllm_response.aread()
-                        logger.error(f"vLLM server error ({vllm_response.status_code}): {error_body.decode()}")
-                        # Yield a single error chunk in Ollama format
-                        error_chunk = {"error": f"vLLM server error: {error_body.decode()}"}
-                        yield (json.dumps(error_chunk) + '\n').encode('utf-8')
-                        return
-                    
-                    async for chunk in vllm_stream_to_ollama_stream(vllm_response.aiter_text(), model_name):
+                try:
+                    async for chunk in vllm_stream_to_ollama_stream(vllm_response.aiter_bytes(), model_name, path):
                         yield chunk
-            
-            return StreamingResponse(stream_generator(), media_type="application/x-ndjson")
+                finally:
+                    await vllm_response.aclose()
+
+            return StreamingResponse(
+                stream_generator(),
+                media_type="application/x-ndjson",
+                background=BackgroundTask(vllm_response.aclose),
+            )
         else: # Non-streaming
             response = await http_client.post(backend_url, json=vllm_payload, timeout=600.0, headers=headers)
             response.raise_for_status()
             vllm_data = response.json()
+            total_duration_ns = int((time.perf_counter() - started_at) * 1_000_000_000)
             
-            if path == "embeddings":
+            if path == "chat":
+                ollama_data = translate_vllm_to_ollama_chat(vllm_data, model_name, total_duration_ns)
+            elif path == "generate":
+                ollama_data = translate_vllm_to_ollama_generate(vllm_data, model_name, total_duration_ns)
+            elif path == "embed":
+                ollama_data = translate_vllm_to_ollama_embed(vllm_data, model_name, total_duration_ns)
+            else:
                 ollama_data = translate_vllm_to_ollama_embeddings(vllm_data)
-                return JSONResponse(content=ollama_data)
-            # Add non-streaming chat translation if needed
-            raise NotImplementedError("Non-streaming chat for vLLM not yet implemented.")
+            return JSONResponse(content=ollama_data)
 
     except httpx.HTTPStatusError as e:
         error_detail = e.response.text
         logger.error(f"vLLM request failed with status {e.response.status_code}: {error_detail}")
         raise HTTPException(status_code=e.response.status_code, detail=f"vLLM server error: {error_detail}")
+    except (httpx.ConnectError, httpx.ConnectTimeout):
+        # Nothing was sent, so the caller can fail over to the next server
+        raise
     except Exception as e:
         logger.error(f"Error proxying to vLLM server {server.name}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to communicate with vLLM server: {e}")
 
 
+def _check_endpoint_allowed(path: str, settings: AppSettingsModel, api_key: APIKey) -> None:
+    """Raises 403 for the endpoints the administrator has blocked."""
+    blocked_paths = {p.strip().lstrip('/') for p in settings.blocked_ollama_endpoints.split(',') if p.strip()}
+    request_path = path.strip().lstrip('/')
+
+    if request_path in blocked_paths:
+        logger.warning(
+            f"Blocked attempt to access sensitive endpoint '/api/{request_path}' by API key {api_key.key_prefix}"
+        )
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Access to the endpoint '/api/{request_path}' is disabled by the proxy administrator."
+        )
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """True when an If-None-Match header lists `etag` (weak comparison) or is "*"."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
 @router.get("/tags")
 async def federate_models(
     request: Request,
     api_key: APIKey = Depends(get_valid_api_key),
-    db: AsyncSession = Depends(get_db)
 ):
     """
-    Aggregates models from all configured backends (Ollama and vLLM)
-    using the cached model data from the database for efficiency.
+    Aggregates models from all configured backends (Ollama and vLLM). The
+    response is encoded once per routing table rebuild, i.e. per model
+    refresh or server change, and clients holding it get a 304.
     """
-    logger.info("--- /tags endpoint: Starting model federation ---")
-    all_servers = await server_crud.get_servers(db)
-    servers = [s for s in all_servers if s.is_active]
-    logger.info(f"/tags: Found {len(servers)} active servers.")
-
-    all_models = {}
-    for server in servers:
-        logger.info(f"/tags: Processing server '{server.name}' (type: {server.server_type})")
-        models_list = server.available_models or []
-        
-        raw_models_repr = repr(models_list)
-        if len(raw_models_repr) > 300:
-            raw_models_repr = raw_models_repr[:300] + '... (truncated)'
-        logger.info(f"/tags: Raw 'available_models' for '{server.name}': {raw_models_repr}")
+    snapshot = await routing_table.get()
+    headers = {"ETag": snapshot.tags_etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), snapshot.tags_etag):
+        metrics.observe_request("tags", 304)
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-        if isinstance(models_list, str):
-            try:
-                models_list = json.loads(models_list)
-                logger.info(f"/tags: Successfully parsed JSON string for '{server.name}'")
-            except json.JSONDecodeError:
-                logger.warning(f"/tags: Could not parse available_models JSON for server {server.name}")
-                continue
-
-        if not isinstance(models_list, list):
-            logger.warning(f"/tags: Field available_models for server {server.name} is not a list. Type is {type(models_list)}")
-            continue
+    metrics.observe_request("tags", 200)
+    return Response(content=snapshot.tags_body, media_type="application/json", headers=headers)
 
-        model_count_on_server = 0
-        for model in models_list:
-            if isinstance(model, dict) and "name" in model:
-                # --- FIX: Ensure 'model' key exists for compatibility with Ollama clients ---
-                if "model" not in model:
-                    model["model"] = model["name"]
-                # --- END FIX ---
-                all_models[model['name']] = model
-                model_count_on_server += 1
-            else:
-                logger.warning(f"/tags: Invalid model format found for server '{server.name}': {model}")
-        
-        logger.info(f"/tags: Added {model_count_on_server} models from server '{server.name}'")
-
-    logger.info(f"/tags: Total unique models before adding 'auto': {len(all_models)}")
-
-    # Add the 'auto' model to the list for clients to see, with details for compatibility
-    all_models["auto"] = {
-        "name": "auto",
-        "model": "auto",
-        "modified_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-        "size": 0,
-        "digest": "auto-digest-placeholder",
-        "details": {
-            "parent_model": "",
-            "format": "proxy",
-            "family": "auto",
-            "families": ["auto"],
-            "parameter_size": "N/A",
-            "quantization_level": "N/A"
-        }
-    }
-
-    await log_crud.create_usage_log(
-        db=db, api_key_id=api_key.id, endpoint="/api/tags", status_code=200, server_id=None
-    )
-    
-    final_model_list = list(all_models.values())
-    logger.info("--- /tags endpoint: Finished model federation ---")
 
-    return {"models": final_model_list}
+@router.get("/ps")
+async def federate_running_models(
+    request: Request,
+    api_key: APIKey = Depends(get_valid_api_key),
+    settings: AppSettingsModel = Depends(get_settings),
+):
+    """
+    Lists the loaded models of every Ollama server, from the resident model
+    poll when it is recent enough.
+    """
+    _check_endpoint_allowed("ps", settings, api_key)
+    tracker: ResidentModelTracker = request.app.state.resident_models
+    models = await tracker.running_models(PS_MAX_AGE_SECONDS)
+    metrics.observe_request("ps", 200)
+    return Response(content=orjson.dumps({"models": models}), media_type="application/json")
+
+
+@router.get("/version")
+async def federate_version(
+    request: Request,
+    api_key: APIKey = Depends(get_valid_api_key),
+    settings: AppSettingsModel = Depends(get_settings),
+    servers: List[BackendServer] = Depends(get_active_servers),
+):
+    """Reports the lowest version among the Ollama servers, cached for a few minutes."""
+    _check_endpoint_allowed("version", settings, api_key)
+    body = await version_cache.get(servers)
+    if body is None:
+        metrics.observe_request("version", status.HTTP_502_BAD_GATEWAY)
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="No backend server reported its version."
+        )
+    metrics.observe_request("version", 200)
+    return Response(content=body, media_type="application/json")
+
+
+@router.post("/show")
+async def show_model(
+    request: Request,
+    api_key: APIKey = Depends(get_valid_api_key),
+    db: AsyncSession = Depends(get_db),
+    settings: AppSettingsModel = Depends(get_settings),
+    servers: List[BackendServer] = Depends(get_active_servers),
+):
+    """
+    Answers from the cache of /api/show responses by model digest, asking a
+    server hosting the model on a miss. Verbose requests and models without a
+    known digest are proxied like any other request.
+    """
+    _check_endpoint_allowed("show", settings, api_key)
+    body_bytes = await request.body()
+    model_name = None
+    try:
+        members = object_members(body_bytes) if body_bytes else {}
+        name_member = members.get("model") or members.get("name")
+        if name_member is not None and set(members) <= SHOW_CACHEABLE_FIELDS:
+            if "verbose" not in members or is_empty_value(body_bytes, members["verbose"]):
+                model_name = member_value(body_bytes, name_member)
+    except ValueError:
+        model_name = None
+
+    if isinstance(model_name, str) and model_name:
+        snapshot = await routing_table.get()
+        digest = snapshot.model_digest(model_name)
+        if digest:
+            body = show_cache.get(model_name, digest)
+            for server in snapshot.servers_for_model(model_name):
+                if body is not None:
+                    break
+                if server.server_type == "ollama":
+                    body = await show_cache.fetch(
+                        backend_pools.client_for(server), server.url, server.auth_headers, model_name, digest
+                    )
+            if body is not None:
+                metrics.observe_request("show", 200, model=metrics.model_label(model_name, snapshot.knows_model(model_name)))
+                return Response(content=body, media_type="application/json")
+
+    return await proxy_ollama(request, "show", api_key, db, settings, servers)
+
+
+def _auto_routing_fields(body_bytes: bytes, members: Dict[str, JsonMember]) -> Dict[str, Any]:
+    """
+    The parts of a request body that auto-routing looks at, decoded on their
+    own: the prompt, the last message and the options. Images are only
+    checked for being present.
+    """
+    fields: Dict[str, Any] = {}
+    try:
+        if "images" in members and not is_empty_value(body_bytes, members["images"]):
+            fields["images"] = True
+        for name in ("prompt", "options"):
+            if name in members:
+                fields[name] = member_value(body_bytes, members[name])
+        if "messages" in members:
+            messages = array_elements(body_bytes, members["messages"].value_start)
+            fields["messages"] = [json.loads(body_bytes[messages[-1][0]:messages[-1][1]])] if messages else []
+    except ValueError as e:
+        logger.debug(f"Could not read auto-routing fields from the request body: {e}")
+    return fields
 
 
 async def _select_auto_model(db: AsyncSession, body: Dict[str, Any]) -> Optional[str]:
@@ -434,60 +940,59 @@ async def proxy_ollama(
     api_key: APIKey = Depends(get_valid_api_key),
     db: AsyncSession = Depends(get_db),
     settings: AppSettingsModel = Depends(get_settings),
-    servers: List[OllamaServer] = Depends(get_active_servers),
+    servers: List[BackendServer] = Depends(get_active_servers),
 ):
     """
     A catch-all route that proxies all other requests to the backend.
     Uses smart routing and translates requests for vLLM servers.
     """
     # --- Endpoint Security Check ---
-    blocked_paths = {p.strip().lstrip('/') for p in settings.blocked_ollama_endpoints.split(',') if p.strip()}
-    request_path = path.strip().lstrip('/')
+    request_timestamp = datetime.datetime.utcnow()
+    timings = RequestTimings(received_at=time.perf_counter())
+    _check_endpoint_allowed(path, settings, api_key)
 
-    if request_path in blocked_paths:
-        logger.warning(
-            f"Blocked attempt to access sensitive endpoint '/api/{request_path}' by API key {api_key.key_prefix}"
-        )
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail=f"Access to the endpoint '/api/{request_path}' is disabled by the proxy administrator."
-        )
-
-    # Try to extract model name from request body
+    # Read only the fields we need; the body (images and all) is forwarded as sent
     body_bytes = await request.body()
     model_name = None
-    body = {}
+    members: Dict[str, JsonMember] = {}
 
     if body_bytes:
         try:
-            body = json.loads(body_bytes)
-            if isinstance(body, dict) and "model" in body:
-                model_name = body["model"]
-        except (json.JSONDecodeError, Exception):
-            pass
+            members = object_members(body_bytes)
+            if "model" in members:
+                model_name = member_value(body_bytes, members["model"])
+        except ValueError as e:
+            logger.debug(f"Could not read the request body as a JSON object: {e}")
+            members = {}
+        if not isinstance(model_name, str):
+            model_name = None
 
     # Handle 'think' parameter based on model support
-    if model_name and isinstance(body, dict) and "think" in body:
+    if model_name and "think" in members:
         model_name_lower = model_name.lower()
         supported_think_models = ["qwen", "gpt-oss", "deepseek"]
         
         is_supported = any(keyword in model_name_lower for keyword in supported_think_models)
 
-        if is_supported:
-            # Handle special case for gpt-oss which requires string values if boolean `true` is passed
-            if "gpt-oss" in model_name_lower and body.get("think") is True:
-                logger.info(f"Translating 'think: true' to 'think: \"medium\"' for GPT-OSS model '{model_name}'")
-                body["think"] = "medium"
-                body_bytes = json.dumps(body).encode('utf-8')
-        else:
-            # If the model is not supported, remove the 'think' parameter to avoid errors.
-            logger.warning(f"Model '{model_name}' is not in the known list for 'think' support. Removing 'think' parameter from request to avoid errors.")
-            del body["think"]
-            body_bytes = json.dumps(body).encode('utf-8')
+        # A value that cannot be decoded leaves the body as the client sent it
+        try:
+            if is_supported:
+                # Handle special case for gpt-oss which requires string values if boolean `true` is passed
+                if "gpt-oss" in model_name_lower and member_value(body_bytes, members["think"]) is True:
+                    logger.info(f"Translating 'think: true' to 'think: \"medium\"' for GPT-OSS model '{model_name}'")
+                    new_body = replace_value(body_bytes, members["think"], "medium")
+                    members, body_bytes = object_members(new_body), new_body
+            else:
+                # If the model is not supported, remove the 'think' parameter to avoid errors.
+                logger.warning(f"Model '{model_name}' is not in the known list for 'think' support. Removing 'think' parameter from request to avoid errors.")
+                new_body = remove_member(body_bytes, members, "think")
+                members, body_bytes = object_members(new_body), new_body
+        except ValueError as e:
+            logger.debug(f"Could not read the 'think' parameter, forwarding the body unchanged: {e}")
             
     # --- NEW: Handle 'auto' model routing ---
     if model_name == "auto":
-        chosen_model_name = await _select_auto_model(db, body)
+        chosen_model_name = await _select_auto_model(db, _auto_routing_fields(body_bytes, members))
         if not chosen_model_name:
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -496,13 +1001,17 @@ async def proxy_ollama(
         
         # Override the model in the request and continue
         model_name = chosen_model_name
-        body["model"] = model_name
-        body_bytes = json.dumps(body).encode('utf-8')
+        body_bytes = set_member(body_bytes, members, "model", model_name)
+        members = object_members(body_bytes)
 
     # Smart routing: filter servers by model availability
     candidate_servers = servers
+    metrics_model = None
     if model_name:
-        servers_with_model = await server_crud.get_servers_with_model(db, model_name)
+        snapshot = await routing_table.get()
+        servers_with_model = snapshot.servers_for_model(model_name)
+        # The name comes from the client, so only catalogued models get their own metrics label
+        metrics_model = metrics.model_label(model_name, snapshot.knows_model(model_name))
 
         if servers_with_model:
             candidate_servers = servers_with_model
@@ -512,20 +1021,98 @@ async def proxy_ollama(
             # Fall back to all active servers
             logger.warning(
                 f"Model '{model_name}' not found in any server's catalog. "
-                f"Falling back to round-robin across all {len(servers)} active server(s). "
+                f"Falling back to all {len(servers)} active server(s). "
                 f"Make sure to refresh model lists for accurate routing."
             )
 
     # Proxy to one of the candidate servers
-    response, chosen_server = await _reverse_proxy(request, path, candidate_servers, body_bytes)
-
-    await log_crud.create_usage_log(
-        db=db,
-        api_key_id=api_key.id,
-        endpoint=f"/api/{path}",
-        status_code=response.status_code,
-        server_id=chosen_server.id,
-        model=model_name
+    conversation_key = (
+        affinity_key(request.headers, model_name, body_bytes, members) if settings.affinity_routing_enabled else None
     )
 
-    return response
\ No newline at end of file
+    async def forward(body_bytes: bytes, members: Dict[str, JsonMember]) -> Tuple[Response, BackendServer]:
+        # Large embedding batches are spread over every server hosting the model,
+        # and single-text embedding requests may be combined into batches
+        if path == "embed" and len(candidate_servers) > 1:
+            embed_chunks = split_embed_body(body_bytes, members, settings.embed_fanout_chunk_size)
+            if embed_chunks:
+                return await _fan_out_embed(request, embed_chunks, candidate_servers, model_name, api_key, timings)
+        # /api/embeddings only by explicit choice: batched, its vectors come back normalized
+        batching = path == "embed" or (path == "embeddings" and settings.embed_batching_legacy_enabled)
+        if batching and settings.embed_batching_enabled and model_name:
+            batchable = _batchable_embedding(path, body_bytes, members)
+            if batchable:
+                return await _batched_embedding(request, path, *batchable, candidate_servers, model_name, api_key, timings)
+        return await _reverse_proxy(
+            request, path, candidate_servers, body_bytes, model_name, conversation_key, api_key, timings
+        )
+
+    # Texts the same model weights have already embedded are served from the cache
+    cache_lookup = None
+    if path in ("embed", "embeddings") and settings.embedding_cache_enabled and model_name:
+        digest = snapshot.model_digest(model_name)
+        if digest:
+            cache_lookup = await request.app.state.embedding_cache.lookup(digest, path, body_bytes, members)
+
+    # Generations that are fully determined by the request are cached and shared
+    response_cache_key = None
+    if path in ("generate", "chat") and settings.response_cache_enabled and model_name:
+        digest = snapshot.model_digest(model_name)
+        if digest:
+            response_cache_key = deterministic_key(path, digest, body_bytes, members)
+
+    try:
+        if cache_lookup is not None:
+            response, chosen_server = await _cached_embedding(request, cache_lookup, forward, model_name, timings)
+        elif response_cache_key is not None:
+            response_cache: ResponseCache = request.app.state.response_cache
+            response, chosen_server = await response_cache.respond(
+                response_cache_key, lambda: forward(body_bytes, members)
+            )
+        else:
+            response, chosen_server = await forward(body_bytes, members)
+    except HTTPException as e:
+        metrics.observe_request(path, e.status_code, model=metrics_model)
+        raise
+
+    # Inference requests leave the model loaded on the server that served them
+    if model_name and path in INFERENCE_PATHS and response.status_code < 400 and chosen_server:
+        request.app.state.resident_models.mark_loaded(chosen_server.id, model_name)
+
+    # Logged once the body has been streamed, with the token counts from its final chunk
+    per_minute, per_day = token_limits_for(api_key, settings)
+    rate_limits: RateLimiter = request.app.state.rate_limits
+
+    # Cached responses (no server) replay the original final chunk, so their
+    # tokens are read from it and counted against the key's quota like any other.
+    # This may run in cleanup after a disconnect: the log is queued before
+    # anything is awaited and the quota update is shielded from cancellation.
+    async def record_usage(usage: ResponseUsage) -> None:
+        telemetry = usage.telemetry(timings)
+        metrics.observe_request(
+            path,
+            response.status_code,
+            chosen_server.name if chosen_server else "",
+            metrics_model,
+            ttfb_seconds=telemetry["ttfb_ms"] / 1000 if telemetry["ttfb_ms"] is not None else None,
+            duration_seconds=telemetry["total_ms"] / 1000,
+        )
+        usage_log = dict(
+            api_key_id=api_key.id,
+            endpoint=f"/api/{path}",
+            status_code=response.status_code,
+            server_id=chosen_server.id if chosen_server else None,
+            model=model_name,
+            request_timestamp=request_timestamp,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            **telemetry,
+        )
+        usage_log_writer = request.app.state.usage_log_writer
+        if not usage_log_writer.enqueue_nowait(**usage_log):
+            await usage_log_writer.enqueue(**usage_log)
+        if per_minute > 0 or per_day > 0:
+            tokens = (usage.prompt_tokens or 0) + (usage.completion_tokens or 0)
+            await asyncio.shield(rate_limits.record_tokens(api_key.key_prefix, tokens))
+
+    return await tap_response_usage(response, timings, record_usage)
\ No newline at end of file
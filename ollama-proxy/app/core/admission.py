@@ -0,0 +1,278 @@
+"""
+Admission control in front of the backends.
+
+Each backend server has a fixed number of concurrency slots, matching the
+number of requests Ollama processes in parallel (OLLAMA_NUM_PARALLEL).
+Requests beyond that wait here instead of piling up in Ollama's own queue,
+where they would be served first come, first served and a single client
+could starve everyone else.
+
+Waiting requests are served with weighted fair queuing across API keys:
+every key is its own flow, and each request gets a virtual finish time of
+max(virtual clock, key's last finish) + 1 / weight, where the weight comes
+from the key's priority class. The waiter with the lowest finish time whose
+candidate servers have a free slot goes next, so a key flooding the proxy
+only delays its own requests, and interactive keys get a larger share than
+batch keys. A request that waits longer than the maximum queue time is shed.
+
+The slots and the queue live in each worker process. Under gunicorn the
+configured slots per server are split between the workers (at least one
+each), so all workers together send a backend no more than the setting
+allows; the master tells the workers how many of them there are through
+`WORKERS_ENV`. Fairness between keys holds within a worker, and across
+workers only as far as requests are spread evenly between them.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import time
+from bisect import insort
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.core.routing_table import BackendServer
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+# Share of the backends a backlogged key gets relative to other keys
+PRIORITY_WEIGHTS = {
+    PRIORITY_INTERACTIVE: 4.0,
+    PRIORITY_BATCH: 1.0,
+}
+
+# Weight of the newest sample in the slot hold-time average (used for Retry-After)
+HOLD_TIME_ALPHA = 0.2
+
+# Recent queue waits kept for the dashboard
+WAIT_SAMPLES = 200
+
+# Number of worker processes sharing the backends, set by gunicorn_conf.py
+WORKERS_ENV = "OLLAMA_PROXY_WORKERS"
+
+
+def worker_count() -> int:
+    try:
+        return max(1, int(os.environ.get(WORKERS_ENV, "1")))
+    except ValueError:
+        return 1
+
+
+class AdmissionRejected(Exception):
+    """The request waited longer than the maximum queue time."""
+
+    def __init__(self, waited_seconds: float, retry_after_seconds: int):
+        super().__init__(f"Request was queued for {waited_seconds:.1f}s without getting a backend slot")
+        self.waited_seconds = waited_seconds
+        self.retry_after_seconds = retry_after_seconds
+
+
+class _Waiter:
+    __slots__ = ("key_id", "priority_class", "server_ids", "finish", "enqueued_at", "future")
+
+    def __init__(self, key_id: int, priority_class: str, server_ids: List[int], finish: float):
+        self.key_id = key_id
+        self.priority_class = priority_class
+        self.server_ids = server_ids
+        self.finish = finish
+        self.enqueued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class AdmissionTicket:
+    """A slot on one backend, released exactly once. Can move to another server on failover."""
+
+    def __init__(self, controller: "AdmissionController", server_id: int, waited_seconds: float):
+        self._controller = controller
+        self.server_id = server_id
+        self.waited_seconds = waited_seconds
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def move_to(self, server_id: int) -> None:
+        """Moves the slot to the server actually being tried; the request already waited its turn."""
+        if self._released or server_id == self.server_id:
+            return
+        self._controller._move(self.server_id, server_id)
+        self.server_id = server_id
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(self.server_id, time.monotonic() - self.admitted_at)
+
+
+class AdmissionController:
+    """Per-backend concurrency slots with a weighted fair queue in front of them."""
+
+    def __init__(self, slots_per_server: int = 4, max_queue_seconds: float = 30.0, workers: int = 1):
+        # Slots per server across all workers; this worker gets `worker_slots` of them
+        self.slots_per_server = slots_per_server
+        self.max_queue_seconds = max_queue_seconds
+        self.workers = workers
+        self._active: Dict[int, int] = {}
+        self._queue: List[Tuple[float, int, _Waiter]] = []
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish: Dict[int, float] = {}
+        self._avg_hold_seconds: Optional[float] = None
+        self._recent_waits: Deque[Tuple[str, float]] = deque(maxlen=WAIT_SAMPLES)
+        self.admitted = 0
+        self.shed = 0
+
+    def configure(self, slots_per_server: int, max_queue_seconds: float) -> None:
+        self.slots_per_server = slots_per_server
+        self.max_queue_seconds = max_queue_seconds
+        self._dispatch()
+
+    @property
+    def worker_slots(self) -> int:
+        return max(1, self.slots_per_server // self.workers)
+
+    # --- Queueing ---
+
+    async def admit(self, servers: List[BackendServer], key_id: int, priority_class: Optional[str]) -> AdmissionTicket:
+        """
+        Waits for a free slot on one of `servers` (tried in the given order) and
+        returns a ticket for it. Raises AdmissionRejected after the maximum queue time.
+        """
+        if priority_class not in PRIORITY_WEIGHTS:
+            priority_class = PRIORITY_INTERACTIVE
+
+        start = max(self._virtual_time, self._last_finish.get(key_id, 0.0))
+        finish = start + 1.0 / PRIORITY_WEIGHTS[priority_class]
+        self._last_finish[key_id] = finish
+        waiter = _Waiter(key_id, priority_class, [s.id for s in servers], finish)
+        insort(self._queue, (finish, next(self._sequence), waiter))
+        self._dispatch()
+
+        try:
+            server_id = await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_queue_seconds)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                server_id = waiter.future.result()
+            else:
+                self._remove(waiter)
+                waited = time.monotonic() - waiter.enqueued_at
+                self.shed += 1
+                retry_after = self.retry_after_seconds()
+                logger.warning(
+                    f"Shedding request from API key {key_id} ({priority_class}) after {waited:.1f}s in the admission queue"
+                )
+                raise AdmissionRejected(waited, retry_after)
+        except asyncio.CancelledError:
+            # Client went away while queued; give back a slot that was already granted
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(waiter.future.result(), None)
+            else:
+                self._remove(waiter)
+            raise
+
+        waited = time.monotonic() - waiter.enqueued_at
+        self._recent_waits.append((priority_class, waited))
+        self.admitted += 1
+        return AdmissionTicket(self, server_id, waited)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+        if not waiter.future.done():
+            waiter.future.cancel()
+
+    def _has_room(self, server_id: int) -> bool:
+        return self._active.get(server_id, 0) < self.worker_slots
+
+    def _dispatch(self) -> None:
+        """Grants free slots to waiters in finish-time order, skipping those whose servers are all busy."""
+        if not self._queue:
+            return
+        remaining = []
+        for entry in self._queue:
+            waiter = entry[2]
+            if waiter.future.done():
+                continue
+            server_id = next((sid for sid in waiter.server_ids if self._has_room(sid)), None)
+            if server_id is None:
+                remaining.append(entry)
+                continue
+            self._active[server_id] = self._active.get(server_id, 0) + 1
+            self._virtual_time = max(self._virtual_time, waiter.finish - 1.0 / PRIORITY_WEIGHTS[waiter.priority_class])
+            waiter.future.set_result(server_id)
+        self._queue = remaining
+
+        # Keys that are no longer behind the virtual clock need no bookkeeping
+        if len(self._last_finish) > len(self._queue):
+            self._last_finish = {
+                key_id: finish for key_id, finish in self._last_finish.items() if finish > self._virtual_time
+            }
+
+    # --- Slots ---
+
+    def _decrement(self, server_id: int) -> None:
+        remaining = self._active.get(server_id, 0) - 1
+        if remaining > 0:
+            self._active[server_id] = remaining
+        else:
+            self._active.pop(server_id, None)
+
+    def _move(self, from_server_id: int, to_server_id: int) -> None:
+        self._decrement(from_server_id)
+        self._active[to_server_id] = self._active.get(to_server_id, 0) + 1
+        self._dispatch()
+
+    def _release(self, server_id: int, held_seconds: Optional[float]) -> None:
+        self._decrement(server_id)
+        if held_seconds is not None:
+            if self._avg_hold_seconds is None:
+                self._avg_hold_seconds = held_seconds
+            else:
+                self._avg_hold_seconds = HOLD_TIME_ALPHA * held_seconds + (1 - HOLD_TIME_ALPHA) * self._avg_hold_seconds
+        self._dispatch()
+
+    def retry_after_seconds(self) -> int:
+        """Rough time until the queue has moved on: one average slot hold time."""
+        return max(1, round(self._avg_hold_seconds or 1.0))
+
+    # --- Dashboard ---
+
+    def stats(self, server_ids: List[int]) -> Dict[str, Any]:
+        now = time.monotonic()
+        queued: Dict[str, int] = {name: 0 for name in PRIORITY_CLASSES}
+        oldest: Dict[str, float] = {name: 0.0 for name in PRIORITY_CLASSES}
+        per_key: Dict[int, int] = {}
+        for _, _, waiter in self._queue:
+            queued[waiter.priority_class] += 1
+            oldest[waiter.priority_class] = max(oldest[waiter.priority_class], now - waiter.enqueued_at)
+            per_key[waiter.key_id] = per_key.get(waiter.key_id, 0) + 1
+
+        waits: Dict[str, List[float]] = {name: [] for name in PRIORITY_CLASSES}
+        for priority_class, waited in self._recent_waits:
+            waits[priority_class].append(waited)
+
+        return {
+            "slots_per_server": self.slots_per_server,
+            "workers": self.workers,
+            "worker_slots": self.worker_slots,
+            "max_queue_seconds": self.max_queue_seconds,
+            "servers": {
+                server_id: {"active": self._active.get(server_id, 0), "slots": self.worker_slots}
+                for server_id in server_ids
+            },
+            "classes": {
+                name: {
+                    "queued": queued[name],
+                    "oldest_wait_ms": round(oldest[name] * 1000),
+                    "avg_wait_ms": round(sum(waits[name]) / len(waits[name]) * 1000) if waits[name] else 0,
+                    "max_wait_ms": round(max(waits[name]) * 1000) if waits[name] else 0,
+                }
+                for name in PRIORITY_CLASSES
+            },
+            "queued_by_key": per_key,
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
@@ -0,0 +1,106 @@
+"""
+Conversation affinity for chat requests.
+
+Ollama reuses its KV cache when a request starts with the same prompt it
+evaluated last, so the turns of one conversation should keep landing on the
+same backend. A conversation is identified by a client-supplied session
+header or, failing that, by the model plus the messages up to and including
+the first user message (these never change as the chat grows). The key is
+mapped to a backend with consistent hashing with bounded loads: walk the
+ring from the key's position and take the first server that is below
+`load_factor` times the average load, so a hot conversation cannot overload
+its server and adding or removing a server only moves a few conversations.
+"""
+
+import hashlib
+import json
+import math
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+from app.core.json_scan import JsonMember, array_elements, member_value, object_members
+from app.core.routing_table import BackendServer
+
+SESSION_HEADER = "x-session-id"
+VIRTUAL_NODES_PER_SERVER = 100
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def affinity_key(headers, model_name: Optional[str], body: bytes, members: Dict[str, JsonMember]) -> Optional[str]:
+    """
+    Returns a stable conversation key for this request, or None if it has none.
+    `members` are the body's top-level members; message contents and images
+    are hashed as raw bytes, without decoding them.
+    """
+    session_id = headers.get(SESSION_HEADER)
+    if session_id:
+        return f"session:{session_id}"
+
+    if not model_name or "messages" not in members:
+        return None
+
+    digest = hashlib.blake2b(model_name.encode("utf-8"), digest_size=16)
+    view = memoryview(body)
+    try:
+        messages = array_elements(body, members["messages"].value_start)
+        if not messages:
+            return None
+        for start, _ in messages:
+            message = object_members(body, start)
+            role = member_value(body, message["role"]) if "role" in message else None
+            digest.update(json.dumps(role).encode("utf-8"))
+            for field in ("content", "images"):
+                digest.update(b"\x00")
+                if field in message:
+                    digest.update(view[message[field].value_start:message[field].value_end])
+            if role == "user":
+                break
+    except ValueError:
+        return None
+    return "chat:" + digest.hexdigest()
+
+
+class ConsistentHashRing:
+    """Hash ring with virtual nodes over a fixed set of servers."""
+
+    def __init__(self, servers: List[BackendServer], virtual_nodes: int = VIRTUAL_NODES_PER_SERVER):
+        points: List[Tuple[int, BackendServer]] = []
+        for server in servers:
+            for replica in range(virtual_nodes):
+                points.append((_hash(f"{server.id}:{replica}"), server))
+        points.sort(key=lambda point: point[0])
+        self._hashes = [h for h, _ in points]
+        self._servers = [s for _, s in points]
+        self._server_count = len(servers)
+
+    def walk(self, key: str) -> List[BackendServer]:
+        """All servers in ring order starting at the key's position, without duplicates."""
+        if not self._hashes:
+            return []
+        start = bisect_left(self._hashes, _hash(key)) % len(self._hashes)
+        ordered: List[BackendServer] = []
+        seen = set()
+        for offset in range(len(self._servers)):
+            server = self._servers[(start + offset) % len(self._servers)]
+            if server.id not in seen:
+                seen.add(server.id)
+                ordered.append(server)
+                if len(ordered) == self._server_count:
+                    break
+        return ordered
+
+    def order(self, key: str, in_flight: Dict[int, int], load_factor: float) -> List[BackendServer]:
+        """
+        Ring order for the key, with servers at or above the bounded-load
+        capacity moved behind the ones that still have room.
+        """
+        walk = self.walk(key)
+        if len(walk) <= 1:
+            return walk
+        total_load = sum(in_flight.get(s.id, 0) for s in walk) + 1
+        capacity = math.ceil(load_factor * total_load / len(walk))
+        with_room = [s for s in walk if in_flight.get(s.id, 0) < capacity]
+        return with_room + [s for s in walk if s not in with_room]
@@ -0,0 +1,93 @@
+"""
+In-process cache of verified API keys.
+
+Verifying an API key secret is a bcrypt check (~100ms of CPU). Once a
+prefix/secret pair has been verified, subsequent requests presenting the same
+pair are answered from this cache until the entry expires or the key is
+revoked/disabled. Entries are keyed by the key prefix plus an HMAC of the
+secret, so plain secrets are never held in memory.
+
+Invalidations are broadcast through the invalidation bus so every gunicorn
+worker drops the key immediately. Without Redis, other workers fall back to
+the TTL.
+"""
+
+import hashlib
+import hmac
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.core.invalidation_bus import invalidation_bus
+from app.database.models import APIKey
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "api_keys"
+
+
+class APIKeyCache:
+    """TTL cache of API keys whose secret has already been verified."""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._digest_key = settings.SECRET_KEY.encode()
+        self._entries: Dict[Tuple[str, bytes], Tuple[float, APIKey]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_key(self, prefix: str, secret: str) -> Tuple[str, bytes]:
+        digest = hmac.new(self._digest_key, secret.encode(), hashlib.sha256).digest()
+        return prefix, digest
+
+    def get(self, prefix: str, secret: str) -> Optional[APIKey]:
+        """Returns the cached key for this prefix/secret pair, or None on a miss."""
+        cache_key = self._cache_key(prefix, secret)
+        entry = self._entries.get(cache_key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, api_key = entry
+        if expires_at <= time.monotonic():
+            self._entries.pop(cache_key, None)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return api_key
+
+    def put(self, prefix: str, secret: str, api_key: APIKey, ttl_seconds: float) -> None:
+        """Caches a verified key. The APIKey must be detached from its session."""
+        if ttl_seconds <= 0:
+            return
+
+        if len(self._entries) >= self.max_entries:
+            now = time.monotonic()
+            for key in [k for k, (exp, _) in self._entries.items() if exp <= now]:
+                del self._entries[key]
+            if len(self._entries) >= self.max_entries:
+                # Still full: drop the oldest entry (dicts keep insertion order)
+                self._entries.pop(next(iter(self._entries)))
+
+        self._entries[self._cache_key(prefix, secret)] = (time.monotonic() + ttl_seconds, api_key)
+
+    def invalidate_local(self, prefix: str) -> None:
+        """Drops every cached entry for a key prefix in this process only."""
+        for key in [k for k in self._entries if k[0] == prefix]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    async def invalidate(self, prefix: str) -> None:
+        """Drops a key prefix in this process and broadcasts it to the other workers."""
+        await invalidation_bus.publish(INVALIDATION_CHANNEL, prefix)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+api_key_cache = APIKeyCache()
+invalidation_bus.register(INVALIDATION_CHANNEL, api_key_cache.invalidate_local, on_reset=api_key_cache.clear)
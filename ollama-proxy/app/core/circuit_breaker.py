@@ -0,0 +1,164 @@
+"""
+Per-backend circuit breakers.
+
+A breaker starts closed. It opens after `failure_threshold` consecutive
+failures, or when at least `min_requests` requests in the last
+`WINDOW_SECONDS` have an error rate of `error_rate_threshold` or more. While
+open, the server is skipped without being contacted. After `open_seconds`
+the breaker goes half-open and lets a single trial request through (with no
+retries): success closes it, failure opens it again.
+"""
+
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.core import metrics
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+WINDOW_SECONDS = 60.0
+
+# Value of each state in the circuit state gauge
+STATE_METRIC_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+
+@dataclass
+class CircuitBreakerConfig:
+    """Thresholds shared by every breaker."""
+    failure_threshold: int = 5
+    error_rate_threshold: float = 0.5
+    min_requests: int = 10
+    open_seconds: float = 30.0
+
+    @classmethod
+    def from_settings(cls, app_settings) -> "CircuitBreakerConfig":
+        return cls(
+            failure_threshold=app_settings.circuit_breaker_failure_threshold,
+            error_rate_threshold=app_settings.circuit_breaker_error_rate,
+            open_seconds=app_settings.circuit_breaker_open_seconds,
+        )
+
+
+class CircuitBreaker:
+    """Closed / open / half-open state machine for one backend server."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_started_at: Optional[float] = None
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._set_state(STATE_CLOSED)
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        metrics.CIRCUIT_STATE.labels(self.name).set(STATE_METRIC_VALUES[state])
+
+    def _prune(self, now: float) -> None:
+        while self._outcomes and self._outcomes[0][0] < now - WINDOW_SECONDS:
+            self._outcomes.popleft()
+
+    def error_rate(self) -> float:
+        self._prune(time.monotonic())
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for _, ok in self._outcomes if not ok) / len(self._outcomes)
+
+    def allow_request(self, config: CircuitBreakerConfig) -> Optional[str]:
+        """
+        Returns the state the request runs under (closed or half_open), or None
+        if the server must be skipped. In half-open only one trial is let through;
+        a trial that never reports back is replaced after `open_seconds`.
+        """
+        now = time.monotonic()
+        if self.state == STATE_CLOSED:
+            return STATE_CLOSED
+        if self.state == STATE_OPEN:
+            if now - self.opened_at < config.open_seconds:
+                return None
+            self._set_state(STATE_HALF_OPEN)
+            logger.info(f"Circuit for '{self.name}' is half-open, sending a trial request")
+        if self._probe_started_at is not None and now - self._probe_started_at < config.open_seconds:
+            return None
+        self._probe_started_at = now
+        return STATE_HALF_OPEN
+
+    def record_success(self) -> None:
+        self._outcomes.append((time.monotonic(), True))
+        self.consecutive_failures = 0
+        if self.state != STATE_CLOSED:
+            logger.info(f"Circuit for '{self.name}' closed after a successful trial request")
+            self._set_state(STATE_CLOSED)
+            self._probe_started_at = None
+            self._outcomes.clear()
+
+    def record_failure(self, config: CircuitBreakerConfig) -> None:
+        now = time.monotonic()
+        self._outcomes.append((now, False))
+        self._prune(now)
+        self.consecutive_failures += 1
+
+        if self.state == STATE_HALF_OPEN:
+            self._open(now, "trial request failed")
+            return
+        if self.state == STATE_OPEN:
+            return
+
+        if self.consecutive_failures >= config.failure_threshold:
+            self._open(now, f"{self.consecutive_failures} consecutive failures")
+        elif len(self._outcomes) >= config.min_requests and self.error_rate() >= config.error_rate_threshold:
+            self._open(now, f"error rate {self.error_rate():.0%} over the last {len(self._outcomes)} requests")
+
+    def _open(self, now: float, reason: str) -> None:
+        self._set_state(STATE_OPEN)
+        self.opened_at = now
+        self.times_opened += 1
+        metrics.CIRCUIT_OPENED.labels(self.name).inc()
+        self._probe_started_at = None
+        logger.warning(f"Circuit for '{self.name}' opened: {reason}")
+
+    def stats(self, config: CircuitBreakerConfig) -> Dict[str, Any]:
+        retry_in = None
+        if self.state == STATE_OPEN:
+            retry_in = max(0.0, round(config.open_seconds - (time.monotonic() - self.opened_at), 1))
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "error_rate": round(self.error_rate(), 3),
+            "times_opened": self.times_opened,
+            "retry_in_seconds": retry_in,
+        }
+
+
+class CircuitBreakerRegistry:
+    """Holds one breaker per backend server id."""
+
+    def __init__(self, config: Optional[CircuitBreakerConfig] = None):
+        self.config = config or CircuitBreakerConfig()
+        self._breakers: Dict[int, CircuitBreaker] = {}
+
+    def get(self, server_id: int, name: str = "") -> CircuitBreaker:
+        breaker = self._breakers.get(server_id)
+        if breaker is None:
+            breaker = self._breakers[server_id] = CircuitBreaker(name or str(server_id))
+        return breaker
+
+    def allow_request(self, server_id: int, name: str = "") -> Optional[str]:
+        return self.get(server_id, name).allow_request(self.config)
+
+    def record_success(self, server_id: int) -> None:
+        self.get(server_id).record_success()
+
+    def record_failure(self, server_id: int) -> None:
+        self.get(server_id).record_failure(self.config)
+
+    def stats(self, server_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        return {server_id: self.get(server_id).stats(self.config) for server_id in server_ids}
@@ -0,0 +1,260 @@
+"""
+One HTTP connection pool per backend server.
+
+With a single client shared by every backend, a few servers holding many
+long-lived streams could use up the whole pool, and requests to every other
+server then waited for a connection. Each backend now gets its own
+`httpx.AsyncClient` with the limits from the settings, created on first use
+and replaced when the server's URL or the limits change (the old client is
+closed once its streams have had time to finish). vLLM servers can use
+HTTP/2, which multiplexes requests over a few connections when the server
+offers it over TLS; plain-HTTP servers keep using HTTP/1.1.
+
+Time spent waiting for a free connection is measured through httpcore's
+trace hook: the pool itself emits no trace events, so the first event of a
+request (connecting, or sending headers on a reused connection) is the
+moment it got a connection.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from app.core import metrics
+
+logger = logging.getLogger(__name__)
+
+# A replaced client is closed after this long, so streams on it can finish
+RETIRED_CLIENT_GRACE_SECONDS = 600.0
+
+# Requests are reported as having waited for a connection from this long on
+SLOW_WAIT_SECONDS = 0.05
+
+
+class PoolStats:
+    """Connection wait times of one backend's pool."""
+    __slots__ = ("requests", "waiting", "slow_waits", "total_wait", "max_wait")
+
+    def __init__(self):
+        self.requests = 0
+        self.waiting = 0
+        self.slow_waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def observe(self, waited: float) -> None:
+        self.requests += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited >= SLOW_WAIT_SECONDS:
+            self.slow_waits += 1
+
+
+class _MeasuredTransport(httpx.AsyncHTTPTransport):
+    """Records how long each request waited for a connection from the pool."""
+
+    def __init__(self, server_name: str, stats: PoolStats, **kwargs):
+        super().__init__(**kwargs)
+        self._server_name = server_name
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self._stats
+        started = time.perf_counter()
+        pending = True
+        stats.waiting += 1
+        inner_trace = request.extensions.get("trace")
+
+        def connection_acquired() -> None:
+            nonlocal pending
+            if pending:
+                pending = False
+                stats.waiting -= 1
+                waited = time.perf_counter() - started
+                stats.observe(waited)
+                metrics.POOL_WAIT.labels(self._server_name).observe(waited)
+
+        async def trace(event_name: str, info: dict) -> None:
+            connection_acquired()
+            if inner_trace is not None:
+                result = inner_trace(event_name, info)
+                if hasattr(result, "__await__"):
+                    await result
+
+        request.extensions = {**request.extensions, "trace": trace}
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            if pending:
+                # Failed (e.g. pool timeout) before getting a connection
+                pending = False
+                stats.waiting -= 1
+
+    def connection_counts(self) -> Tuple[int, int]:
+        """(open, in use) connections of the pool."""
+        connections = list(self._pool.connections)
+        busy = sum(1 for connection in connections if not connection.is_idle() and not connection.is_closed())
+        return len([c for c in connections if not c.is_closed()]), busy
+
+
+class _BackendPool:
+    __slots__ = ("client", "transport", "stats", "signature")
+
+    def __init__(self, client: httpx.AsyncClient, transport: _MeasuredTransport, stats: PoolStats, signature: tuple):
+        self.client = client
+        self.transport = transport
+        self.stats = stats
+        self.signature = signature
+
+
+class BackendPools:
+    """The HTTP clients of the backend servers, one pool each."""
+
+    def __init__(
+        self,
+        max_connections: int = 64,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry_seconds: float = 60.0,
+        pool_timeout_seconds: float = 60.0,
+        vllm_http2: bool = False,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry_seconds = keepalive_expiry_seconds
+        self.pool_timeout_seconds = pool_timeout_seconds
+        self.vllm_http2 = vllm_http2
+        self._pools: Dict[int, _BackendPool] = {}
+        self._names: Dict[int, str] = {}
+        self._retiring: List[asyncio.Task] = []
+        self._http2_available: Optional[bool] = None
+
+    def configure(
+        self,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry_seconds: float,
+        pool_timeout_seconds: float,
+        vllm_http2: bool,
+    ) -> None:
+        """New limits apply to each pool from its next request on."""
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry_seconds = keepalive_expiry_seconds
+        self.pool_timeout_seconds = pool_timeout_seconds
+        self.vllm_http2 = vllm_http2
+
+    def _use_http2(self, server_type: str) -> bool:
+        if not (self.vllm_http2 and server_type == "vllm"):
+            return False
+        if self._http2_available is None:
+            try:
+                import h2  # noqa: F401
+                self._http2_available = True
+            except ImportError:
+                logger.warning("HTTP/2 for vLLM servers is enabled but the 'h2' package is not installed. Using HTTP/1.1.")
+                self._http2_available = False
+        return self._http2_available
+
+    def client_for(self, server) -> httpx.AsyncClient:
+        """The client of a backend server (a `BackendServer` or an `OllamaServer` row)."""
+        url = server.url.rstrip("/")
+        http2 = self._use_http2(server.server_type)
+        signature = (
+            url, http2, self.max_connections, self.max_keepalive_connections,
+            self.keepalive_expiry_seconds, self.pool_timeout_seconds,
+        )
+        pool = self._pools.get(server.id)
+        if pool is not None and pool.signature == signature:
+            return pool.client
+
+        stats = pool.stats if pool is not None else PoolStats()
+        if pool is not None:
+            self._retire(pool.client)
+        transport = _MeasuredTransport(
+            server.name,
+            stats,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry_seconds,
+            ),
+            http2=http2,
+        )
+        client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(10.0, read=600.0, write=600.0, pool=self.pool_timeout_seconds),
+        )
+        self._pools[server.id] = _BackendPool(client, transport, stats, signature)
+        self._names[server.id] = server.name
+        return client
+
+    def _retire(self, client: httpx.AsyncClient) -> None:
+        async def close_later():
+            try:
+                await asyncio.sleep(RETIRED_CLIENT_GRACE_SECONDS)
+            finally:
+                await client.aclose()
+
+        task = asyncio.create_task(close_later())
+        self._retiring.append(task)
+        task.add_done_callback(self._retiring.remove)
+
+    def forget(self, active_server_ids) -> None:
+        """Retires the pools of servers that were removed or deactivated."""
+        for server_id in [sid for sid in self._pools if sid not in active_server_ids]:
+            self._retire(self._pools.pop(server_id).client)
+            self._names.pop(server_id, None)
+
+    async def prewarm(self, servers, connections: int) -> None:
+        """Opens up to `connections` keep-alive connections to each server."""
+        if connections <= 0:
+            return
+
+        async def ping(server) -> bool:
+            client = self.client_for(server)
+            path = "/health" if server.server_type == "vllm" else "/"
+            try:
+                await client.get(f"{server.url.rstrip('/')}{path}", headers=server.auth_headers, timeout=5.0)
+                return True
+            except httpx.HTTPError:
+                return False
+
+        count = min(connections, self.max_keepalive_connections)
+        results = await asyncio.gather(*(ping(server) for server in servers for _ in range(count)))
+        logger.info(f"Pre-warmed {sum(results)} connection(s) to {len(servers)} backend server(s)")
+
+    def stats(self) -> List[dict]:
+        result = []
+        for server_id, pool in self._pools.items():
+            open_connections, busy = pool.transport.connection_counts()
+            stats = pool.stats
+            result.append({
+                "server_id": server_id,
+                "name": self._names.get(server_id, str(server_id)),
+                "http2": pool.signature[1],
+                "max_connections": self.max_connections,
+                "open": open_connections,
+                "in_use": busy,
+                "utilization": round(busy / self.max_connections, 3) if self.max_connections else 0.0,
+                "waiting": stats.waiting,
+                "requests": stats.requests,
+                "slow_waits": stats.slow_waits,
+                "avg_wait_ms": round(stats.total_wait / stats.requests * 1000, 2) if stats.requests else 0.0,
+                "max_wait_ms": round(stats.max_wait * 1000, 2),
+            })
+        return result
+
+    async def aclose(self) -> None:
+        retiring = list(self._retiring)
+        for task in retiring:
+            task.cancel()
+        await asyncio.gather(*retiring, return_exceptions=True)
+        clients = [pool.client for pool in self._pools.values()]
+        self._pools.clear()
+        await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+
+
+backend_pools = BackendPools()
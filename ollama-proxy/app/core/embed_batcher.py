@@ -0,0 +1,136 @@
+"""
+Micro-batching of single-text embedding requests.
+
+Clients that send one text per request make the backend run one forward
+pass per text. With batching on, concurrent requests for the same model
+(and the same endpoint and options) are held for at most `max_wait_ms`, or
+until `max_batch_size` of them have arrived, then sent upstream as one
+/api/embed call whose results are handed back to each waiting request in
+the shape of the endpoint it called.
+
+/api/embed returns L2-normalized vectors and /api/embeddings does not, so
+batching /api/embeddings callers changes the vectors they get; the proxy
+only does so when the administrator opts in to that separately.
+
+The batch is sent with the routing of the request that opened it, in a task
+of its own, so a caller going away does not cancel the batch for the others.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple
+
+import orjson
+
+from app.core import metrics
+from app.core.routing_table import BackendServer
+
+logger = logging.getLogger(__name__)
+
+# Sends the prompts as one /api/embed request: (status code, body, server)
+BatchSender = Callable[[List[str]], Awaitable[Tuple[int, bytes, BackendServer]]]
+
+# What each caller gets back: (status code, JSON body, server)
+BatchResult = Tuple[int, bytes, BackendServer]
+
+
+class _Batch:
+    __slots__ = ("endpoint", "send", "prompts", "futures", "enqueued_at", "timer")
+
+    def __init__(self, endpoint: str, send: BatchSender):
+        self.endpoint = endpoint
+        self.send = send
+        self.prompts: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.enqueued_at: List[float] = []
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent single-prompt embedding requests per batch key."""
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: int = 5):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._pending: Dict[Any, _Batch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def configure(self, max_batch_size: int, max_wait_ms: int) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+    async def embed(self, key: Any, endpoint: str, prompt: str, send: BatchSender) -> BatchResult:
+        """
+        Adds the prompt of an `endpoint` ("embed" or "embeddings") request to
+        the open batch for `key` (opening one that will be sent with `send` if
+        there is none) and waits for its result. The key must tell endpoints apart.
+        """
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _Batch(endpoint, send)
+            batch.timer = loop.call_later(self.max_wait_ms / 1000, self._flush, key, batch)
+
+        future = loop.create_future()
+        batch.prompts.append(prompt)
+        batch.futures.append(future)
+        batch.enqueued_at.append(time.perf_counter())
+        if len(batch.prompts) >= self.max_batch_size:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key: Any, batch: _Batch) -> None:
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: _Batch) -> None:
+        sent_at = time.perf_counter()
+        metrics.EMBED_BATCH_SIZE.observe(len(batch.prompts))
+        for enqueued_at in batch.enqueued_at:
+            metrics.EMBED_BATCH_WAIT.observe(sent_at - enqueued_at)
+
+        try:
+            status_code, body, server = await batch.send(batch.prompts)
+            results = self._split(batch.endpoint, status_code, body, server, len(batch.prompts))
+        except BaseException as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        for future, result in zip(batch.futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _split(endpoint: str, status_code: int, body: bytes, server: BackendServer, count: int) -> List[BatchResult]:
+        """One response per prompt, shaped like the endpoint's; errors are passed on to every caller."""
+        if status_code != 200:
+            return [(status_code, body, server)] * count
+        response = orjson.loads(body)
+        embeddings = response.get("embeddings") or []
+        if len(embeddings) != count:
+            logger.error(f"Batched embedding call on '{server.name}' returned {len(embeddings)} vectors for {count} prompts")
+            error = orjson.dumps({"error": "Backend returned an incomplete embedding batch"})
+            return [(502, error, server)] * count
+        if endpoint == "embeddings":
+            return [(200, orjson.dumps({"embedding": embedding}), server) for embedding in embeddings]
+
+        # The batch's prompt tokens are shared out so that the callers' counts add up to it
+        prompt_tokens = response.get("prompt_eval_count")
+        results = []
+        for i, embedding in enumerate(embeddings):
+            single = {"model": response.get("model"), "embeddings": [embedding], "total_duration": response.get("total_duration")}
+            if isinstance(prompt_tokens, int):
+                single["prompt_eval_count"] = prompt_tokens // count + (1 if i < prompt_tokens % count else 0)
+            results.append((200, orjson.dumps(single), server))
+        return results
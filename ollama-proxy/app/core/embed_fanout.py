@@ -0,0 +1,55 @@
+"""
+Splitting large /api/embed batches across backends.
+
+A request with more `input` texts than the chunk size is cut into several
+/api/embed requests of at most that many texts. The chunks are built by
+splicing the raw bytes of the input array into the original body, so every
+other field (options, truncate, keep_alive, dimensions) is sent unchanged
+and the texts are never decoded. The chunk responses are merged back into
+one response with the embeddings in input order.
+"""
+
+from typing import Dict, List, Optional
+
+import orjson
+
+from app.core.json_scan import JsonMember, array_elements
+
+
+def split_embed_body(body: bytes, members: Dict[str, JsonMember], chunk_size: int) -> Optional[List[bytes]]:
+    """
+    Request bodies for consecutive chunks of the `input` array, or None when
+    the input is a single string or small enough to send as is.
+    """
+    if chunk_size <= 0 or "input" not in members:
+        return None
+    member = members["input"]
+    try:
+        elements = array_elements(body, member.value_start)
+    except ValueError:
+        return None
+    if len(elements) <= chunk_size:
+        return None
+
+    head, tail = body[:member.value_start], body[member.value_end:]
+    return [
+        head + b"[" + b",".join(body[start:end] for start, end in elements[i:i + chunk_size]) + b"]" + tail
+        for i in range(0, len(elements), chunk_size)
+    ]
+
+
+def merge_embed_responses(bodies: List[bytes], total_duration_ns: int) -> bytes:
+    """One /api/embed response from the chunk responses, given in chunk order."""
+    parts = [orjson.loads(body) for body in bodies]
+    merged = {
+        "model": parts[0].get("model"),
+        "embeddings": [embedding for part in parts for embedding in part.get("embeddings") or []],
+        "total_duration": total_duration_ns,
+    }
+    load_durations = [part["load_duration"] for part in parts if part.get("load_duration") is not None]
+    if load_durations:
+        merged["load_duration"] = max(load_durations)
+    prompt_counts = [part["prompt_eval_count"] for part in parts if part.get("prompt_eval_count") is not None]
+    if prompt_counts:
+        merged["prompt_eval_count"] = sum(prompt_counts)
+    return orjson.dumps(merged)
@@ -0,0 +1,221 @@
+"""
+Content-addressed cache of embeddings.
+
+An embedding depends only on the model weights, the endpoint (/api/embed
+normalizes its vectors, /api/embeddings does not), the request options and
+the text. The cache key is a hash of exactly those: the model digest from
+the routing table, the raw bytes of the fields that shape the output, and
+the raw bytes of each text. Texts are hashed as the client encoded them and
+never decoded; the same text sent with different JSON escaping is a miss,
+never a wrong answer.
+
+Vectors are kept as float64 bytes (8 bytes per dimension), the precision
+the JSON responses are parsed at, so a hit returns exactly the numbers a
+miss would have. They live in a bounded in-process LRU and, optionally, in
+Redis with a TTL so that every worker, and a restarted one, can use them. A
+request whose texts are partly cached is sent upstream with only the
+missing texts, and the response is put back together in input order.
+
+Only models with a real content digest are cached; vLLM servers report
+none (see `RoutingSnapshot.model_digest`).
+"""
+
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import orjson
+
+from app.core import metrics
+from app.core.json_scan import JsonMember, array_elements
+
+logger = logging.getLogger(__name__)
+
+# Versioned by the vector encoding, so entries stored as float32 are not misread
+KEY_PREFIX = "embedding_cache:f64:"
+REDIS_RETRY_SECONDS = 30.0
+
+# Fields that do not change the vectors and so are left out of the key
+UNKEYED_FIELDS = frozenset({"model", "input", "prompt", "keep_alive"})
+
+
+class EmbeddingLookup:
+    """The cache keys of one request's texts, the vectors found for them, and the body asking for the rest."""
+    __slots__ = ("endpoint", "keys", "vectors", "miss_body")
+
+    def __init__(self, endpoint: str, keys: List[str], vectors: List[Optional[np.ndarray]], miss_body: Optional[bytes]):
+        self.endpoint = endpoint
+        self.keys = keys
+        self.vectors = vectors
+        # None when every text was cached
+        self.miss_body = miss_body
+
+    @property
+    def missing(self) -> List[int]:
+        return [i for i, vector in enumerate(self.vectors) if vector is None]
+
+    def cached_response(self, model_name: str, total_duration_ns: int) -> bytes:
+        """The response for a request answered entirely from the cache."""
+        if self.endpoint == "embeddings":
+            return orjson.dumps({"embedding": self.vectors[0]}, option=orjson.OPT_SERIALIZE_NUMPY)
+        return orjson.dumps(
+            {
+                "model": model_name,
+                "embeddings": self.vectors,
+                "total_duration": total_duration_ns,
+                "load_duration": 0,
+                "prompt_eval_count": 0,
+            },
+            option=orjson.OPT_SERIALIZE_NUMPY,
+        )
+
+
+def _text_spans(endpoint: str, body: bytes, members: Dict[str, JsonMember]) -> Optional[List[Tuple[int, int]]]:
+    """Byte spans of the texts to embed, or None when the request has none the cache can key."""
+    member = members.get("prompt" if endpoint == "embeddings" else "input")
+    if member is None:
+        return None
+    if body[member.value_start:member.value_start + 1] != b"[":
+        return [(member.value_start, member.value_end)]
+    try:
+        spans = array_elements(body, member.value_start)
+    except ValueError:
+        return None
+    return spans or None
+
+
+def _miss_body(body: bytes, members: Dict[str, JsonMember], spans: List[Tuple[int, int]], missing: List[int]) -> bytes:
+    """The request body asking only for the texts at the `missing` positions."""
+    if len(missing) == len(spans):
+        return body
+    member = members["input"]
+    texts = b",".join(body[spans[i][0]:spans[i][1]] for i in missing)
+    return body[:member.value_start] + b"[" + texts + b"]" + body[member.value_end:]
+
+
+class EmbeddingCache:
+    """Embeddings by content hash: a local LRU in front of an optional shared Redis tier."""
+
+    def __init__(self, redis_client=None, max_entries: int = 10000, redis_enabled: bool = False, redis_ttl_seconds: int = 604800):
+        # Expects a client that returns bytes (decode_responses=False)
+        self.redis_client = redis_client
+        self.max_entries = max_entries
+        self.redis_enabled = redis_enabled
+        self.redis_ttl_seconds = redis_ttl_seconds
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._redis_retry_at = 0.0
+
+    def configure(self, max_entries: int, redis_enabled: bool, redis_ttl_seconds: int) -> None:
+        self.max_entries = max_entries
+        self.redis_enabled = redis_enabled
+        self.redis_ttl_seconds = redis_ttl_seconds
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @property
+    def _use_redis(self) -> bool:
+        return self.redis_client is not None and self.redis_enabled and time.monotonic() >= self._redis_retry_at
+
+    def _redis_failed(self, error: Exception) -> None:
+        if time.monotonic() >= self._redis_retry_at:
+            logger.warning(f"Redis embedding cache failed: {error}. Using the local cache only for {REDIS_RETRY_SECONDS:.0f}s.")
+        self._redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
+
+    def _remember(self, key: str, blob: bytes) -> None:
+        self._entries[key] = blob
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def lookup(self, digest: str, endpoint: str, body: bytes, members: Dict[str, JsonMember]) -> Optional[EmbeddingLookup]:
+        """Looks up every text of an /api/embed or /api/embeddings request; None if the request cannot be cached."""
+        spans = _text_spans(endpoint, body, members)
+        if spans is None:
+            return None
+
+        scope = hashlib.blake2b(digest_size=32)
+        scope.update(f"{digest}\0{endpoint}".encode("utf-8"))
+        for name in sorted(set(members) - UNKEYED_FIELDS):
+            member = members[name]
+            scope.update(b"\0" + name.encode("utf-8") + b"=" + body[member.value_start:member.value_end])
+        scope_key = scope.digest()
+        keys = [hashlib.blake2b(body[start:end], digest_size=20, key=scope_key).hexdigest() for start, end in spans]
+
+        blobs: List[Optional[bytes]] = []
+        for key in keys:
+            blob = self._entries.get(key)
+            if blob is not None:
+                self._entries.move_to_end(key)
+            blobs.append(blob)
+        local_hits = sum(blob is not None for blob in blobs)
+
+        redis_hits = 0
+        pending = [i for i, blob in enumerate(blobs) if blob is None]
+        if pending and self._use_redis:
+            try:
+                found = await self.redis_client.mget([KEY_PREFIX + keys[i] for i in pending])
+            except Exception as e:
+                self._redis_failed(e)
+                found = []
+            for i, blob in zip(pending, found):
+                if blob is not None:
+                    blobs[i] = blob
+                    self._remember(keys[i], blob)
+                    redis_hits += 1
+
+        metrics.EMBED_CACHE_LOOKUPS.labels("local").inc(local_hits)
+        metrics.EMBED_CACHE_LOOKUPS.labels("redis").inc(redis_hits)
+        metrics.EMBED_CACHE_LOOKUPS.labels("miss").inc(len(keys) - local_hits - redis_hits)
+
+        vectors = [np.frombuffer(blob, dtype=np.float64) if blob is not None else None for blob in blobs]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        miss_body = _miss_body(body, members, spans, missing) if missing else None
+        return EmbeddingLookup(endpoint, keys, vectors, miss_body)
+
+    async def fill(self, lookup: EmbeddingLookup, upstream_body: bytes, total_duration_ns: int) -> bytes:
+        """
+        Caches the vectors of a successful response to `lookup.miss_body` and
+        returns the response to the original request. Raises ValueError when
+        the response does not hold one vector per missing text.
+        """
+        missing = lookup.missing
+        response = orjson.loads(upstream_body)
+        if lookup.endpoint == "embeddings":
+            received = [response.get("embedding")]
+        else:
+            received = response.get("embeddings") or []
+        if len(received) != len(missing):
+            raise ValueError(f"Expected {len(missing)} embedding(s), got {len(received)}")
+
+        blobs = {}
+        for i, vector in zip(missing, received):
+            try:
+                blob = np.asarray(vector, dtype=np.float64).tobytes()
+            except (TypeError, ValueError):
+                raise ValueError("Embedding is not a list of numbers")
+            if not blob:
+                raise ValueError("Empty embedding")
+            blobs[lookup.keys[i]] = blob
+            self._remember(lookup.keys[i], blob)
+
+        if self._use_redis:
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for key, blob in blobs.items():
+                        pipe.set(KEY_PREFIX + key, blob, ex=self.redis_ttl_seconds)
+                    await pipe.execute()
+            except Exception as e:
+                self._redis_failed(e)
+
+        if len(missing) == len(lookup.vectors):
+            return upstream_body
+
+        merged = list(lookup.vectors)
+        for i, vector in zip(missing, received):
+            merged[i] = vector
+        response["embeddings"] = merged
+        response["total_duration"] = total_duration_ns
+        return orjson.dumps(response, option=orjson.OPT_SERIALIZE_NUMPY)
@@ -0,0 +1,89 @@
+"""
+Cross-worker invalidation messages over Redis pub/sub.
+
+Each gunicorn worker keeps its own in-process caches. When one worker changes
+something those caches depend on (an API key is revoked, a server is edited),
+it publishes a message here and every worker, itself included, applies it.
+Without Redis, messages only reach the local process and the caches rely on
+their own expiry.
+"""
+
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "ollama_proxy:invalidate:"
+
+
+class InvalidationBus:
+    """Single pub/sub listener that dispatches messages to registered handlers."""
+
+    def __init__(self):
+        self._handlers: Dict[str, Callable[[str], None]] = {}
+        self._reset_handlers: List[Callable[[], None]] = []
+        self._redis: Optional[redis.Redis] = None
+
+    def register(self, channel: str, handler: Callable[[str], None], on_reset: Optional[Callable[[], None]] = None) -> None:
+        """
+        Registers a handler for a channel. `on_reset` is called whenever the
+        subscription is (re)established, since messages may have been missed.
+        """
+        self._handlers[CHANNEL_PREFIX + channel] = handler
+        if on_reset is not None:
+            self._reset_handlers.append(on_reset)
+
+    def attach_redis(self, redis_client: Optional[redis.Redis]) -> None:
+        self._redis = redis_client
+
+    async def publish(self, channel: str, message: str) -> None:
+        """Applies the message locally and broadcasts it to the other workers."""
+        handler = self._handlers.get(CHANNEL_PREFIX + channel)
+        if handler:
+            handler(message)
+        if self._redis is None:
+            return
+        try:
+            await self._redis.publish(CHANNEL_PREFIX + channel, message)
+        except Exception as e:
+            logger.warning(f"Could not broadcast invalidation on '{channel}': {e}")
+
+    def _reset_all(self) -> None:
+        for on_reset in self._reset_handlers:
+            on_reset()
+
+    async def listen(self) -> None:
+        """
+        Background task that applies messages published by other workers.
+        Reconnects with a short delay if the subscription drops.
+        """
+        while self._redis is not None:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(*self._handlers.keys())
+                self._reset_all()
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    handler = self._handlers.get(message["channel"])
+                    if handler:
+                        handler(message["data"])
+            except asyncio.CancelledError:
+                logger.info("Invalidation listener cancelled")
+                raise
+            except Exception as e:
+                # Messages may have been missed while disconnected
+                self._reset_all()
+                logger.warning(f"Invalidation listener error: {e}. Retrying in 5s.")
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+
+invalidation_bus = InvalidationBus()
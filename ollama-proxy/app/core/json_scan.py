@@ -0,0 +1,181 @@
+"""
+Field access on raw JSON request bodies without parsing them.
+
+Chat and generate requests can carry megabytes of base64 images, while the
+proxy only needs a handful of small fields (`model`, `think`, the leading
+messages for affinity). `object_members` walks one object level and
+returns the byte span of each member's value: strings are skipped with
+`bytes.find` and nested values with a regex that only stops on quotes and
+brackets, so no Python objects are created for the values that are not
+asked for. Single values are then decoded with `json.loads` on their span,
+and a rewrite splices new bytes in for one member, leaving the rest of the
+body exactly as the client sent it.
+
+Every function raises `ValueError` on malformed input.
+"""
+
+import json
+import re
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_SCALAR = re.compile(rb"[^,}\]\s]+")
+_NESTED_TOKEN = re.compile(rb'["\[\]{}]')
+
+_OPENERS = (ord("{"), ord("["))
+_QUOTE = ord('"')
+_BACKSLASH = ord("\\")
+
+
+class JsonMember(NamedTuple):
+    """Byte offsets of one object member: where its key starts and where its value starts and ends."""
+    start: int
+    value_start: int
+    value_end: int
+
+
+def _skip_whitespace(data: bytes, i: int) -> int:
+    return _WHITESPACE.match(data, i).end()
+
+
+def _string_end(data: bytes, i: int) -> int:
+    """Offset just past the string whose opening quote is at `i`."""
+    j = i + 1
+    while True:
+        j = data.find(b'"', j)
+        if j < 0:
+            raise ValueError("Unterminated string")
+        k = j - 1
+        while data[k] == _BACKSLASH:
+            k -= 1
+        # An even number of backslashes means the quote itself is not escaped
+        if (j - 1 - k) % 2 == 0:
+            return j + 1
+        j += 1
+
+
+def _value_end(data: bytes, i: int) -> int:
+    """Offset just past the value starting at `i`."""
+    if i >= len(data):
+        raise ValueError("Missing value")
+    first = data[i]
+    if first == _QUOTE:
+        return _string_end(data, i)
+    if first not in _OPENERS:
+        match = _SCALAR.match(data, i)
+        if match is None:
+            raise ValueError(f"Unexpected byte at offset {i}")
+        return match.end()
+
+    depth = 0
+    while True:
+        token = _NESTED_TOKEN.search(data, i)
+        if token is None:
+            raise ValueError("Unterminated object or array")
+        i = token.start()
+        if data[i] == _QUOTE:
+            i = _string_end(data, i)
+            continue
+        depth += 1 if data[i] in _OPENERS else -1
+        i += 1
+        if depth == 0:
+            return i
+
+
+def object_members(data: bytes, start: int = 0) -> Dict[str, JsonMember]:
+    """Members of the object starting at `start` (after whitespace); the last duplicate key wins, as in json.loads."""
+    i = _skip_whitespace(data, start)
+    if data[i:i + 1] != b"{":
+        raise ValueError("Not a JSON object")
+    members: Dict[str, JsonMember] = {}
+    i = _skip_whitespace(data, i + 1)
+    if data[i:i + 1] == b"}":
+        return members
+
+    while True:
+        if data[i:i + 1] != b'"':
+            raise ValueError(f"Expected a key at offset {i}")
+        key_end = _string_end(data, i)
+        raw_key = data[i + 1:key_end - 1]
+        key = json.loads(data[i:key_end]) if b"\\" in raw_key else raw_key.decode("utf-8")
+
+        colon = _skip_whitespace(data, key_end)
+        if data[colon:colon + 1] != b":":
+            raise ValueError(f"Expected ':' at offset {colon}")
+        value_start = _skip_whitespace(data, colon + 1)
+        value_end = _value_end(data, value_start)
+        members[key] = JsonMember(i, value_start, value_end)
+
+        i = _skip_whitespace(data, value_end)
+        separator = data[i:i + 1]
+        if separator == b"}":
+            return members
+        if separator != b",":
+            raise ValueError(f"Expected ',' or '}}' at offset {i}")
+        i = _skip_whitespace(data, i + 1)
+
+
+def array_elements(data: bytes, start: int) -> List[Tuple[int, int]]:
+    """(start, end) offsets of the elements of the array starting at `start`."""
+    i = _skip_whitespace(data, start)
+    if data[i:i + 1] != b"[":
+        raise ValueError("Not a JSON array")
+    elements: List[Tuple[int, int]] = []
+    i = _skip_whitespace(data, i + 1)
+    if data[i:i + 1] == b"]":
+        return elements
+
+    while True:
+        end = _value_end(data, i)
+        elements.append((i, end))
+        i = _skip_whitespace(data, end)
+        separator = data[i:i + 1]
+        if separator == b"]":
+            return elements
+        if separator != b",":
+            raise ValueError(f"Expected ',' or ']' at offset {i}")
+        i = _skip_whitespace(data, i + 1)
+
+
+def member_value(data: bytes, member: JsonMember) -> Any:
+    """Decodes a single member's value."""
+    return json.loads(data[member.value_start:member.value_end])
+
+
+def is_empty_value(data: bytes, member: JsonMember) -> bool:
+    """True for null, false, an empty string, array or object: the values Python treats as falsy."""
+    raw = data[member.value_start:member.value_end]
+    if raw[:1] in (b"[", b"{"):
+        return not raw[1:-1].strip()
+    return raw in (b"null", b"false", b'""', b"0")
+
+
+def replace_value(data: bytes, member: JsonMember, value: Any) -> bytes:
+    """The body with one member's value replaced; every other byte is kept."""
+    encoded = json.dumps(value).encode("utf-8")
+    return data[:member.value_start] + encoded + data[member.value_end:]
+
+
+def set_member(data: bytes, members: Dict[str, JsonMember], key: str, value: Any) -> bytes:
+    """The body with `key` set to `value`, added at the front of the object if it was missing."""
+    if key in members:
+        return replace_value(data, members[key], value)
+    opening = data.index(b"{")
+    encoded = json.dumps({key: value})[1:-1].encode("utf-8")
+    separator = b"," if members else b""
+    return data[:opening + 1] + encoded + separator + data[opening + 1:]
+
+
+def remove_member(data: bytes, members: Dict[str, JsonMember], key: str) -> bytes:
+    """The body without `key`, together with the comma that separated it from its neighbour."""
+    member = members.get(key)
+    if member is None:
+        return data
+    following = _skip_whitespace(data, member.value_end)
+    if data[following:following + 1] == b",":
+        return data[:member.start] + data[_skip_whitespace(data, following + 1):]
+    # Last member: drop the comma after the one before it
+    previous_ends = [m.value_end for m in members.values() if m.value_end <= member.start]
+    if previous_ends:
+        return data[:max(previous_ends)] + data[member.value_end:]
+    return data[:member.start] + data[member.value_end:]
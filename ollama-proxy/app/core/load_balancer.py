@@ -0,0 +1,303 @@
+"""
+Backend selection strategies for the reverse proxy.
+
+The balancer returns the candidate servers in the order they should be tried:
+the first entry is the preferred backend and the rest are failover targets.
+A request counts as in flight from the moment it is sent to a backend until
+its response body has been fully streamed (or the client went away), and
+time-to-first-byte is kept as an exponentially weighted moving average per
+(server, model). Only successful responses for models a server lists are
+averaged: model names come from clients, and fast error replies would make a
+failing backend look like the quickest one.
+
+Load is tracked per worker by default. With shared state enabled and Redis
+available, in-flight counts and TTFB averages come from Redis so that every
+worker and proxy node sees the real backend load. If Redis fails, the
+balancer falls back to its local view and retries Redis a little later.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import redis.asyncio as redis
+
+from app.core import metrics
+from app.core.affinity import ConsistentHashRing
+from app.core.routing_table import BackendServer
+from app.core.shared_load_state import SharedLoadState
+
+logger = logging.getLogger(__name__)
+
+STRATEGY_ROUND_ROBIN = "round_robin"
+STRATEGY_LEAST_IN_FLIGHT = "least_in_flight"
+STRATEGY_POWER_OF_TWO = "power_of_two"
+STRATEGY_EWMA_LATENCY = "ewma_latency"
+
+STRATEGIES = (
+    STRATEGY_ROUND_ROBIN,
+    STRATEGY_LEAST_IN_FLIGHT,
+    STRATEGY_POWER_OF_TWO,
+    STRATEGY_EWMA_LATENCY,
+)
+
+# Weight of the newest sample in the TTFB moving average
+EWMA_ALPHA = 0.3
+
+# How long to stay on local state after a Redis error
+SHARED_STATE_RETRY_SECONDS = 10.0
+
+# Hash rings kept for distinct candidate sets (one per model, typically)
+MAX_CACHED_RINGS = 256
+
+
+class LoadBalancer:
+    """Tracks backend load and orders candidate servers."""
+
+    def __init__(self, redis_client: Optional[redis.Redis] = None, shared_state: bool = False):
+        self._round_robin_index = 0
+        self._in_flight: Dict[int, int] = {}
+        self._ewma_ttfb: Dict[Tuple[int, str], float] = {}
+        self._shared: Optional[SharedLoadState] = None
+        self._shared_retry_at = 0.0
+        self._rings: Dict[Tuple[int, ...], ConsistentHashRing] = {}
+        self.configure_shared_state(redis_client, shared_state)
+
+    def configure_shared_state(self, redis_client: Optional[redis.Redis], enabled: bool) -> None:
+        """Turns Redis-backed shared state on or off (it stays off without Redis)."""
+        if enabled and redis_client is not None:
+            if self._shared is None:
+                self._shared = SharedLoadState(redis_client)
+                logger.info("Load balancer is using shared backend load state in Redis")
+        else:
+            self._shared = None
+
+    @property
+    def shared_state_active(self) -> bool:
+        return self._shared is not None and time.monotonic() >= self._shared_retry_at
+
+    def _shared_state_failed(self, action: str, error: Exception) -> None:
+        if time.monotonic() >= self._shared_retry_at:
+            logger.warning(
+                f"Shared load state {action} failed: {error}. "
+                f"Using local load state for {SHARED_STATE_RETRY_SECONDS:.0f}s."
+            )
+        self._shared_retry_at = time.monotonic() + SHARED_STATE_RETRY_SECONDS
+
+    # --- Load tracking ---
+
+    async def acquire(
+        self, server_id: int, model: Optional[str], server_name: str = "", record_ttfb: bool = True
+    ) -> "InFlightGuard":
+        """
+        Takes an in-flight slot on a backend; release it through the returned guard.
+        With `record_ttfb` False (e.g. a model no server lists) its TTFB is not averaged.
+        """
+        self._in_flight[server_id] = self._in_flight.get(server_id, 0) + 1
+        metrics.IN_FLIGHT.labels(server_name or str(server_id)).inc()
+        token = None
+        if self.shared_state_active:
+            try:
+                token = await self._shared.acquire(server_id)
+            except Exception as e:
+                self._shared_state_failed("acquire", e)
+        return InFlightGuard(self, server_id, model, token, server_name, record_ttfb)
+
+    def _release_local(self, guard: "InFlightGuard") -> None:
+        remaining = self._in_flight.get(guard.server_id, 0) - 1
+        if remaining > 0:
+            self._in_flight[guard.server_id] = remaining
+        else:
+            self._in_flight.pop(guard.server_id, None)
+        metrics.IN_FLIGHT.labels(guard.server_name or str(guard.server_id)).dec()
+
+        if guard.record_ttfb and guard.ttfb_seconds is not None:
+            self._record_ttfb(guard.server_id, guard.model, guard.ttfb_seconds)
+
+    async def _release_shared(self, guard: "InFlightGuard") -> None:
+        # Released even while degraded: an unreleased slot would only expire with its lease
+        if guard.shared_token is not None and self._shared is not None:
+            try:
+                ttfb_seconds = guard.ttfb_seconds if guard.record_ttfb else None
+                await self._shared.release(guard.server_id, guard.shared_token, guard.model, ttfb_seconds, EWMA_ALPHA)
+            except Exception as e:
+                self._shared_state_failed("release", e)
+
+    def _record_ttfb(self, server_id: int, model: Optional[str], seconds: float) -> None:
+        key = (server_id, model or "")
+        previous = self._ewma_ttfb.get(key)
+        if previous is None:
+            self._ewma_ttfb[key] = seconds
+        else:
+            self._ewma_ttfb[key] = EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * previous
+
+    async def _load_view(self, servers: List[BackendServer], model: Optional[str]) -> Tuple[Dict[int, int], Dict[int, float]]:
+        """In-flight counts and TTFB averages for the candidates, cluster-wide when possible."""
+        if self.shared_state_active:
+            try:
+                return await self._shared.read([s.id for s in servers], model)
+            except Exception as e:
+                self._shared_state_failed("read", e)
+
+        in_flight = {s.id: self._in_flight.get(s.id, 0) for s in servers}
+        ttfb = {}
+        for s in servers:
+            value = self._ewma_ttfb.get((s.id, model or ""))
+            if value is not None:
+                ttfb[s.id] = value
+        return in_flight, ttfb
+
+    # --- Selection ---
+
+    def _rotated(self, servers: List[BackendServer]) -> List[BackendServer]:
+        """Round-robin rotation, also used to break ties fairly in other strategies."""
+        index = self._round_robin_index % len(servers)
+        self._round_robin_index = index + 1
+        return servers[index:] + servers[:index]
+
+    async def order(
+        self,
+        servers: List[BackendServer],
+        strategy: str,
+        model: Optional[str] = None,
+        warm_server_ids: Optional[Set[int]] = None,
+        warm_max_in_flight: int = 0,
+    ) -> List[BackendServer]:
+        """
+        Returns `servers` in the order they should be tried for this request.
+        Servers in `warm_server_ids` (model already loaded) go first unless they
+        have `warm_max_in_flight` or more requests in flight (0 = no limit).
+        """
+        if len(servers) <= 1:
+            return list(servers)
+
+        rotated = self._rotated(servers)
+        if strategy not in STRATEGIES:
+            logger.warning(f"Unknown load balancing strategy '{strategy}', using round robin")
+            strategy = STRATEGY_ROUND_ROBIN
+
+        prefer_warm = bool(warm_server_ids) and len(warm_server_ids) < len(servers)
+        if strategy == STRATEGY_ROUND_ROBIN and not (prefer_warm and warm_max_in_flight):
+            in_flight, ttfb = {}, {}
+        else:
+            in_flight, ttfb = await self._load_view(servers, model)
+
+        if strategy == STRATEGY_LEAST_IN_FLIGHT:
+            ordered = sorted(rotated, key=lambda s: in_flight.get(s.id, 0))
+        elif strategy == STRATEGY_POWER_OF_TWO:
+            first, second = random.sample(rotated, 2)
+            chosen = first if in_flight.get(first.id, 0) <= in_flight.get(second.id, 0) else second
+            fallbacks = sorted((s for s in rotated if s is not chosen), key=lambda s: in_flight.get(s.id, 0))
+            ordered = [chosen] + fallbacks
+        elif strategy == STRATEGY_EWMA_LATENCY:
+            # Servers without samples for this model score 0 so they get probed;
+            # scaling by queue depth keeps one fast server from absorbing everything.
+            ordered = sorted(rotated, key=lambda s: ttfb.get(s.id, 0.0) * (in_flight.get(s.id, 0) + 1))
+        else:
+            ordered = rotated
+
+        if not prefer_warm:
+            return ordered
+
+        def available_warm(server: BackendServer) -> bool:
+            if server.id not in warm_server_ids:
+                return False
+            return not warm_max_in_flight or in_flight.get(server.id, 0) < warm_max_in_flight
+
+        warm = [s for s in ordered if available_warm(s)]
+        return warm + [s for s in ordered if s not in warm]
+
+    async def order_by_affinity(
+        self,
+        servers: List[BackendServer],
+        key: str,
+        model: Optional[str] = None,
+        load_factor: float = 1.25,
+    ) -> List[BackendServer]:
+        """
+        Orders `servers` so that requests with the same affinity key keep going
+        to the same backend (bounded-load consistent hashing). The rest of the
+        ring order is the failover order.
+        """
+        if len(servers) <= 1:
+            return list(servers)
+
+        ring_key = tuple(sorted(s.id for s in servers))
+        ring = self._rings.get(ring_key)
+        if ring is None:
+            if len(self._rings) >= MAX_CACHED_RINGS:
+                self._rings.pop(next(iter(self._rings)))
+            ring = self._rings[ring_key] = ConsistentHashRing(servers)
+
+        in_flight, _ = await self._load_view(servers, model)
+        # Rings outlive routing snapshots, so map back to the current server objects
+        current = {s.id: s for s in servers}
+        return [current[s.id] for s in ring.order(key, in_flight, load_factor)]
+
+    async def stats(self, server_ids: List[int]) -> Dict[int, Dict[str, Optional[float]]]:
+        """Per-server in-flight count and average TTFB (across models) for the dashboard."""
+        in_flight = {server_id: self._in_flight.get(server_id, 0) for server_id in server_ids}
+        samples: Dict[int, List[float]] = {}
+        for (server_id, _model), value in self._ewma_ttfb.items():
+            samples.setdefault(server_id, []).append(value)
+
+        if self.shared_state_active and server_ids:
+            try:
+                in_flight, _ = await self._shared.read(server_ids, None)
+                samples = await self._shared.ttfb_by_server(server_ids)
+            except Exception as e:
+                self._shared_state_failed("read", e)
+
+        return {
+            server_id: {
+                "in_flight": in_flight.get(server_id, 0),
+                "ewma_ttfb_ms": round(sum(samples[server_id]) / len(samples[server_id]) * 1000, 1) if samples.get(server_id) else None,
+            }
+            for server_id in server_ids
+        }
+
+
+class InFlightGuard:
+    """
+    One in-flight slot on a backend, released exactly once.
+    Also records time-to-first-byte when the first body chunk is seen.
+    """
+
+    def __init__(
+        self,
+        balancer: LoadBalancer,
+        server_id: int,
+        model: Optional[str],
+        shared_token: Optional[str] = None,
+        server_name: str = "",
+        record_ttfb: bool = True,
+    ):
+        self._balancer = balancer
+        self.server_id = server_id
+        self.server_name = server_name
+        self.model = model
+        self.shared_token = shared_token
+        self.started_at = time.perf_counter()
+        self.ttfb_seconds: Optional[float] = None
+        # Cleared for responses whose TTFB should not be averaged (errors)
+        self.record_ttfb = record_ttfb
+        self._released = False
+
+    def first_byte(self) -> None:
+        if self.ttfb_seconds is None:
+            self.ttfb_seconds = time.perf_counter() - self.started_at
+
+    async def release(self) -> None:
+        """
+        Frees the local slot right away, then the shared one in Redis. The
+        Redis call is shielded, so a caller cancelled mid-release (the client
+        went away) still gives the lease back.
+        """
+        if self._released:
+            return
+        self._released = True
+        self._balancer._release_local(self)
+        if self.shared_token is not None:
+            await asyncio.shield(self._balancer._release_shared(self))
@@ -0,0 +1,144 @@
+"""
+Prometheus metrics for the proxy.
+
+Under gunicorn every worker is its own process with its own counters, so
+when PROMETHEUS_MULTIPROC_DIR is set (gunicorn_conf.py sets it) each worker
+writes its values to memory-mapped files in that directory and a scrape of
+/metrics, whichever worker answers it, aggregates the files of all workers.
+Counters and histograms are summed; gauges say how they are combined
+(in-flight requests are summed over live workers, circuit state takes the
+worst worker). Without the variable, the default in-process registry is used.
+
+Updating a metric is a dictionary lookup and an add on a memory-mapped
+value, so it is done inline on the request path.
+"""
+
+import os
+from typing import Optional, Tuple
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, multiprocess
+from prometheus_client.exposition import choose_encoder
+
+# Ollama endpoints reported by name; anything else is counted as "other"
+KNOWN_ROUTES = frozenset({
+    "generate", "chat", "embed", "embeddings", "tags", "show", "ps", "version",
+    "pull", "push", "create", "copy", "delete", "blobs",
+})
+
+# Latency buckets in seconds: from a cached response to a long generation
+TTFB_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUESTS = Counter(
+    "ollama_proxy_requests_total",
+    "Proxied requests by route, response status, backend server and model.",
+    ["route", "status", "server", "model"],
+)
+UPSTREAM_TTFB = Histogram(
+    "ollama_proxy_upstream_ttfb_seconds",
+    "Time from sending a request upstream to the first response byte.",
+    ["server"],
+    buckets=TTFB_BUCKETS,
+)
+REQUEST_DURATION = Histogram(
+    "ollama_proxy_request_duration_seconds",
+    "Time from receiving a request to the end of the response body.",
+    ["server", "model"],
+    buckets=DURATION_BUCKETS,
+)
+UPSTREAM_RETRIES = Counter(
+    "ollama_proxy_upstream_retries_total",
+    "Requests re-sent upstream, as a retry on the same server or a failover to the next one.",
+    ["server", "kind"],
+)
+CIRCUIT_STATE = Gauge(
+    "ollama_proxy_circuit_breaker_state",
+    "Circuit breaker state per backend server (0 = closed, 1 = half-open, 2 = open).",
+    ["server"],
+    multiprocess_mode="max",
+)
+CIRCUIT_OPENED = Counter(
+    "ollama_proxy_circuit_breaker_opened_total",
+    "Times a backend server's circuit breaker opened.",
+    ["server"],
+)
+REJECTIONS = Counter(
+    "ollama_proxy_rejections_total",
+    "Requests refused before reaching a backend, by reason (rate_limit, token_quota, admission).",
+    ["reason"],
+)
+POOL_WAIT = Histogram(
+    "ollama_proxy_connection_pool_wait_seconds",
+    "Time a request to a backend server waited for a connection from its pool.",
+    ["server"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60),
+)
+IN_FLIGHT = Gauge(
+    "ollama_proxy_in_flight_requests",
+    "Requests currently being sent to or streamed from each backend server.",
+    ["server"],
+    multiprocess_mode="livesum",
+)
+EMBED_BATCH_SIZE = Histogram(
+    "ollama_proxy_embed_batch_size",
+    "Prompts per micro-batched embedding call.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+EMBED_BATCH_WAIT = Histogram(
+    "ollama_proxy_embed_batch_wait_seconds",
+    "Time an embedding request was held waiting for its batch to be sent.",
+    buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2),
+)
+EMBED_CACHE_LOOKUPS = Counter(
+    "ollama_proxy_embedding_cache_lookups_total",
+    "Texts looked up in the embedding cache, by where they were found (local, redis) or miss.",
+    ["result"],
+)
+RESPONSE_CACHE_REQUESTS = Counter(
+    "ollama_proxy_response_cache_requests_total",
+    "Deterministic generate/chat requests by outcome: served from cache (hit), joined a running generation (coalesced) or sent upstream (miss).",
+    ["result"],
+)
+USAGE_LOG_QUEUE_DEPTH = Gauge(
+    "ollama_proxy_usage_log_queue_depth",
+    "Usage log rows waiting to be written to the database.",
+    multiprocess_mode="livesum",
+)
+
+
+def route_label(path: str) -> str:
+    """The route label for a proxied path, bounded to the known Ollama endpoints."""
+    endpoint = path.strip("/").split("/", 1)[0]
+    return f"/api/{endpoint}" if endpoint in KNOWN_ROUTES else "/api/other"
+
+
+def model_label(model_name: Optional[str], known: bool) -> str:
+    """The model label for a request, bounded to the models the servers list."""
+    if not model_name:
+        return ""
+    return model_name if known else "other"
+
+
+def observe_request(
+    path: str,
+    status_code: int,
+    server: str = "",
+    model: Optional[str] = None,
+    ttfb_seconds: Optional[float] = None,
+    duration_seconds: Optional[float] = None,
+) -> None:
+    REQUESTS.labels(route_label(path), str(status_code), server, model or "").inc()
+    if ttfb_seconds is not None and server:
+        UPSTREAM_TTFB.labels(server).observe(ttfb_seconds)
+    if duration_seconds is not None:
+        REQUEST_DURATION.labels(server, model or "").observe(duration_seconds)
+
+
+def render(accept_header: Optional[str]) -> Tuple[bytes, str]:
+    """Exposition of every worker's metrics, in the format the scraper asked for."""
+    encoder, content_type = choose_encoder(accept_header or "")
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return encoder(registry), content_type
+    return encoder(REGISTRY), content_type
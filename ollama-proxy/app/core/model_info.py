@@ -0,0 +1,171 @@
+"""
+Cached answers for /api/show and /api/version.
+
+Open WebUI asks /api/show about every model on every page load, and the
+answer only depends on the model weights and the name it is asked about.
+Responses are kept by model name and digest: they are fetched for every new
+pair when a server's model list is refreshed (within
+`SHOW_WARM_TIMEOUT_SECONDS`), and on a miss from one of the servers hosting
+the model. Verbose requests (with the tensor listing) are not cached.
+
+/api/version is asked of every Ollama server at most once per
+`VERSION_TTL_SECONDS`. The lowest version is reported, since a client can
+only rely on the features all the backends it may be routed to support.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import httpx
+import orjson
+
+from app.core.connection_pools import backend_pools
+from app.core.routing_table import BackendServer
+
+logger = logging.getLogger(__name__)
+
+MAX_SHOW_ENTRIES = 1024
+SHOW_WARM_CONCURRENCY = 4
+SHOW_WARM_TIMEOUT_SECONDS = 30.0
+VERSION_TTL_SECONDS = 300.0
+VERSION_RETRY_SECONDS = 10.0
+
+_VERSION_RE = re.compile(r"\d+")
+
+
+def _log_failure(failing: Set[str], server: str, message: str) -> None:
+    """Warns about the first failure of a server in a row; repeats go to debug."""
+    if server in failing:
+        logger.debug(message)
+    else:
+        failing.add(server)
+        logger.warning(message)
+
+
+class ShowCache:
+    """/api/show response bodies by model name and digest."""
+
+    def __init__(self, max_entries: int = MAX_SHOW_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._failing: Set[str] = set()
+
+    def get(self, model_name: str, digest: str) -> Optional[bytes]:
+        key = (model_name, digest)
+        body = self._entries.get(key)
+        if body is not None:
+            self._entries.move_to_end(key)
+        return body
+
+    def put(self, model_name: str, digest: str, body: bytes) -> None:
+        key = (model_name, digest)
+        self._entries[key] = body
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def fetch(
+        self, http_client: httpx.AsyncClient, base_url: str, headers: Dict[str, str], model_name: str, digest: str
+    ) -> Optional[bytes]:
+        """Asks one server about the model and caches the answer; None if it could not answer."""
+        try:
+            response = await http_client.post(
+                f"{base_url}/api/show", json={"model": model_name}, headers=headers, timeout=10.0
+            )
+        except httpx.HTTPError as e:
+            _log_failure(self._failing, base_url, f"Could not fetch /api/show for '{model_name}' from {base_url}: {e}")
+            return None
+        if response.status_code != 200:
+            _log_failure(self._failing, base_url, f"/api/show for '{model_name}' on {base_url} returned {response.status_code}")
+            return None
+        self._failing.discard(base_url)
+        self.put(model_name, digest, response.content)
+        return response.content
+
+    async def warm(self, http_client: httpx.AsyncClient, base_url: str, headers: Dict[str, str], models: List[dict]) -> int:
+        """
+        Fetches the models of a freshly refreshed server that are not cached yet,
+        giving up after `SHOW_WARM_TIMEOUT_SECONDS`; returns how many were added.
+        """
+        pending = set()
+        for model in models:
+            digest = model.get("digest") if isinstance(model, dict) else None
+            name = model.get("name") if isinstance(model, dict) else None
+            if isinstance(digest, str) and digest and isinstance(name, str) and name and (name, digest) not in self._entries:
+                pending.add((name, digest))
+
+        semaphore = asyncio.Semaphore(SHOW_WARM_CONCURRENCY)
+        added = 0
+
+        async def fetch(model_name: str, digest: str) -> None:
+            nonlocal added
+            async with semaphore:
+                if await self.fetch(http_client, base_url, headers, model_name, digest) is not None:
+                    added += 1
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(fetch(name, digest) for name, digest in pending)), timeout=SHOW_WARM_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Caching /api/show for {base_url} took longer than {SHOW_WARM_TIMEOUT_SECONDS}s; the rest is fetched on demand")
+        return added
+
+
+def _version_key(version: str) -> Tuple[int, ...]:
+    return tuple(int(part) for part in _VERSION_RE.findall(version)[:3])
+
+
+class VersionCache:
+    """The lowest /api/version of the active Ollama servers, refreshed once per TTL."""
+
+    def __init__(self, ttl_seconds: float = VERSION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._body: Optional[bytes] = None
+        self._fetched_at = 0.0
+        self._failed_at = float("-inf")
+        self._lock = asyncio.Lock()
+        self._failing: Set[str] = set()
+
+    def _fresh(self) -> bool:
+        now = time.monotonic()
+        if self._body is not None and now - self._fetched_at < self.ttl_seconds:
+            return True
+        # After a round where no server answered, keep what we have for a while
+        return now - self._failed_at < VERSION_RETRY_SECONDS
+
+    async def _fetch(self, server: BackendServer) -> Optional[str]:
+        try:
+            response = await backend_pools.client_for(server).get(f"{server.url}/api/version", headers=server.auth_headers, timeout=3.0)
+            response.raise_for_status()
+            version = response.json().get("version")
+        except Exception as e:
+            _log_failure(self._failing, server.name, f"Could not fetch /api/version from '{server.name}': {e}")
+            return None
+        self._failing.discard(server.name)
+        return version if isinstance(version, str) and version else None
+
+    async def get(self, servers: List[BackendServer]) -> Optional[bytes]:
+        """The cached body, refreshed (by one caller at a time) when it has expired; None if no server answered."""
+        if self._fresh():
+            return self._body
+        async with self._lock:
+            if self._fresh():
+                return self._body
+            ollama_servers = [s for s in servers if s.server_type == "ollama"]
+            versions = await asyncio.gather(*(self._fetch(server) for server in ollama_servers))
+            versions = [v for v in versions if v]
+            if not versions:
+                self._failed_at = time.monotonic()
+                return self._body
+            self._body = orjson.dumps({"version": min(versions, key=_version_key)})
+            self._fetched_at = time.monotonic()
+            return self._body
+
+
+show_cache = ShowCache()
+version_cache = VersionCache()
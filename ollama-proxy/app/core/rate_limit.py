@@ -0,0 +1,251 @@
+"""
+Per-API-key request rate limiting.
+
+Limits are enforced with GCRA (the generic cell rate algorithm): a key
+allowed `limit` requests per `window` has one request "emitted" every
+window / limit seconds and may burst up to `limit` requests. The only state
+is the key's theoretical arrival time (TAT), so a check is a single Lua
+script call that returns allow/deny, remaining quota and retry-after in one
+round trip. Unlike a fixed window, there is no boundary at which a client
+can send twice its limit.
+
+Token quotas (per minute and per UTC day) are counted in fixed windows:
+the tokens a response used are added once it has been streamed, and a new
+request is refused while the current window's total is at or over the
+quota. Reading both windows is one MGET and recording is one script call.
+
+Whenever Redis cannot be used (not reachable at startup, or failing later),
+checks fall back to an in-process token bucket with the same rate and burst
+(and token windows to in-process counters), so each worker limits on its
+own until Redis is retried a little later. Limits are never switched off.
+"""
+
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "rate_limit:"
+TOKEN_KEY_PREFIX = "token_usage:"
+
+MINUTE_SECONDS = 60
+DAY_SECONDS = 86400
+
+# How long to stay on the local limiter after a Redis error
+REDIS_RETRY_SECONDS = 10.0
+
+# Buckets kept by the local limiter (least recently used are evicted)
+MAX_LOCAL_BUCKETS = 10000
+
+# KEYS[1] = TAT key; ARGV = emission interval (ms), window (ms)
+# Returns allowed (1/0), remaining, retry after (ms), reset (ms)
+_GCRA_SCRIPT = """
+local interval = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + tonumber(time[2]) / 1000
+
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local allow_at = new_tat - window
+
+if now < allow_at then
+    return {0, 0, math.ceil(allow_at - now), math.ceil(tat - now)}
+end
+
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil(new_tat - now))
+return {1, math.floor((now - allow_at) / interval), 0, math.ceil(new_tat - now)}
+"""
+
+
+# KEYS = minute window, day window; ARGV = tokens, minute ttl, day ttl
+_ADD_TOKENS_SCRIPT = """
+redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('INCRBY', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after_seconds: int
+    reset_seconds: int
+
+    def headers(self) -> dict:
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(self.reset_seconds),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after_seconds)
+        return headers
+
+
+class TokenQuotaResult(NamedTuple):
+    allowed: bool
+    remaining_minute: Optional[int]
+    remaining_day: Optional[int]
+    retry_after_seconds: int
+
+    def headers(self) -> dict:
+        headers = {}
+        if self.remaining_minute is not None:
+            headers["X-TokenLimit-Remaining-Minute"] = str(self.remaining_minute)
+        if self.remaining_day is not None:
+            headers["X-TokenLimit-Remaining-Day"] = str(self.remaining_day)
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after_seconds)
+        return headers
+
+
+def _token_windows(key_prefix: str, now: float) -> Tuple[str, str, int, int]:
+    """Minute and day window keys, with the seconds left in each window."""
+    minute, day = int(now // MINUTE_SECONDS), int(now // DAY_SECONDS)
+    return (
+        f"{TOKEN_KEY_PREFIX}{key_prefix}:m:{minute}",
+        f"{TOKEN_KEY_PREFIX}{key_prefix}:d:{day}",
+        max(1, math.ceil((minute + 1) * MINUTE_SECONDS - now)),
+        max(1, math.ceil((day + 1) * DAY_SECONDS - now)),
+    )
+
+
+def usage_from_tat(tat_ms: float, now_ms: float, limit: int, window_seconds: float) -> Tuple[int, int]:
+    """Requests counted against the quota and seconds until it is fully restored, for the dashboard."""
+    backlog_ms = max(0.0, tat_ms - now_ms)
+    interval_ms = window_seconds * 1000 / limit
+    return min(limit, math.ceil(backlog_ms / interval_ms)), math.ceil(backlog_ms / 1000)
+
+
+class LocalTokenBucket:
+    """In-process token buckets keyed by API key prefix."""
+
+    def __init__(self, max_buckets: int = MAX_LOCAL_BUCKETS):
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._max_buckets = max_buckets
+
+    def check(self, key: str, limit: int, window_seconds: float) -> RateLimitResult:
+        now = time.monotonic()
+        rate = limit / window_seconds
+        tokens, updated_at = self._buckets.pop(key, (float(limit), now))
+        tokens = min(float(limit), tokens + (now - updated_at) * rate)
+
+        allowed = tokens >= 1.0
+        if allowed:
+            tokens -= 1.0
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self._max_buckets:
+            self._buckets.popitem(last=False)
+
+        return RateLimitResult(
+            allowed=allowed,
+            limit=limit,
+            remaining=int(tokens),
+            retry_after_seconds=0 if allowed else math.ceil((1.0 - tokens) / rate),
+            reset_seconds=math.ceil((limit - tokens) / rate),
+        )
+
+
+class RateLimiter:
+    """GCRA limiter and token quotas in Redis, with local fallbacks."""
+
+    def __init__(self, redis_client: Optional[redis.Redis], connected: bool = True):
+        """
+        `connected` is False when Redis did not answer at startup: limits start
+        on the local fallback and Redis is tried again after REDIS_RETRY_SECONDS.
+        """
+        self._redis = redis_client
+        self._script = redis_client.register_script(_GCRA_SCRIPT) if redis_client is not None else None
+        self._add_tokens = redis_client.register_script(_ADD_TOKENS_SCRIPT) if redis_client is not None else None
+        self._local = LocalTokenBucket()
+        self._local_tokens: "OrderedDict[str, int]" = OrderedDict()
+        self._redis_retry_at = 0.0
+        if redis_client is not None and not connected:
+            self._redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
+
+    @property
+    def using_fallback(self) -> bool:
+        return time.monotonic() < self._redis_retry_at
+
+    async def check(self, key_prefix: str, limit: int, window_seconds: float) -> RateLimitResult:
+        """Counts one request for the key and says whether it is allowed."""
+        if limit <= 0 or window_seconds <= 0:
+            return RateLimitResult(False, max(limit, 0), 0, max(1, math.ceil(window_seconds)), 0)
+
+        if self._script is not None and not self.using_fallback:
+            try:
+                allowed, remaining, retry_after_ms, reset_ms = await self._script(
+                    keys=[KEY_PREFIX + key_prefix],
+                    args=[window_seconds * 1000 / limit, window_seconds * 1000],
+                )
+                return RateLimitResult(
+                    allowed=bool(allowed),
+                    limit=limit,
+                    remaining=int(remaining),
+                    retry_after_seconds=max(1, math.ceil(int(retry_after_ms) / 1000)) if not allowed else 0,
+                    reset_seconds=math.ceil(int(reset_ms) / 1000),
+                )
+            except Exception as e:
+                self._redis_failed(e)
+
+        return self._local.check(key_prefix, limit, window_seconds)
+
+    def _redis_failed(self, error: Exception) -> None:
+        if not self.using_fallback:
+            logger.warning(
+                f"Redis rate limiting failed: {error}. "
+                f"Using the in-process limiter for {REDIS_RETRY_SECONDS:.0f}s."
+            )
+        self._redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
+
+    # --- Token quotas ---
+
+    async def check_tokens(self, key_prefix: str, per_minute: int, per_day: int) -> TokenQuotaResult:
+        """Says whether the key still has token quota left (0 = no quota for that window)."""
+        minute_key, day_key, minute_left, day_left = _token_windows(key_prefix, time.time())
+        used_minute = used_day = None
+        if self._redis is not None and not self.using_fallback:
+            try:
+                used_minute, used_day = await self._redis.mget(minute_key, day_key)
+            except Exception as e:
+                self._redis_failed(e)
+        if self._redis is None or self.using_fallback:
+            used_minute, used_day = self._local_tokens.get(minute_key), self._local_tokens.get(day_key)
+
+        remaining_minute = max(0, per_minute - int(used_minute or 0)) if per_minute > 0 else None
+        remaining_day = max(0, per_day - int(used_day or 0)) if per_day > 0 else None
+        retry_after = 0
+        if remaining_day == 0:
+            retry_after = day_left
+        elif remaining_minute == 0:
+            retry_after = minute_left
+        return TokenQuotaResult(retry_after == 0, remaining_minute, remaining_day, retry_after)
+
+    async def record_tokens(self, key_prefix: str, tokens: int) -> None:
+        """Adds the tokens a finished response used to the key's current windows."""
+        if tokens <= 0:
+            return
+        minute_key, day_key, minute_left, day_left = _token_windows(key_prefix, time.time())
+        if self._add_tokens is not None and not self.using_fallback:
+            try:
+                await self._add_tokens(keys=[minute_key, day_key], args=[tokens, minute_left, day_left])
+                return
+            except Exception as e:
+                self._redis_failed(e)
+
+        for key in (minute_key, day_key):
+            self._local_tokens[key] = self._local_tokens.pop(key, 0) + tokens
+        while len(self._local_tokens) > MAX_LOCAL_BUCKETS:
+            self._local_tokens.popitem(last=False)
@@ -0,0 +1,135 @@
+"""
+Tracks which models are resident (loaded in memory) on each backend.
+
+A background task polls `/api/ps` on every active Ollama server and keeps
+the loaded models with their expiry time, so routing can prefer a server
+that already has the model loaded over one that must cold-load it. Models
+proxied successfully are marked as loaded right away, and vLLM servers are
+treated as always warm for the models they serve.
+
+The models each server reported are also kept as sent, so the proxy's own
+/api/ps can list the loaded models of every server without polling them
+again on each call.
+"""
+
+import asyncio
+import datetime
+import logging
+import re
+from typing import Any, Dict, List, Optional, Set
+
+from app.core.connection_pools import backend_pools
+from app.core.routing_table import routing_table, BackendServer
+
+logger = logging.getLogger(__name__)
+
+# Ollama unloads an idle model after 5 minutes unless keep_alive says otherwise
+DEFAULT_KEEP_ALIVE = datetime.timedelta(minutes=5)
+
+_FRACTION_RE = re.compile(r"\.(\d{6})\d+")
+
+
+def _parse_expires_at(value: Any) -> Optional[datetime.datetime]:
+    """Parses Ollama's `expires_at`, which may carry nanosecond precision."""
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        value = _FRACTION_RE.sub(r".\1", value.replace("Z", "+00:00"))
+        expires_at = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+    return expires_at
+
+
+def _name_matches(requested: str, resident: str) -> bool:
+    return resident == requested or resident.startswith(requested + ":")
+
+
+class ResidentModelTracker:
+    """Per-server set of loaded models with their expiry times."""
+
+    def __init__(self):
+        self._resident: Dict[int, Dict[str, datetime.datetime]] = {}
+        self._reported: Dict[int, List[dict]] = {}
+        self.last_poll_at: Optional[datetime.datetime] = None
+        self._poll_lock = asyncio.Lock()
+
+    def is_warm(self, server: BackendServer, model_name: Optional[str]) -> bool:
+        if not model_name:
+            return False
+        if server.server_type == "vllm":
+            return True
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for resident, expires_at in self._resident.get(server.id, {}).items():
+            if expires_at > now and _name_matches(model_name, resident):
+                return True
+        return False
+
+    def warm_server_ids(self, servers: List[BackendServer], model_name: Optional[str]) -> Set[int]:
+        return {server.id for server in servers if self.is_warm(server, model_name)}
+
+    def mark_loaded(self, server_id: int, model_name: str) -> None:
+        """Records that a model was just used on a server (and so is loaded there)."""
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + DEFAULT_KEEP_ALIVE
+        models = self._resident.setdefault(server_id, {})
+        if models.get(model_name, expires_at) <= expires_at:
+            models[model_name] = expires_at
+
+    def forget(self, server_id: int, model_name: str) -> None:
+        models = self._resident.get(server_id, {})
+        for resident in [name for name in models if _name_matches(model_name, name)]:
+            del models[resident]
+
+    async def _poll_server(self, server: BackendServer) -> None:
+        try:
+            response = await backend_pools.client_for(server).get(f"{server.url}/api/ps", timeout=3.0, headers=server.auth_headers)
+            response.raise_for_status()
+            models = response.json().get("models", [])
+        except Exception as e:
+            logger.debug(f"Could not poll running models on '{server.name}': {e}")
+            self._resident.pop(server.id, None)
+            self._reported.pop(server.id, None)
+            return
+
+        self._reported[server.id] = [model for model in models if isinstance(model, dict)]
+        resident = {}
+        fallback_expiry = datetime.datetime.now(datetime.timezone.utc) + DEFAULT_KEEP_ALIVE
+        for model in models:
+            name = model.get("name") or model.get("model")
+            if name:
+                resident[name] = _parse_expires_at(model.get("expires_at")) or fallback_expiry
+        self._resident[server.id] = resident
+
+    async def poll(self) -> None:
+        """Refreshes the resident models of every active Ollama server."""
+        snapshot = await routing_table.get()
+        servers = [s for s in snapshot.servers if s.server_type == "ollama"]
+        await asyncio.gather(*(self._poll_server(server) for server in servers))
+
+        # Drop servers that were removed or deactivated
+        active_ids = {s.id for s in servers}
+        for server_id in [sid for sid in self._resident if sid not in active_ids]:
+            self._resident.pop(server_id, None)
+        for server_id in [sid for sid in self._reported if sid not in active_ids]:
+            self._reported.pop(server_id, None)
+        self.last_poll_at = datetime.datetime.now(datetime.timezone.utc)
+
+    async def running_models(self, max_age_seconds: float) -> List[dict]:
+        """
+        The loaded models of every Ollama server, as they reported them, from
+        a poll at most `max_age_seconds` old. Concurrent callers share a poll.
+        """
+        def fresh() -> bool:
+            if self.last_poll_at is None:
+                return False
+            age = datetime.datetime.now(datetime.timezone.utc) - self.last_poll_at
+            return age.total_seconds() < max_age_seconds
+
+        if not fresh():
+            async with self._poll_lock:
+                if not fresh():
+                    await self.poll()
+        return [model for models in self._reported.values() for model in models]
+
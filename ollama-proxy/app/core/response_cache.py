@@ -0,0 +1,228 @@
+"""
+Caching and coalescing of deterministic /api/generate and /api/chat calls.
+
+A request is treated as deterministic when it asks for greedy decoding
+(`options.temperature` 0) or fixes the sampling seed (`options.seed` 0 or
+more). Its key hashes the model digest, the endpoint and the request body
+parsed and re-encoded with sorted keys (`keep_alive` dropped and `stream`
+made explicit), so formatting and field order do not matter.
+
+Identical requests that arrive while one is being generated do not start a
+generation of their own: the first one sends the request upstream in a task
+of its own and every caller, the first included, replays the chunks as they
+arrive. A caller going away therefore does not cut the stream short for the
+others. A response that completed without an error is then kept, up to a
+size limit, and replayed chunk by chunk (as NDJSON when it was streamed)
+until it expires. Replayed responses keep their original `created_at` and
+duration fields.
+"""
+
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import orjson
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+from app.core import metrics
+from app.core.json_scan import JsonMember, member_value
+from app.core.routing_table import BackendServer
+
+logger = logging.getLogger(__name__)
+
+_DONE_RE = re.compile(rb'"done"\s*:\s*true')
+_ERROR_RE = re.compile(rb'(?:^|\n)\s*\{\s*"error"')
+
+# Larger responses are coalesced but not kept
+MAX_ENTRY_BYTES = 1024 * 1024
+
+# Response headers carried over to replays
+REPLAYED_HEADERS = ("content-type", "content-encoding")
+
+# Sends the request upstream: the response and the server it came from
+Sender = Callable[[], Awaitable[Tuple[Response, BackendServer]]]
+
+
+def _is_number(value, predicate) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and predicate(value)
+
+
+def deterministic_key(path: str, digest: str, body: bytes, members: Dict[str, JsonMember]) -> Optional[str]:
+    """The cache key of a generate or chat request whose output is fixed, or None for any other request."""
+    if "options" not in members:
+        return None
+    try:
+        options = member_value(body, members["options"])
+    except ValueError:
+        return None
+    if not isinstance(options, dict):
+        return None
+    greedy = _is_number(options.get("temperature"), lambda t: t == 0)
+    seeded = isinstance(options.get("seed"), int) and _is_number(options["seed"], lambda s: s >= 0)
+    if not (greedy or seeded):
+        return None
+
+    try:
+        request = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return None
+    request.pop("keep_alive", None)
+    request.setdefault("stream", True)
+    normalized = orjson.dumps(request, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(f"{digest}\0{path}\0".encode("utf-8") + normalized, digest_size=20).hexdigest()
+
+
+def _is_complete(body: bytes) -> bool:
+    """True when the final object says done and no object in the body is an error."""
+    return _DONE_RE.search(body[-4096:]) is not None and _ERROR_RE.search(body) is None
+
+
+class _CachedResponse:
+    __slots__ = ("status_code", "headers", "chunks", "streamed", "expires_at")
+
+    def __init__(self, status_code: int, headers: Dict[str, str], chunks: List[bytes], streamed: bool, expires_at: float):
+        self.status_code = status_code
+        self.headers = headers
+        self.chunks = chunks
+        self.streamed = streamed
+        self.expires_at = expires_at
+
+    def response(self) -> Response:
+        if self.streamed:
+            async def replay():
+                for chunk in self.chunks:
+                    yield chunk
+            return StreamingResponse(replay(), status_code=self.status_code, headers=self.headers)
+        return Response(content=b"".join(self.chunks), status_code=self.status_code, headers=self.headers)
+
+
+class _Flight:
+    """One upstream generation and the chunks it has produced so far."""
+
+    def __init__(self):
+        # (status code, headers, streamed, server) once the response has started
+        self.head: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.failed = False
+        self._wakeup = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    def append(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, failed: bool = False) -> None:
+        self.done = True
+        self.failed = failed
+        self._notify()
+
+    async def replay(self):
+        sent = 0
+        while True:
+            while sent < len(self.chunks):
+                yield self.chunks[sent]
+                sent += 1
+            if self.failed:
+                raise RuntimeError("The shared upstream response failed")
+            if self.done:
+                return
+            await self._wakeup.wait()
+
+
+class ResponseCache:
+    """Deterministic responses by request key, with concurrent identical requests sharing one generation."""
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: int = 300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, _CachedResponse]" = OrderedDict()
+        self._flights: Dict[str, _Flight] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def configure(self, max_entries: int, ttl_seconds: int) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def respond(self, key: str, send: Sender) -> Tuple[Response, Optional[BackendServer]]:
+        """
+        The response for `key`: replayed from the cache, joined to the
+        generation already running for it, or generated with `send`. The
+        server is None for a cached response.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                metrics.RESPONSE_CACHE_REQUESTS.labels("hit").inc()
+                return entry.response(), None
+            del self._entries[key]
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            task = asyncio.create_task(self._generate(key, flight, send))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            metrics.RESPONSE_CACHE_REQUESTS.labels("miss").inc()
+        else:
+            metrics.RESPONSE_CACHE_REQUESTS.labels("coalesced").inc()
+
+        # Shielded so that one caller going away does not cancel the others' wait
+        status_code, headers, streamed, server = await asyncio.shield(flight.head)
+        if streamed:
+            return StreamingResponse(flight.replay(), status_code=status_code, headers=headers), server
+        return Response(content=b"".join(flight.chunks), status_code=status_code, headers=headers), server
+
+    async def _generate(self, key: str, flight: _Flight, send: Sender) -> None:
+        try:
+            try:
+                response, server = await send()
+            except Exception as e:
+                flight.head.set_exception(e)
+                flight.head.exception()  # Retrieved here in case every caller has gone away
+                return
+            except BaseException:
+                flight.head.cancel()
+                raise
+
+            streamed = isinstance(response, StreamingResponse)
+            headers = {name: value for name, value in response.headers.items() if name in REPLAYED_HEADERS}
+            if not streamed:
+                flight.chunks.append(bytes(response.body))
+            flight.head.set_result((response.status_code, headers, streamed, server))
+
+            if streamed:
+                try:
+                    async for chunk in response.body_iterator:
+                        flight.append(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+                except Exception as e:
+                    logger.warning(f"Shared response from '{server.name}' failed mid-stream: {type(e).__name__}: {e}")
+                    flight.finish(failed=True)
+                    return
+                finally:
+                    # The response is never sent as is, so run its cleanup here
+                    if response.background is not None:
+                        await response.background()
+            flight.finish()
+
+            body = b"".join(flight.chunks)
+            if response.status_code == 200 and len(body) <= MAX_ENTRY_BYTES and _is_complete(body) and self.max_entries > 0:
+                self._entries[key] = _CachedResponse(
+                    response.status_code, headers, flight.chunks, streamed, time.monotonic() + self.ttl_seconds
+                )
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
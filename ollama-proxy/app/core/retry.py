@@ -1,13 +1,20 @@
 """
 Retry utilities for backend server requests with exponential backoff.
+
+Only failures where the backend cannot have started working on the request
+are retried (see `RETRY_SAFE_EXCEPTIONS`), and retries are limited by a
+token-bucket budget so that a brownout does not multiply the load on the
+servers that are already struggling.
 """
 
 import asyncio
 import logging
 import time
-from typing import Callable, TypeVar, Optional, List
+from typing import Any, Callable, Dict, TypeVar, Optional, List
 from dataclasses import dataclass
 
+import httpx
+
 logger = logging.getLogger(__name__)
 
 T = TypeVar('T')
@@ -30,6 +37,118 @@ class RetryConfig:
             raise ValueError("base_delay_ms must be positive")
 
 
+class BackendUnavailableError(Exception):
+    """The backend answered 503 before sending any body, so nothing was processed."""
+
+
+# Failures that happen before the backend could have done any work on the request
+RETRY_SAFE_EXCEPTIONS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.PoolTimeout,
+    BackendUnavailableError,
+)
+
+
+def is_retry_safe(error: BaseException) -> bool:
+    return isinstance(error, RETRY_SAFE_EXCEPTIONS)
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a fraction of recent successful requests.
+
+    Every success deposits `ratio` tokens and every retry withdraws one. The
+    bucket also refills at `min_per_second` so that a low-traffic deployment can
+    still retry occasionally. The balance is capped at `max_tokens`.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1.0, max_tokens: float = 100.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._refilled_at = time.monotonic()
+        self.retries = 0
+        self.exhausted = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._refilled_at) * self.min_per_second)
+        self._refilled_at = now
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def record_success(self) -> None:
+        self._refill()
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def can_retry(self) -> bool:
+        return self.tokens >= 1.0
+
+    def withdraw(self) -> None:
+        self._refill()
+        self._tokens -= 1.0
+        self.retries += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"tokens": round(self.tokens, 1), "retries": self.retries, "exhausted": self.exhausted}
+
+
+class RetryBudgets:
+    """A global retry budget plus one budget per backend server."""
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.global_budget = RetryBudget(ratio, min_per_second)
+        self._servers: Dict[int, RetryBudget] = {}
+        self.not_retried = 0
+
+    def configure(self, ratio: float, min_per_second: float) -> None:
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        for budget in [self.global_budget, *self._servers.values()]:
+            budget.ratio = ratio
+            budget.min_per_second = min_per_second
+
+    def server(self, server_id: int) -> RetryBudget:
+        budget = self._servers.get(server_id)
+        if budget is None:
+            budget = self._servers[server_id] = RetryBudget(self.ratio, self.min_per_second)
+        return budget
+
+    def record_success(self, server_id: int) -> None:
+        self.global_budget.record_success()
+        self.server(server_id).record_success()
+
+    def try_retry(self, server_id: Optional[int] = None) -> bool:
+        """
+        Takes one retry from the global budget and, if given, the server's budget.
+        Returns False (and counts the exhaustion) when either budget is empty.
+        """
+        budgets = [self.global_budget] if server_id is None else [self.global_budget, self.server(server_id)]
+        empty = [budget for budget in budgets if not budget.can_retry()]
+        if empty:
+            for budget in empty:
+                budget.exhausted += 1
+            return False
+        for budget in budgets:
+            budget.withdraw()
+        return True
+
+    def stats(self, server_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+        ids = server_ids if server_ids is not None else list(self._servers)
+        return {
+            "global": self.global_budget.stats(),
+            "not_retried": self.not_retried,
+            "servers": {server_id: self.server(server_id).stats() for server_id in ids},
+        }
+
+
 @dataclass
 class RetryResult:
     """Result of a retry operation."""
@@ -38,6 +157,7 @@ class RetryResult:
     attempts: int = 0
     total_duration_ms: float = 0.0
     errors: List[str] = None
+    budget_exhausted: bool = False
 
     def __post_init__(self):
         if self.errors is None:
@@ -50,6 +170,7 @@ async def retry_with_backoff(
     config: RetryConfig,
     retry_on_exceptions: tuple = (Exception,),
     operation_name: str = "operation",
+    should_retry: Optional[Callable[[], bool]] = None,
     **kwargs
 ) -> RetryResult:
     """
@@ -59,8 +180,11 @@ async def retry_with_backoff(
         func: Async function to execute
         *args: Positional arguments to pass to func
         config: Retry configuration
-        retry_on_exceptions: Tuple of exception types to retry on
+        retry_on_exceptions: Tuple of exception types to retry on; any other
+            exception propagates to the caller immediately
         operation_name: Name of the operation for logging
+        should_retry: Called before each retry; returning False stops retrying
+            (used for retry budgets)
         **kwargs: Keyword arguments to pass to func
 
     Returns:
@@ -74,6 +198,7 @@ async def retry_with_backoff(
     start_time = time.time()
     errors = []
     attempt = 0
+    budget_exhausted = False
 
     for attempt in range(config.max_retries + 1):
         # Check if we've exceeded the total timeout budget
@@ -136,6 +261,11 @@ async def retry_with_backoff(
                     )
                     break
 
+                if should_retry is not None and not should_retry():
+                    logger.warning(f"{operation_name}: Retry budget exhausted, not retrying")
+                    budget_exhausted = True
+                    break
+
                 # Cap the delay to remaining time
                 actual_delay = min(delay_seconds, remaining_time)
 
@@ -158,7 +288,8 @@ async def retry_with_backoff(
         result=None,
         attempts=attempt + 1,
         total_duration_ms=total_duration_ms,
-        errors=errors
+        errors=errors,
+        budget_exhausted=budget_exhausted
     )
 
 
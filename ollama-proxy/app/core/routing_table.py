@@ -0,0 +1,253 @@
+"""
+Process-local routing snapshot of the active backend servers.
+
+The proxy used to load every server from the database twice per request and
+walk each server's model list to find candidates. The snapshot is built once
+whenever models are refreshed or servers are edited (and at least every
+`MAX_AGE_SECONDS` as a safety net for changes made by other workers without
+Redis). It holds an index from model names to candidate servers and each
+server's auth headers, already decrypted, as well as the federated
+/api/tags response, encoded once with its ETag.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+from sqlalchemy.future import select
+
+from app.core.connection_pools import backend_pools
+from app.core.encryption import decrypt_data
+from app.core.invalidation_bus import invalidation_bus
+from app.database.models import OllamaServer
+from app.database.session import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "servers"
+MAX_AGE_SECONDS = 60.0
+MAX_MEMOIZED_LOOKUPS = 4096
+
+# Listed in /api/tags so clients can pick it; the proxy chooses the real model
+AUTO_MODEL = {
+    "name": "auto",
+    "model": "auto",
+    "size": 0,
+    "digest": "auto-digest-placeholder",
+    "details": {
+        "parent_model": "",
+        "format": "proxy",
+        "family": "auto",
+        "families": ["auto"],
+        "parameter_size": "N/A",
+        "quantization_level": "N/A"
+    }
+}
+
+
+@dataclass(frozen=True, eq=False)
+class BackendServer:
+    """Immutable, DB-detached view of an active backend server used for routing."""
+    id: int
+    name: str
+    url: str
+    server_type: str
+    auth_headers: Dict[str, str] = field(default_factory=dict)
+    model_names: Tuple[str, ...] = ()
+    model_digests: Dict[str, str] = field(default_factory=dict)
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BackendServer) and other.id == self.id
+
+
+def _parse_models(server: OllamaServer) -> List[dict]:
+    models_list = server.available_models or []
+    if isinstance(models_list, str):
+        try:
+            models_list = json.loads(models_list)
+        except json.JSONDecodeError:
+            logger.warning(f"Could not parse available_models JSON for server {server.name} in routing table")
+            return []
+    if not isinstance(models_list, list):
+        return []
+    return [m for m in models_list if isinstance(m, dict) and "name" in m]
+
+
+def _encode_catalog(models: List[dict]) -> Tuple[bytes, str]:
+    """
+    The /api/tags body for the models of every server (a name listed by
+    several servers appears once, as the last of them lists it) and its ETag.
+    """
+    all_models = {}
+    for model in models:
+        all_models[model["name"]] = model if "model" in model else {**model, "model": model["name"]}
+
+    # Dated like the newest real model so the body only changes with the catalog
+    newest = max((str(m.get("modified_at") or "") for m in all_models.values()), default="")
+    all_models["auto"] = {**AUTO_MODEL, "modified_at": newest or "1970-01-01T00:00:00Z"}
+
+    body = orjson.dumps({"models": list(all_models.values())})
+    return body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+class RoutingSnapshot:
+    """
+    Immutable routing view. Model lookups use the same flexible matching as
+    before: exact name, `name:` prefix (e.g. "llama3" matches "llama3:8b") and,
+    for vLLM servers only, substring aliases.
+    """
+
+    def __init__(self, servers: List[BackendServer], catalog: Optional[List[dict]] = None):
+        self.servers = servers
+        self.tags_body, self.tags_etag = _encode_catalog(catalog or [])
+        self._order = {server.id: position for position, server in enumerate(servers)}
+        self._exact: Dict[str, List[BackendServer]] = {}
+        self._prefix: Dict[str, List[BackendServer]] = {}
+        self._vllm_models: List[Tuple[str, BackendServer]] = []
+        self._memo: Dict[str, List[BackendServer]] = {}
+
+        for server in servers:
+            for model_name in server.model_names:
+                self._add(self._exact, model_name, server)
+                # Every "<prefix>:" of the name is a valid short form
+                position = model_name.find(":")
+                while position != -1:
+                    self._add(self._prefix, model_name[:position], server)
+                    position = model_name.find(":", position + 1)
+                if server.server_type == "vllm":
+                    self._vllm_models.append((model_name, server))
+
+    @staticmethod
+    def _add(index: Dict[str, List[BackendServer]], key: str, server: BackendServer) -> None:
+        servers = index.setdefault(key, [])
+        if server not in servers:
+            servers.append(server)
+
+    @property
+    def all_model_names(self) -> List[str]:
+        return sorted(self._exact.keys())
+
+    def knows_model(self, model_name: str) -> bool:
+        """Whether a server lists `model_name` by its full name or a `name:` prefix (no vLLM aliases)."""
+        return model_name in self._exact or model_name in self._prefix
+
+    def servers_for_model(self, model_name: str) -> List[BackendServer]:
+        """Returns the active servers hosting `model_name`, in server-list order."""
+        cached = self._memo.get(model_name)
+        if cached is not None:
+            return cached
+
+        candidates = set(self._exact.get(model_name, ()))
+        candidates.update(self._prefix.get(model_name, ()))
+        for available_name, server in self._vllm_models:
+            if model_name in available_name:
+                candidates.add(server)
+
+        result = sorted(candidates, key=lambda s: self._order[s.id])
+        if len(self._memo) < MAX_MEMOIZED_LOOKUPS:
+            self._memo[model_name] = result
+        return result
+
+    def model_digest(self, model_name: str) -> Optional[str]:
+        """
+        The digest of the model weights `model_name` resolves to, or None when
+        a server hosting it does not report one or the servers disagree (e.g. "llama3"
+        naming both llama3:8b and llama3:70b). Callers cache by this digest, so
+        None means "do not cache".
+        """
+        digests = set()
+        for server in self.servers_for_model(model_name):
+            if server.server_type == "vllm":
+                # vLLM reports no digest: the model id stands in for one and stays
+                # the same when different weights are served under it
+                digests.add(None)
+                continue
+            matching = [
+                server.model_digests.get(available_name)
+                for available_name in server.model_names
+                if available_name == model_name or available_name.startswith(f"{model_name}:")
+            ]
+            digests.update(matching or [None])
+        return digests.pop() if len(digests) == 1 and None not in digests else None
+
+
+async def build_snapshot() -> RoutingSnapshot:
+    """Loads the active servers and builds a fresh snapshot."""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(OllamaServer).order_by(OllamaServer.created_at.desc()))
+        db_servers = [s for s in result.scalars().all() if s.is_active]
+
+        servers = []
+        catalog = []
+        for db_server in db_servers:
+            headers = {}
+            if db_server.encrypted_api_key:
+                api_key = decrypt_data(db_server.encrypted_api_key)
+                if api_key:
+                    headers["Authorization"] = f"Bearer {api_key}"
+            models = _parse_models(db_server)
+            catalog.extend(models)
+            servers.append(BackendServer(
+                id=db_server.id,
+                name=db_server.name,
+                url=db_server.url.rstrip('/'),
+                server_type=db_server.server_type,
+                auth_headers=headers,
+                model_names=tuple(m["name"] for m in models),
+                model_digests={m["name"]: m["digest"] for m in models if isinstance(m.get("digest"), str) and m["digest"]},
+            ))
+
+    return RoutingSnapshot(servers, catalog)
+
+
+class RoutingTable:
+    """Holds the current snapshot and rebuilds it when it is invalidated or too old."""
+
+    def __init__(self):
+        self._snapshot: Optional[RoutingSnapshot] = None
+        self._built_at = 0.0
+        self._stale = True
+        self._lock = asyncio.Lock()
+
+    def _needs_rebuild(self) -> bool:
+        return self._snapshot is None or self._stale or (time.monotonic() - self._built_at) > MAX_AGE_SECONDS
+
+    async def get(self) -> RoutingSnapshot:
+        if self._needs_rebuild():
+            async with self._lock:
+                if self._needs_rebuild():
+                    await self.rebuild()
+        return self._snapshot
+
+    async def rebuild(self) -> RoutingSnapshot:
+        # Clear the flag first so an invalidation arriving mid-build triggers another rebuild
+        self._stale = False
+        try:
+            snapshot = await build_snapshot()
+        except Exception:
+            self._stale = True
+            raise
+        self._snapshot = snapshot
+        self._built_at = time.monotonic()
+        backend_pools.forget({server.id for server in snapshot.servers})
+        logger.debug(f"Routing table rebuilt with {len(snapshot.servers)} active server(s)")
+        return snapshot
+
+    def invalidate_local(self, _message: str = "") -> None:
+        self._stale = True
+
+    async def invalidate(self) -> None:
+        """Marks the snapshot stale in this process and in every other worker."""
+        await invalidation_bus.publish(INVALIDATION_CHANNEL, "changed")
+
+
+routing_table = RoutingTable()
+invalidation_bus.register(INVALIDATION_CHANNEL, routing_table.invalidate_local, on_reset=routing_table.invalidate_local)
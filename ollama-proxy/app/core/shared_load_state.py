@@ -0,0 +1,149 @@
+"""
+Backend load state shared by every worker and proxy node through Redis.
+
+Each in-flight request is a member of a per-server sorted set, scored by a
+lease expiry, so slots held by a worker that crashed expire on their own
+instead of leaking. Time-to-first-byte averages live in one hash keyed by
+"<server_id>|<model>"; the balancer only writes them for models a server
+lists, and a sorted set of last-update times lets each write drop fields
+that have not been updated for `TTFB_TTL_SECONDS`. Acquire, release and the
+routing read are each a single Lua script, i.e. one round trip.
+"""
+
+import time
+import uuid
+from itertools import count
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+KEY_PREFIX = "ollama_proxy:lb:"
+TTFB_KEY = KEY_PREFIX + "ttfb"
+TTFB_UPDATED_KEY = KEY_PREFIX + "ttfb_updated"
+
+# Upper bound on how long a request may hold a slot (backend read timeout is 600s)
+LEASE_SECONDS = 900
+
+# TTFB averages not updated for this long are dropped (e.g. removed models)
+TTFB_TTL_SECONDS = 86400
+
+# Stale TTFB fields dropped per release, to keep the script's cost bounded
+TTFB_PRUNE_BATCH = 50
+
+# KEYS[1] = in-flight set; ARGV = now, lease expiry, token, key ttl
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# KEYS[1] = in-flight set, KEYS[2] = TTFB hash, KEYS[3] = TTFB update times;
+# ARGV = token, ttfb field, sample ('' if none), alpha, now, ttl, prune batch
+_RELEASE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+if ARGV[3] ~= '' then
+    local sample = tonumber(ARGV[3])
+    local previous = tonumber(redis.call('HGET', KEYS[2], ARGV[2]))
+    local alpha = tonumber(ARGV[4])
+    if previous then
+        sample = alpha * sample + (1 - alpha) * previous
+    end
+    redis.call('HSET', KEYS[2], ARGV[2], tostring(sample))
+
+    local now = tonumber(ARGV[5])
+    local ttl = tonumber(ARGV[6])
+    redis.call('ZADD', KEYS[3], now, ARGV[2])
+    local stale = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now - ttl, 'LIMIT', 0, tonumber(ARGV[7]))
+    if #stale > 0 then
+        redis.call('HDEL', KEYS[2], unpack(stale))
+        redis.call('ZREM', KEYS[3], unpack(stale))
+    end
+    redis.call('EXPIRE', KEYS[2], ttl)
+    redis.call('EXPIRE', KEYS[3], ttl)
+end
+return 1
+"""
+
+# KEYS = in-flight sets followed by the TTFB hash; ARGV = now, then one TTFB field per set
+_READ_SCRIPT = """
+local n = #KEYS - 1
+local result = {}
+for i = 1, n do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', ARGV[1])
+    result[i] = redis.call('ZCARD', KEYS[i])
+    result[n + i] = redis.call('HGET', KEYS[#KEYS], ARGV[i + 1]) or false
+end
+return result
+"""
+
+
+def _in_flight_key(server_id: int) -> str:
+    return f"{KEY_PREFIX}inflight:{server_id}"
+
+
+def _ttfb_field(server_id: int, model: Optional[str]) -> str:
+    return f"{server_id}|{model or ''}"
+
+
+class SharedLoadState:
+    """Cluster-wide in-flight counts and TTFB averages kept in Redis."""
+
+    def __init__(self, redis_client: redis.Redis):
+        self._redis = redis_client
+        self._worker_id = uuid.uuid4().hex[:12]
+        self._token_counter = count()
+        self._acquire = redis_client.register_script(_ACQUIRE_SCRIPT)
+        self._release = redis_client.register_script(_RELEASE_SCRIPT)
+        self._read = redis_client.register_script(_READ_SCRIPT)
+
+    async def acquire(self, server_id: int) -> str:
+        """Takes a slot on the server and returns the token needed to release it."""
+        token = f"{self._worker_id}:{next(self._token_counter)}"
+        now = time.time()
+        await self._acquire(
+            keys=[_in_flight_key(server_id)],
+            args=[now, now + LEASE_SECONDS, token, LEASE_SECONDS],
+        )
+        return token
+
+    async def release(self, server_id: int, token: str, model: Optional[str], ttfb_seconds: Optional[float], alpha: float) -> None:
+        await self._release(
+            keys=[_in_flight_key(server_id), TTFB_KEY, TTFB_UPDATED_KEY],
+            args=[
+                token,
+                _ttfb_field(server_id, model),
+                "" if ttfb_seconds is None else ttfb_seconds,
+                alpha,
+                time.time(),
+                TTFB_TTL_SECONDS,
+                TTFB_PRUNE_BATCH,
+            ],
+        )
+
+    async def read(self, server_ids: List[int], model: Optional[str]) -> Tuple[Dict[int, int], Dict[int, float]]:
+        """Returns cluster-wide in-flight counts and this model's TTFB averages for the servers."""
+        if not server_ids:
+            return {}, {}
+        keys = [_in_flight_key(server_id) for server_id in server_ids] + [TTFB_KEY]
+        args = [time.time()] + [_ttfb_field(server_id, model) for server_id in server_ids]
+        result = await self._read(keys=keys, args=args)
+
+        n = len(server_ids)
+        in_flight = {server_id: int(result[i]) for i, server_id in enumerate(server_ids)}
+        ttfb = {
+            server_id: float(result[n + i])
+            for i, server_id in enumerate(server_ids)
+            if result[n + i] is not None
+        }
+        return in_flight, ttfb
+
+    async def ttfb_by_server(self, server_ids: Iterable[int]) -> Dict[int, List[float]]:
+        """All TTFB averages (across models) for the given servers, for the dashboard."""
+        wanted = {str(server_id) for server_id in server_ids}
+        samples: Dict[int, List[float]] = {}
+        for field, value in (await self._redis.hgetall(TTFB_KEY)).items():
+            server_id, _, _model = field.partition("|")
+            if server_id in wanted:
+                samples.setdefault(int(server_id), []).append(float(value))
+        return samples
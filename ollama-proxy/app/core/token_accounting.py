@@ -0,0 +1,160 @@
+"""
+Token counts and latency telemetry from proxied Ollama responses.
+
+Ollama reports `prompt_eval_count`, `eval_count` and `eval_duration` in the
+last object of a response, streamed or not. The tap passes every body chunk
+through untouched and only keeps the last `TAIL_BYTES` of the body; once
+the body is done, the counters are read from that tail with a byte regex.
+Until the first token has been seen, each chunk is also checked for a
+non-empty `response`, `message.content` or `thinking` value. Nothing is
+parsed or re-serialized, so the cost per chunk is a bounded slice.
+
+Timestamps are `time.perf_counter()` values: when the handler received the
+request, when it was sent upstream, the first body byte, the first token
+and the end of the stream.
+"""
+
+import re
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+# The counters come after `context` and the durations in the final object
+TAIL_BYTES = 1024
+
+_COUNTER_RE = re.compile(rb'"(prompt_eval_count|eval_count|eval_duration)"\s*:\s*(\d+)')
+_CONTENT_RE = re.compile(rb'"(?:response|content|thinking)"\s*:\s*"[^"]')
+
+
+@dataclass
+class RequestTimings:
+    """Points in a proxied request's life, filled in as they happen."""
+    received_at: float
+    upstream_at: Optional[float] = None
+    first_byte_at: Optional[float] = None
+    first_token_at: Optional[float] = None
+    ended_at: Optional[float] = None
+
+
+@dataclass
+class ResponseUsage:
+    """What the tap learned about a response once its body was done."""
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    eval_duration_ns: Optional[int] = None
+
+    def telemetry(self, timings: RequestTimings) -> dict:
+        """Usage-log latency fields in milliseconds, plus generation speed."""
+        def ms(start: Optional[float], end: Optional[float]) -> Optional[int]:
+            return round((end - start) * 1000) if start is not None and end is not None else None
+
+        tokens_per_second = None
+        if self.completion_tokens:
+            if self.eval_duration_ns:
+                tokens_per_second = self.completion_tokens / (self.eval_duration_ns / 1e9)
+            elif timings.first_token_at is not None and timings.ended_at > timings.first_token_at:
+                tokens_per_second = self.completion_tokens / (timings.ended_at - timings.first_token_at)
+
+        return {
+            "queue_ms": ms(timings.received_at, timings.upstream_at),
+            "ttfb_ms": ms(timings.upstream_at, timings.first_byte_at),
+            "ttft_ms": ms(timings.received_at, timings.first_token_at),
+            "total_ms": ms(timings.received_at, timings.ended_at),
+            "tokens_per_second": round(tokens_per_second, 2) if tokens_per_second is not None else None,
+        }
+
+
+class TokenCounter:
+    """Keeps the tail of a response body and reads Ollama's token counters from it."""
+
+    def __init__(self):
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> None:
+        if len(chunk) >= TAIL_BYTES:
+            self._tail = chunk[-TAIL_BYTES:]
+        else:
+            self._tail = (self._tail + chunk)[-TAIL_BYTES:]
+
+    def usage(self) -> ResponseUsage:
+        """Counters from the last final object seen; fields are None if absent."""
+        found = {}
+        for match in _COUNTER_RE.finditer(self._tail):
+            found[match.group(1)] = int(match.group(2))
+        return ResponseUsage(
+            prompt_tokens=found.get(b"prompt_eval_count"),
+            completion_tokens=found.get(b"eval_count"),
+            eval_duration_ns=found.get(b"eval_duration"),
+        )
+
+
+async def tap_response_usage(
+    response: Response,
+    timings: RequestTimings,
+    on_complete: Callable[[ResponseUsage], Awaitable[None]],
+) -> Response:
+    """
+    Calls `on_complete(usage)` exactly once when the response body has been
+    sent (or the client went away), without altering the body, and fills in
+    the first-byte, first-token and end timestamps of `timings` along the way.
+    Responses that are not streamed are complete already, so it is called right away.
+
+    Like the in-flight tracking, completion also runs from the response's
+    background hook, so a client that disconnects before the body is iterated
+    is still accounted for. `on_complete` should do its synchronous work
+    (queuing the usage log) before its first await.
+    """
+    counter = TokenCounter()
+
+    if not isinstance(response, StreamingResponse):
+        body = bytes(response.body or b"")
+        counter.feed(body)
+        timings.first_byte_at = timings.ended_at = time.perf_counter()
+        if _CONTENT_RE.search(body):
+            timings.first_token_at = timings.first_byte_at
+        await on_complete(counter.usage())
+        return response
+
+    completed = False
+
+    async def complete() -> None:
+        nonlocal completed
+        if completed:
+            return
+        completed = True
+        if timings.ended_at is None:
+            timings.ended_at = time.perf_counter()
+        await on_complete(counter.usage())
+
+    body_iterator = response.body_iterator
+
+    async def tapped_body():
+        try:
+            async for chunk in body_iterator:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                if timings.first_byte_at is None:
+                    timings.first_byte_at = time.perf_counter()
+                if timings.first_token_at is None and _CONTENT_RE.search(chunk):
+                    timings.first_token_at = time.perf_counter()
+                counter.feed(chunk)
+                yield chunk
+        finally:
+            await complete()
+
+    previous_background = response.background
+
+    async def background() -> None:
+        try:
+            await complete()
+        finally:
+            if previous_background is not None:
+                await previous_background()
+
+    response.body_iterator = tapped_body()
+    response.background = BackgroundTask(background)
+    return response
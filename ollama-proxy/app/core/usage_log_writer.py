@@ -0,0 +1,208 @@
+"""
+Background writer that batches usage-log rows.
+
+Proxied requests enqueue their usage record in memory instead of committing
+one row each. A single writer task per worker flushes the queue with one
+multi-row INSERT every `batch_size` rows or `flush_interval_ms` milliseconds,
+whichever comes first, and drains what is left on shutdown. A batch whose
+write fails (a locked database, a dropped connection) is retried with backoff
+before its rows are given up on.
+"""
+
+import asyncio
+import datetime
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from app.core import metrics
+from app.database.session import AsyncSessionLocal
+from app.crud import log_crud
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Delays before retrying a failed flush; the rows are lost once they run out
+FLUSH_RETRY_DELAYS = (0.5, 2.0, 5.0)
+
+
+class UsageLogWriter:
+    """Bounded in-memory queue of usage records flushed in bulk by a writer task."""
+
+    def __init__(
+        self,
+        batch_size: int = 200,
+        flush_interval_ms: int = 500,
+        max_queue_size: int = 10000,
+        enqueue_timeout_seconds: float = 2.0,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval_ms = flush_interval_ms
+        self.enqueue_timeout_seconds = enqueue_timeout_seconds
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._batch_full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+        # Counters exposed on the dashboard
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.rows_failed = 0
+        self.flush_count = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops accepting records and waits until everything queued is written."""
+        if self._task is None:
+            return
+        self._closed = True
+        await self._queue.put(_STOP)
+        self._batch_full.set()
+        await self._task
+        self._task = None
+
+    @staticmethod
+    def _record(
+        *,
+        api_key_id: int,
+        endpoint: str,
+        status_code: int,
+        server_id: Optional[int],
+        model: Optional[str] = None,
+        **extra: Any,
+    ) -> Dict[str, Any]:
+        return {
+            "api_key_id": api_key_id,
+            "endpoint": endpoint,
+            "status_code": status_code,
+            "server_id": server_id,
+            "model": model,
+            "request_timestamp": datetime.datetime.utcnow(),
+            **extra,
+        }
+
+    def enqueue_nowait(self, **fields: Any) -> bool:
+        """
+        Queues a usage record without awaiting anything, so it cannot be lost to
+        a cancellation. Returns False, without queuing it, if the queue is full.
+        """
+        if self._closed:
+            logger.warning(f"Usage log writer is stopped; dropping log for {fields.get('endpoint')}")
+            self.rows_dropped += 1
+            return True
+        try:
+            self._queue.put_nowait(self._record(**fields))
+        except asyncio.QueueFull:
+            return False
+        self._queued()
+        return True
+
+    async def enqueue(self, **fields: Any) -> None:
+        """
+        Queues a usage record. Waits for room when the queue is full
+        (backpressure) and drops the record if none frees up in time.
+        """
+        if self.enqueue_nowait(**fields):
+            return
+        try:
+            await asyncio.wait_for(self._queue.put(self._record(**fields)), timeout=self.enqueue_timeout_seconds)
+        except asyncio.TimeoutError:
+            self.rows_dropped += 1
+            logger.warning(
+                f"Usage log queue full ({self._queue.maxsize} rows) for "
+                f"{self.enqueue_timeout_seconds}s; dropping log for {fields.get('endpoint')}"
+            )
+            return
+        self._queued()
+
+    def _queued(self) -> None:
+        metrics.USAGE_LOG_QUEUE_DEPTH.set(self._queue.qsize())
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_full.set()
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            batch: List[Dict[str, Any]] = []
+            if first is _STOP:
+                stopping = True
+            else:
+                batch.append(first)
+
+            # Give the batch time to fill up unless it is already full
+            if not stopping and self._queue.qsize() + 1 < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), timeout=self.flush_interval_ms / 1000)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_full.clear()
+
+            while len(batch) < self.batch_size and not self._queue.empty():
+                record = self._queue.get_nowait()
+                if record is _STOP:
+                    stopping = True
+                    continue
+                batch.append(record)
+
+            metrics.USAGE_LOG_QUEUE_DEPTH.set(self._queue.qsize())
+            if batch:
+                await self._flush(batch)
+
+        # Drain anything enqueued concurrently with shutdown
+        while not self._queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                record = self._queue.get_nowait()
+                if record is not _STOP:
+                    batch.append(record)
+            if batch:
+                await self._flush(batch)
+
+        logger.info(f"Usage log writer stopped after writing {self.rows_written} rows")
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        started = time.perf_counter()
+        for attempt, delay in enumerate((*FLUSH_RETRY_DELAYS, None), start=1):
+            try:
+                async with AsyncSessionLocal() as db:
+                    await log_crud.bulk_create_usage_logs(db, batch)
+                self.rows_written += len(batch)
+                break
+            except Exception as e:
+                if delay is None:
+                    self.rows_failed += len(batch)
+                    logger.error(f"Failed to write {len(batch)} usage log rows after {attempt} attempts: {e}", exc_info=True)
+                    break
+                logger.warning(f"Failed to write {len(batch)} usage log rows (attempt {attempt}), retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.flush_count += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self._total_flush_ms += elapsed_ms
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue_depth,
+            "queue_capacity": self._queue.maxsize,
+            "rows_written": self.rows_written,
+            "rows_dropped": self.rows_dropped,
+            "rows_failed": self.rows_failed,
+            "flush_count": self.flush_count,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "avg_flush_ms": round(self._total_flush_ms / self.flush_count, 2) if self.flush_count else 0.0,
+        }
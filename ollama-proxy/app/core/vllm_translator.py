@@ -1,9 +1,11 @@
 import json
 import logging
-from typing import Dict, Any, AsyncGenerator
+from typing import Dict, Any, AsyncGenerator, List, Optional, Tuple
 import time
 from datetime import datetime, timezone
 
+import orjson
+
 logger = logging.getLogger(__name__)
 
 # --- Constants for Chain-of-Thought ---
@@ -28,12 +30,58 @@ THINK_TOOL = {
     },
 }
 
+# Ollama `options` that have an OpenAI sampling parameter
+OPTION_PARAMETERS = {
+    "temperature": "temperature",
+    "top_p": "top_p",
+    "top_k": "top_k",
+    "min_p": "min_p",
+    "seed": "seed",
+    "stop": "stop",
+    "num_predict": "max_tokens",
+    "presence_penalty": "presence_penalty",
+    "frequency_penalty": "frequency_penalty",
+    "repeat_penalty": "repetition_penalty",
+}
+
+# OpenAI finish reasons as Ollama's done_reason
+DONE_REASONS = {"stop": "stop", "length": "length", "tool_calls": "stop"}
+
+
 # --- Request Translation ---
-def translate_ollama_to_vllm_chat(ollama_payload: Dict[str, Any]) -> Dict[str, Any]:
+def _base_vllm_payload(ollama_payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Model, streaming (on by default, as in Ollama), sampling options and output format."""
     vllm_payload = {
         "model": ollama_payload.get("model"),
-        "stream": ollama_payload.get("stream", False),
+        "stream": ollama_payload.get("stream", True) is not False,
     }
+    if vllm_payload["stream"]:
+        # Ask for a final usage chunk so the done message carries real token counts
+        vllm_payload["stream_options"] = {"include_usage": True}
+
+    options = ollama_payload.get("options") or {}
+    for option, parameter in OPTION_PARAMETERS.items():
+        if options.get(option) is not None:
+            vllm_payload[parameter] = options[option]
+    if vllm_payload.get("max_tokens") is not None and vllm_payload["max_tokens"] < 0:
+        # -1 means "no limit" in Ollama
+        del vllm_payload["max_tokens"]
+
+    output_format = ollama_payload.get("format")
+    if output_format == "json":
+        vllm_payload["response_format"] = {"type": "json_object"}
+    elif isinstance(output_format, dict):
+        vllm_payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "response", "schema": output_format},
+        }
+    return vllm_payload
+
+
+def translate_ollama_to_vllm_chat(ollama_payload: Dict[str, Any]) -> Dict[str, Any]:
+    vllm_payload = _base_vllm_payload(ollama_payload)
+    if ollama_payload.get("tools"):
+        vllm_payload["tools"] = ollama_payload["tools"]
     
     messages = ollama_payload.get("messages", [])
     
@@ -60,8 +108,8 @@ def translate_ollama_to_vllm_chat(ollama_payload: Dict[str, Any]) -> Dict[str, A
     # Translate image format if present
     for message in vllm_payload["messages"]:
         if "images" in message and isinstance(message["images"], list):
-            if message.get("content") and isinstance(message["content"], str):
-                new_content = [{"type": "text", "text": message["content"]}]
+            if isinstance(message.get("content") or "", str):
+                new_content = [{"type": "text", "text": message["content"]}] if message.get("content") else []
                 for img_b64 in message["images"]:
                     new_content.append({
                         "type": "image_url",
@@ -69,150 +117,320 @@ def translate_ollama_to_vllm_chat(ollama_payload: Dict[str, Any]) -> Dict[str, A
                     })
                 message["content"] = new_content
             del message["images"]
-            
+
+    # Tool call arguments come back from Ollama clients as objects; OpenAI wants JSON strings
+    for message in vllm_payload["messages"]:
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function") or {}
+            if isinstance(function.get("arguments"), dict):
+                function["arguments"] = json.dumps(function["arguments"])
+
     return vllm_payload
 
+def translate_ollama_to_vllm_generate(ollama_payload: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Returns the vLLM path and payload for /api/generate. A raw prompt goes to
+    the completions endpoint as is; otherwise the prompt, system prompt and
+    images become a chat, so the model's chat template is applied as in Ollama.
+    """
+    prompt = ollama_payload.get("prompt") or ""
+    if ollama_payload.get("raw"):
+        vllm_payload = _base_vllm_payload(ollama_payload)
+        vllm_payload["prompt"] = prompt
+        return "v1/completions", vllm_payload
+
+    messages = []
+    if ollama_payload.get("system"):
+        messages.append({"role": "system", "content": ollama_payload["system"]})
+    user_message: Dict[str, Any] = {"role": "user", "content": prompt}
+    if ollama_payload.get("images"):
+        user_message["images"] = ollama_payload["images"]
+    messages.append(user_message)
+
+    return "v1/chat/completions", translate_ollama_to_vllm_chat({**ollama_payload, "messages": messages})
+
 def translate_ollama_to_vllm_embeddings(ollama_payload: Dict[str, Any]) -> Dict[str, Any]:
-    return {
+    """/api/embed sends `input` (a string or a list, embedded in one batch); /api/embeddings sends `prompt`."""
+    embed_input = ollama_payload.get("input")
+    if embed_input is None:
+        embed_input = ollama_payload.get("prompt")
+    vllm_payload = {
         "model": ollama_payload.get("model"),
-        "input": ollama_payload.get("prompt"),
+        "input": embed_input,
     }
+    if ollama_payload.get("dimensions"):
+        vllm_payload["dimensions"] = ollama_payload["dimensions"]
+    return vllm_payload
 
 # --- Response Translation ---
-async def vllm_stream_to_ollama_stream(vllm_stream: AsyncGenerator[str, None], model_name: str) -> AsyncGenerator[bytes, None]:
+class _TimestampCache:
+    """ISO 8601 timestamps, formatted once per second rather than once per token."""
+
+    def __init__(self):
+        self._second: int | None = None
+        self._formatted = b""
+
+    def get(self, ts: int | None) -> bytes:
+        second = int(ts if ts is not None else time.time())
+        if second != self._second:
+            self._second = second
+            self._formatted = datetime.fromtimestamp(second, tz=timezone.utc).isoformat().replace("+00:00", "Z").encode()
+        return self._formatted
+
+
+def _sse_events(pending: bytearray, chunk: bytes):
     """
-    Translates a vLLM/OpenAI SSE stream into an Ollama-compatible SSE stream.
-    Handles regular content and tool calls for "thinking".
+    Appends `chunk` to `pending` and returns the payloads of the complete
+    `data:` lines; the trailing partial line stays in `pending`. Only the
+    new bytes are searched for line breaks, so a stream is parsed in
+    linear time however it is split into chunks.
     """
-    tool_call_buffer = ""
-    in_tool_call = False
+    search_from = len(pending)
+    pending += chunk
+    if pending.find(b"\n", search_from) < 0:
+        return []
+
+    events = []
+    line_start = 0
+    while (line_end := pending.find(b"\n", line_start)) >= 0:
+        line = pending[line_start:line_end].strip()
+        line_start = line_end + 1
+        if line.startswith(b"data:"):
+            events.append(line[5:].lstrip())
+    del pending[:line_start]
+    return events
+
+
+async def vllm_stream_to_ollama_stream(
+    vllm_stream: AsyncGenerator[bytes, None], model_name: str, endpoint: str = "chat"
+) -> AsyncGenerator[bytes, None]:
+    """
+    Translates a vLLM/OpenAI SSE stream (chat or completions) into an
+    Ollama-compatible NDJSON stream for /api/chat or, with endpoint="generate",
+    /api/generate.
+
+    Tool calls arrive as argument fragments and are sent on as one chunk
+    with `message.tool_calls` once the model finishes them. A call to the
+    `THINK_TOOL` is shown as its steps between <think> tags instead, and
+    `reasoning_content` deltas become Ollama's `thinking` field.
+
+    Token counts come from the usage chunk vLLM sends when the request asks
+    for `stream_options.include_usage`; without one, each content delta is
+    counted as a token.
+    """
+    # Tool calls being streamed, by index: [name, argument fragments]
+    tool_calls: Dict[int, List[Any]] = {}
     start_time = time.monotonic()
-    total_eval_text = ""
-    buffer = ""
+    pending = bytearray()
+    timestamps = _TimestampCache()
+    usage: Dict[str, Any] = {}
+    content_deltas = 0
+    finish_reason = None
+    is_generate = endpoint == "generate"
+
+    # Every chunk is the same object around its timestamp and content
+    prefix = b'{"model":' + orjson.dumps(model_name) + b',"created_at":"'
+    if is_generate:
+        middle = b'","response":'
+        suffix = b',"done":false}\n'
+    else:
+        middle = b'","message":{"role":"assistant","content":'
+        suffix = b'},"done":false}\n'
+
+    def content_chunk(created_ts: int | None, content: str) -> bytes:
+        return prefix + timestamps.get(created_ts) + middle + orjson.dumps(content) + suffix
 
-    def get_iso_timestamp(ts: int | None) -> str:
-        """Converts a Unix timestamp to an ISO 8601 string, ensuring Z-suffix for UTC."""
-        if ts is None:
-            dt_obj = datetime.now(timezone.utc)
+    def extra_chunk(created_ts: int | None, **fields) -> bytes:
+        """A chunk with empty content and extra message fields (thinking, tool_calls)."""
+        chunk: Dict[str, Any] = {"model": model_name, "created_at": timestamps.get(created_ts).decode()}
+        if is_generate:
+            chunk["response"] = ""
+            chunk.update(fields)
         else:
-            dt_obj = datetime.fromtimestamp(ts, tz=timezone.utc)
-        return dt_obj.isoformat().replace('+00:00', 'Z')
+            chunk["message"] = {"role": "assistant", "content": "", **fields}
+        chunk["done"] = False
+        return orjson.dumps(chunk) + b"\n"
 
-    async for text_chunk in vllm_stream:
-        buffer += text_chunk
-        lines = buffer.split('\n')
-        buffer = lines.pop() # Keep any partial line for the next chunk
+    def flush_tool_calls(created_ts: int | None):
+        calls = [tool_calls[index] for index in sorted(tool_calls)]
+        tool_calls.clear()
+        real_calls = []
+        for name, fragments in calls:
+            arguments = "".join(fragments)
+            if name == THINK_TOOL["function"]["name"]:
+                try:
+                    steps = orjson.loads(arguments).get("steps", [])
+                    thinking_content = "\n".join(steps) if isinstance(steps, list) else str(steps)
+                except (orjson.JSONDecodeError, AttributeError, TypeError) as e:
+                    logger.error(f"Failed to parse think tool arguments: {arguments}. Error: {e}")
+                    continue
+                yield content_chunk(created_ts, "<think>")
+                yield content_chunk(created_ts, thinking_content)
+                yield content_chunk(created_ts, "</think>")
+            else:
+                real_calls.append({"function": {"name": name, "arguments": arguments}})
+        if real_calls:
+            if is_generate:
+                logger.warning(f"Dropping {len(real_calls)} tool call(s): /api/generate responses cannot carry them")
+            else:
+                yield extra_chunk(created_ts, tool_calls=_ollama_tool_calls(real_calls))
 
-        for line in lines:
-            if not line.strip():
-                continue
+    def done_chunk() -> bytes:
+        final_chunk = {
+            "model": model_name,
+            "created_at": timestamps.get(None).decode(),
+            "done": True,
+            "done_reason": DONE_REASONS.get(finish_reason, "stop"),
+            "eval_count": usage.get("completion_tokens", content_deltas),
+            "eval_duration": int((time.monotonic() - start_time) * 1_000_000_000),
+        }
+        if is_generate:
+            final_chunk["response"] = ""
+        else:
+            final_chunk["message"] = {"role": "assistant", "content": ""}
+        if "prompt_tokens" in usage:
+            final_chunk["prompt_eval_count"] = usage["prompt_tokens"]
+        return orjson.dumps(final_chunk) + b"\n"
 
-            if line.strip() == "data: [DONE]":
-                end_time = time.monotonic()
-                eval_duration_ns = (end_time - start_time) * 1_000_000_000
-                eval_count = len(total_eval_text) // 4
-                
-                final_done_chunk = { 
-                    "model": model_name,
-                    "created_at": get_iso_timestamp(None),
-                    "message": {"role": "assistant", "content": ""},
-                    "done": True,
-                    "eval_count": eval_count,
-                    "eval_duration": int(eval_duration_ns)
-                }
-                yield (json.dumps(final_done_chunk) + '\n').encode('utf-8')
-                return # End of stream, stop the generator.
+    async for raw_chunk in vllm_stream:
+        if isinstance(raw_chunk, str):
+            raw_chunk = raw_chunk.encode("utf-8")
 
-            if not line.startswith("data: "):
+        for payload in _sse_events(pending, raw_chunk):
+            if payload == b"[DONE]":
+                for chunk in flush_tool_calls(None):
+                    yield chunk
+                yield done_chunk()
+                return  # End of stream, stop the generator.
+            if not payload:
                 continue
 
             try:
-                data_str = line.lstrip("data: ").strip()
-                if not data_str:
-                    continue
-                
-                data = json.loads(data_str)
-                delta = data.get("choices", [{}])[0].get("delta", {})
-                finish_reason = data.get("choices", [{}])[0].get("finish_reason")
-                created_ts = data.get("created")
-
-                # --- Handle Tool Call for "thinking" ---
-                if "tool_calls" in delta:
-                    if not in_tool_call:
-                        in_tool_call = True
-                        # Yield <think> start tag as a separate message
-                        start_think_chunk = {
-                            "model": model_name, "created_at": get_iso_timestamp(created_ts),
-                            "message": {"role": "assistant", "content": "<think>"}, "done": False
-                        }
-                        yield (json.dumps(start_think_chunk) + '\n').encode('utf-8')
-                    
-                    tool_call_part = delta["tool_calls"][0].get("function", {}).get("arguments", "")
-                    if tool_call_part:
-                        tool_call_buffer += tool_call_part
-                
-                # --- Process completed tool call ---
-                if in_tool_call and finish_reason == "tool_calls":
-                    try:
-                        args = json.loads(tool_call_buffer)
-                        steps = args.get("steps", [])
-                        thinking_content = '\n'.join(steps) if isinstance(steps, list) else str(steps)
-                        total_eval_text += thinking_content
-                        
-                        # Yield the content of the thought
-                        ollama_chunk = {
-                            "model": model_name, "created_at": get_iso_timestamp(created_ts),
-                            "message": {"role": "assistant", "content": thinking_content}, "done": False,
-                        }
-                        yield (json.dumps(ollama_chunk) + '\n').encode('utf-8')
-                        
-                        # Yield the closing </think> tag
-                        end_think_chunk = {
-                            "model": model_name, "created_at": get_iso_timestamp(created_ts),
-                            "message": {"role": "assistant", "content": "</think>"}, "done": False
-                        }
-                        yield (json.dumps(end_think_chunk) + '\n').encode('utf-8')
-                        
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Failed to parse tool call arguments: {tool_call_buffer}. Error: {e}")
-                    
-                    tool_call_buffer = ""
-                    in_tool_call = False
-                    if "content" not in delta or not delta.get("content"):
-                        continue
-
-                # --- Handle regular content ---
-                if content := delta.get("content"):
-                    total_eval_text += content
-                    ollama_chunk = {
-                        "model": model_name, "created_at": get_iso_timestamp(created_ts),
-                        "message": {"role": "assistant", "content": content}, "done": False,
-                    }
-                    yield (json.dumps(ollama_chunk) + '\n').encode('utf-8')
-
-            except (json.JSONDecodeError, IndexError) as e:
-                logger.warning(f"Could not parse VLLM stream chunk: {line}. Error: {e}")
+                data = orjson.loads(payload)
+            except orjson.JSONDecodeError as e:
+                logger.warning(f"Could not parse VLLM stream chunk: {payload[:200]!r}. Error: {e}")
                 continue
-    
+
+            if data.get("usage"):
+                usage = data["usage"]
+            choices = data.get("choices")
+            if not choices:
+                # The usage chunk has no choices
+                continue
+            choice = choices[0]
+            delta = choice.get("delta") or {}
+            finish_reason = choice.get("finish_reason") or finish_reason
+            created_ts = data.get("created")
+
+            if reasoning := delta.get("reasoning_content"):
+                content_deltas += 1
+                yield extra_chunk(created_ts, thinking=reasoning)
+
+            # --- Collect tool call fragments; the name comes with the first one ---
+            for tool_call_delta in delta.get("tool_calls") or []:
+                function = tool_call_delta.get("function") or {}
+                call = tool_calls.setdefault(tool_call_delta.get("index", 0), ["", []])
+                if function.get("name"):
+                    call[0] = function["name"]
+                if function.get("arguments"):
+                    call[1].append(function["arguments"])
+
+            # --- Handle regular content (completions put it in `text`) ---
+            if content := delta.get("content") or choice.get("text"):
+                content_deltas += 1
+                yield content_chunk(created_ts, content)
+
+            if tool_calls and choice.get("finish_reason"):
+                for chunk in flush_tool_calls(created_ts):
+                    yield chunk
+
     # Process any final data left in the buffer. This is a safeguard.
-    if buffer.strip():
-        line = buffer.strip()
-        if line.strip() == "data: [DONE]":
-            end_time = time.monotonic()
-            eval_duration_ns = (end_time - start_time) * 1_000_000_000
-            eval_count = len(total_eval_text) // 4
-            final_done_chunk = { 
-                "model": model_name,
-                "created_at": get_iso_timestamp(None),
-                "message": {"role": "assistant", "content": ""},
-                "done": True,
-                "eval_count": eval_count,
-                "eval_duration": int(eval_duration_ns)
-            }
-            yield (json.dumps(final_done_chunk) + '\n').encode('utf-8')
+    if pending.strip() == b"data: [DONE]":
+        for chunk in flush_tool_calls(None):
+            yield chunk
+        yield done_chunk()
+
+
+def _iso_now() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _ollama_tool_calls(tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """OpenAI tool calls carry their arguments as a JSON string; Ollama's as an object."""
+    translated = []
+    for tool_call in tool_calls:
+        function = tool_call.get("function") or {}
+        arguments = function.get("arguments") or {}
+        if isinstance(arguments, str):
+            try:
+                arguments = json.loads(arguments) if arguments else {}
+            except json.JSONDecodeError:
+                logger.warning(f"Tool call arguments are not valid JSON: {arguments[:200]}")
+        translated.append({"function": {"name": function.get("name"), "arguments": arguments}})
+    return translated
+
+
+def _ollama_final_fields(vllm_payload: Dict[str, Any], finish_reason: Optional[str], total_duration_ns: int) -> Dict[str, Any]:
+    usage = vllm_payload.get("usage") or {}
+    fields = {
+        "done": True,
+        "done_reason": DONE_REASONS.get(finish_reason, "stop"),
+        "total_duration": total_duration_ns,
+    }
+    if usage.get("prompt_tokens") is not None:
+        fields["prompt_eval_count"] = usage["prompt_tokens"]
+    if usage.get("completion_tokens") is not None:
+        fields["eval_count"] = usage["completion_tokens"]
+    return fields
+
+
+def translate_vllm_to_ollama_chat(vllm_payload: Dict[str, Any], model_name: str, total_duration_ns: int) -> Dict[str, Any]:
+    """A non-streaming chat completion as an /api/chat response."""
+    choice = (vllm_payload.get("choices") or [{}])[0]
+    vllm_message = choice.get("message") or {}
+    message: Dict[str, Any] = {"role": "assistant", "content": vllm_message.get("content") or ""}
+    if vllm_message.get("reasoning_content"):
+        message["thinking"] = vllm_message["reasoning_content"]
+    if vllm_message.get("tool_calls"):
+        message["tool_calls"] = _ollama_tool_calls(vllm_message["tool_calls"])
+    return {
+        "model": model_name,
+        "created_at": _iso_now(),
+        "message": message,
+        **_ollama_final_fields(vllm_payload, choice.get("finish_reason"), total_duration_ns),
+    }
+
+
+def translate_vllm_to_ollama_generate(vllm_payload: Dict[str, Any], model_name: str, total_duration_ns: int) -> Dict[str, Any]:
+    """A non-streaming chat or text completion as an /api/generate response."""
+    choice = (vllm_payload.get("choices") or [{}])[0]
+    if "message" in choice:
+        text = (choice.get("message") or {}).get("content") or ""
+    else:
+        text = choice.get("text") or ""
+    return {
+        "model": model_name,
+        "created_at": _iso_now(),
+        "response": text,
+        **_ollama_final_fields(vllm_payload, choice.get("finish_reason"), total_duration_ns),
+    }
 
 
 def translate_vllm_to_ollama_embeddings(vllm_payload: Dict[str, Any]) -> Dict[str, Any]:
     embedding_data = vllm_payload.get("data", [])
     embedding = embedding_data[0].get("embedding") if embedding_data else []
-    return {"embedding": embedding}
\ No newline at end of file
+    return {"embedding": embedding}
+
+
+def translate_vllm_to_ollama_embed(vllm_payload: Dict[str, Any], model_name: str, total_duration_ns: int) -> Dict[str, Any]:
+    """An embeddings response as an /api/embed response, in input order."""
+    data = sorted(vllm_payload.get("data") or [], key=lambda item: item.get("index", 0))
+    response = {
+        "model": model_name,
+        "embeddings": [item.get("embedding") for item in data],
+        "total_duration": total_duration_ns,
+    }
+    usage = vllm_payload.get("usage") or {}
+    if usage.get("prompt_tokens") is not None:
+        response["prompt_eval_count"] = usage["prompt_tokens"]
+    return response
\ No newline at end of file
@@ -7,6 +7,7 @@ from typing import Optional
 
 from app.database.models import APIKey
 from app.core.security import get_api_key_hash
+from app.core.auth_cache import api_key_cache
 
 
 async def get_api_key_by_prefix(db: AsyncSession, prefix: str) -> APIKey | None:
@@ -29,7 +30,10 @@ async def create_api_key(
     user_id: int, 
     key_name: str,
     rate_limit_requests: Optional[int] = None,
-    rate_limit_window_minutes: Optional[int] = None
+    rate_limit_window_minutes: Optional[int] = None,
+    priority_class: str = "interactive",
+    token_limit_per_minute: Optional[int] = None,
+    token_limit_per_day: Optional[int] = None
 ) -> (str, APIKey):
     """
     Generates a new API key, stores its hash, and returns the plain key and the DB object.
@@ -52,7 +56,10 @@ async def create_api_key(
         key_prefix=prefix,
         user_id=user_id,
         rate_limit_requests=rate_limit_requests,
-        rate_limit_window_minutes=rate_limit_window_minutes
+        rate_limit_window_minutes=rate_limit_window_minutes,
+        priority_class=priority_class,
+        token_limit_per_minute=token_limit_per_minute,
+        token_limit_per_day=token_limit_per_day
     )
     db.add(db_api_key)
     await db.commit()
@@ -69,7 +76,10 @@ async def revoke_api_key(db: AsyncSession, key_id: int) -> APIKey | None:
     )
     result = await db.execute(stmt)
     await db.commit()
-    return result.scalars().first()
+    key = result.scalars().first()
+    if key:
+        await api_key_cache.invalidate(key.key_prefix)
+    return key
 
 async def toggle_api_key_active(db: AsyncSession, key_id: int) -> APIKey | None:
     """Toggles the is_active status of an API key."""
@@ -80,6 +90,19 @@ async def toggle_api_key_active(db: AsyncSession, key_id: int) -> APIKey | None:
     key.is_active = not key.is_active
     await db.commit()
     await db.refresh(key)
+    await api_key_cache.invalidate(key.key_prefix)
+    return key
+
+async def set_api_key_priority_class(db: AsyncSession, key_id: int, priority_class: str) -> APIKey | None:
+    """Moves an API key to another admission priority class."""
+    key = await get_api_key_by_id(db, key_id)
+    if not key:
+        return None
+
+    key.priority_class = priority_class
+    await db.commit()
+    await db.refresh(key)
+    await api_key_cache.invalidate(key.key_prefix)
     return key
 
 async def get_api_key_by_name_and_user_id(db: AsyncSession, *, key_name: str, user_id: int) -> APIKey | None:
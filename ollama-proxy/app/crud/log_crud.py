@@ -1,8 +1,15 @@
 # app/crud/log_crud.py
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import func, select, text, Date # <-- Import Date
-from app.database.models import UsageLog, APIKey, User, OllamaServer
+from sqlalchemy import func, select, text, insert, Date # <-- Import Date
+from sqlalchemy.dialects import sqlite, postgresql
+from app.database.models import UsageLog, UsageRollupHourly, APIKey, User, OllamaServer
+from collections import Counter
+from typing import Any, Dict, Iterator, List
 import datetime
+import math
+
+# Shown for requests answered by the proxy itself (cached responses), which have no server
+NO_SERVER_NAME = "(proxy cache)"
 
 async def create_usage_log(
     db: AsyncSession, *, api_key_id: int, endpoint: str, status_code: int, server_id: int | None, model: str | None = None
@@ -15,23 +22,87 @@ async def create_usage_log(
         model=model
     )
     db.add(db_log)
+    await db.flush()
+    await _add_to_rollups(db, [{
+        "request_timestamp": db_log.request_timestamp,
+        "api_key_id": api_key_id,
+        "server_id": server_id,
+        "model": model,
+        "status_code": status_code,
+    }])
     await db.commit()
     await db.refresh(db_log)
     return db_log
 
+# Bound parameters per statement: the limit of SQLite builds before 3.32
+MAX_INSERT_PARAMETERS = 999
+
+def _row_chunks(rows: List[Dict[str, Any]], columns: int) -> Iterator[List[Dict[str, Any]]]:
+    """Splits rows so that each multi-row INSERT stays under MAX_INSERT_PARAMETERS."""
+    size = max(1, MAX_INSERT_PARAMETERS // max(1, columns))
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+async def bulk_create_usage_logs(db: AsyncSession, records: List[Dict[str, Any]]) -> int:
+    """
+    Writes many usage records with as few multi-row INSERTs as the bound-parameter
+    limit allows, in one transaction. Used by the background usage-log writer.
+    """
+    if not records:
+        return 0
+    # A multi-row VALUES clause needs every row to carry the same columns
+    columns = set().union(*(record.keys() for record in records))
+    rows = [{column: record.get(column) for column in columns} for record in records]
+    for chunk in _row_chunks(rows, len(columns)):
+        await db.execute(insert(UsageLog).values(chunk))
+    await _add_to_rollups(db, rows)
+    await db.commit()
+    return len(records)
+
+def _rollup_bucket(record: Dict[str, Any]) -> tuple:
+    """Maps a usage record to its (hour, api_key, server, model, status class) bucket."""
+    timestamp = record.get("request_timestamp") or datetime.datetime.utcnow()
+    return (
+        timestamp.replace(minute=0, second=0, microsecond=0),
+        record["api_key_id"],
+        record.get("server_id") or 0,
+        record.get("model") or "",
+        record["status_code"] // 100,
+    )
+
+async def _add_to_rollups(db: AsyncSession, records: List[Dict[str, Any]]) -> None:
+    """Upserts the per-hour counters for a batch of usage records (caller commits)."""
+    buckets = Counter(_rollup_bucket(record) for record in records)
+    values = [
+        {"hour": hour, "api_key_id": api_key_id, "server_id": server_id,
+         "model": model, "status_class": status_class, "request_count": count}
+        for (hour, api_key_id, server_id, model, status_class), count in buckets.items()
+    ]
+
+    dialect_insert = postgresql.insert if db.bind.dialect.name == "postgresql" else sqlite.insert
+    for chunk in _row_chunks(values, 6):
+        stmt = dialect_insert(UsageRollupHourly).values(chunk)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["hour", "api_key_id", "server_id", "model", "status_class"],
+            set_={"request_count": UsageRollupHourly.request_count + stmt.excluded.request_count},
+        )
+        await db.execute(stmt)
+
 async def get_usage_statistics(db: AsyncSession, sort_by: str = "request_count", sort_order: str = "desc"):
     """
     Returns aggregated usage statistics for all API keys, with sorting.
+    Reads from the hourly rollups rather than the raw usage log.
     """
+    request_count = func.coalesce(func.sum(UsageRollupHourly.request_count), 0)
     sort_column_map = {
         "username": User.username,
         "key_name": APIKey.key_name,
         "key_prefix": APIKey.key_prefix,
-        "request_count": func.count(UsageLog.id),
+        "request_count": request_count,
     }
 
     # Default to request_count if an invalid column is provided for safety
-    sort_column = sort_column_map.get(sort_by, func.count(UsageLog.id))
+    sort_column = sort_column_map.get(sort_by, request_count)
 
     # Determine sort order
     if sort_order.lower() == "asc":
@@ -45,11 +116,11 @@ async def get_usage_statistics(db: AsyncSession, sort_by: str = "request_count",
             APIKey.key_name,
             APIKey.key_prefix,
             APIKey.is_revoked,
-            func.count(UsageLog.id).label("request_count"),
+            request_count.label("request_count"),
         )
         .select_from(APIKey)
         .join(User, APIKey.user_id == User.id)
-        .outerjoin(UsageLog, APIKey.id == UsageLog.api_key_id)
+        .outerjoin(UsageRollupHourly, APIKey.id == UsageRollupHourly.api_key_id)
         .group_by(User.username, APIKey.key_name, APIKey.key_prefix, APIKey.is_revoked)
         .order_by(order_modifier)
     )
@@ -65,15 +136,15 @@ async def get_daily_usage_stats(db: AsyncSession, days: int = 30):
     # --- CRITICAL FIX: Cast the date function output to a Date type ---
     # This ensures that we get a date object back, not just a string,
     # which is required for the strftime formatting in the admin route.
-    date_column = func.date(UsageLog.request_timestamp, type_=Date).label("date")
+    date_column = func.date(UsageRollupHourly.hour, type_=Date).label("date")
     # --- END FIX ---
     
     stmt = (
         select(
             date_column,
-            func.count(UsageLog.id).label("request_count")
+            func.sum(UsageRollupHourly.request_count).label("request_count")
         )
-        .filter(UsageLog.request_timestamp >= start_date)
+        .filter(UsageRollupHourly.hour >= start_date.replace(minute=0, second=0, microsecond=0))
         .group_by(date_column)
         .order_by(date_column.asc())
     )
@@ -83,13 +154,13 @@ async def get_daily_usage_stats(db: AsyncSession, days: int = 30):
 async def get_hourly_usage_stats(db: AsyncSession):
     """Returns total requests aggregated by the hour of the day (UTC)."""
     # This uses strftime which is specific to SQLite.
-    # For PostgreSQL, you would use: func.extract('hour', UsageLog.request_timestamp)
-    hour_extract = func.strftime('%H', UsageLog.request_timestamp)
+    # For PostgreSQL, you would use: func.extract('hour', UsageRollupHourly.hour)
+    hour_extract = func.strftime('%H', UsageRollupHourly.hour)
     
     stmt = (
         select(
             hour_extract.label("hour"),
-            func.count(UsageLog.id).label("request_count")
+            func.sum(UsageRollupHourly.request_count).label("request_count")
         )
         .group_by("hour")
         .order_by("hour")
@@ -101,48 +172,102 @@ async def get_hourly_usage_stats(db: AsyncSession):
 
 async def get_server_load_stats(db: AsyncSession):
     """Returns total requests per backend server."""
+    request_count = func.coalesce(func.sum(UsageRollupHourly.request_count), 0)
     stmt = (
         select(
             OllamaServer.name.label("server_name"),
-            func.count(UsageLog.id).label("request_count")
+            request_count.label("request_count")
         )
         .select_from(OllamaServer)
-        .outerjoin(UsageLog, OllamaServer.id == UsageLog.server_id)
+        .outerjoin(UsageRollupHourly, OllamaServer.id == UsageRollupHourly.server_id)
         .group_by(OllamaServer.name)
-        .order_by(func.count(UsageLog.id).desc())
+        .order_by(request_count.desc())
     )
     result = await db.execute(stmt)
     return result.all()
 
 async def get_model_usage_stats(db: AsyncSession):
     """Returns total requests per model."""
+    request_count = func.sum(UsageRollupHourly.request_count)
     stmt = (
         select(
-            UsageLog.model.label("model_name"),
-            func.count(UsageLog.id).label("request_count")
+            UsageRollupHourly.model.label("model_name"),
+            request_count.label("request_count")
         )
-        .filter(UsageLog.model.isnot(None))
-        .group_by(UsageLog.model)
-        .order_by(func.count(UsageLog.id).desc())
+        .filter(UsageRollupHourly.model != "")
+        .group_by(UsageRollupHourly.model)
+        .order_by(request_count.desc())
     )
     result = await db.execute(stmt)
     return result.all()
 
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def _latency_summary(rows: List[Any]) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"request_count": len(rows)}
+    for field in ("queue_ms", "ttfb_ms", "ttft_ms", "total_ms", "tokens_per_second"):
+        values = sorted(getattr(row, field) for row in rows if getattr(row, field) is not None)
+        summary[field] = {
+            name: (round(_percentile(values, fraction), 1) if values else None)
+            for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+        }
+    return summary
+
+async def get_latency_percentiles(db: AsyncSession, hours: int = 24, max_rows: int = 50000) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Returns p50/p95/p99 of the latency telemetry per server and per model over
+    the last N hours (most recent `max_rows` successful requests at most).
+    SQLite has no percentile function, so they are computed here.
+    """
+    since = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    stmt = (
+        select(
+            func.coalesce(OllamaServer.name, NO_SERVER_NAME).label("server_name"),
+            UsageLog.model,
+            UsageLog.queue_ms,
+            UsageLog.ttfb_ms,
+            UsageLog.ttft_ms,
+            UsageLog.total_ms,
+            UsageLog.tokens_per_second,
+        )
+        .outerjoin(OllamaServer, UsageLog.server_id == OllamaServer.id)
+        .filter(UsageLog.request_timestamp >= since, UsageLog.status_code < 400, UsageLog.total_ms.isnot(None))
+        .order_by(UsageLog.request_timestamp.desc())
+        .limit(max_rows)
+    )
+    rows = (await db.execute(stmt)).all()
+
+    by_server: Dict[str, List[Any]] = {}
+    by_model: Dict[str, List[Any]] = {}
+    for row in rows:
+        by_server.setdefault(row.server_name, []).append(row)
+        if row.model:
+            by_model.setdefault(row.model, []).append(row)
+
+    def summarize(groups: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+        summaries = [dict(_latency_summary(group), name=name) for name, group in groups.items()]
+        return sorted(summaries, key=lambda item: item["request_count"], reverse=True)
+
+    return {"servers": summarize(by_server), "models": summarize(by_model)}
+
 # --- NEW USER-SPECIFIC STATISTICS FUNCTIONS ---
 
 async def get_daily_usage_stats_for_user(db: AsyncSession, user_id: int, days: int = 30):
     """Returns total requests per day for the last N days for a specific user."""
     start_date = datetime.datetime.utcnow() - datetime.timedelta(days=days)
-    date_column = func.date(UsageLog.request_timestamp, type_=Date).label("date")
+    date_column = func.date(UsageRollupHourly.hour, type_=Date).label("date")
     
     stmt = (
         select(
             date_column,
-            func.count(UsageLog.id).label("request_count")
+            func.sum(UsageRollupHourly.request_count).label("request_count")
         )
-        .join(APIKey, UsageLog.api_key_id == APIKey.id)
+        .join(APIKey, UsageRollupHourly.api_key_id == APIKey.id)
         .filter(APIKey.user_id == user_id)
-        .filter(UsageLog.request_timestamp >= start_date)
+        .filter(UsageRollupHourly.hour >= start_date.replace(minute=0, second=0, microsecond=0))
         .group_by(date_column)
         .order_by(date_column.asc())
     )
@@ -151,14 +276,14 @@ async def get_daily_usage_stats_for_user(db: AsyncSession, user_id: int, days: i
 
 async def get_hourly_usage_stats_for_user(db: AsyncSession, user_id: int):
     """Returns total requests aggregated by the hour for a specific user."""
-    hour_extract = func.strftime('%H', UsageLog.request_timestamp)
+    hour_extract = func.strftime('%H', UsageRollupHourly.hour)
     
     stmt = (
         select(
             hour_extract.label("hour"),
-            func.count(UsageLog.id).label("request_count")
+            func.sum(UsageRollupHourly.request_count).label("request_count")
         )
-        .join(APIKey, UsageLog.api_key_id == APIKey.id)
+        .join(APIKey, UsageRollupHourly.api_key_id == APIKey.id)
         .filter(APIKey.user_id == user_id)
         .group_by("hour")
         .order_by("hour")
@@ -169,33 +294,35 @@ async def get_hourly_usage_stats_for_user(db: AsyncSession, user_id: int):
 
 async def get_server_load_stats_for_user(db: AsyncSession, user_id: int):
     """Returns total requests per backend server for a specific user."""
+    request_count = func.sum(UsageRollupHourly.request_count)
     stmt = (
         select(
-            OllamaServer.name.label("server_name"),
-            func.count(UsageLog.id).label("request_count")
+            func.coalesce(OllamaServer.name, NO_SERVER_NAME).label("server_name"),
+            request_count.label("request_count")
         )
-        .select_from(UsageLog)
-        .join(APIKey, UsageLog.api_key_id == APIKey.id)
-        .outerjoin(OllamaServer, UsageLog.server_id == OllamaServer.id)
+        .select_from(UsageRollupHourly)
+        .join(APIKey, UsageRollupHourly.api_key_id == APIKey.id)
+        .outerjoin(OllamaServer, UsageRollupHourly.server_id == OllamaServer.id)
         .filter(APIKey.user_id == user_id)
-        .group_by(OllamaServer.name)
-        .order_by(func.count(UsageLog.id).desc())
+        .group_by("server_name")
+        .order_by(request_count.desc())
     )
     result = await db.execute(stmt)
     return result.all()
 
 async def get_model_usage_stats_for_user(db: AsyncSession, user_id: int):
     """Returns total requests per model for a specific user."""
+    request_count = func.sum(UsageRollupHourly.request_count)
     stmt = (
         select(
-            UsageLog.model.label("model_name"),
-            func.count(UsageLog.id).label("request_count")
+            UsageRollupHourly.model.label("model_name"),
+            request_count.label("request_count")
         )
-        .join(APIKey, UsageLog.api_key_id == APIKey.id)
+        .join(APIKey, UsageRollupHourly.api_key_id == APIKey.id)
         .filter(APIKey.user_id == user_id)
-        .filter(UsageLog.model.isnot(None))
-        .group_by(UsageLog.model)
-        .order_by(func.count(UsageLog.id).desc())
+        .filter(UsageRollupHourly.model != "")
+        .group_by(UsageRollupHourly.model)
+        .order_by(request_count.desc())
     )
     result = await db.execute(stmt)
-    return result.all()
\ No newline at end of file
+    return result.all()
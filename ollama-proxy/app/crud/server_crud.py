@@ -3,6 +3,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.database.models import OllamaServer
 from app.schema.server import ServerCreate, ServerUpdate
 from app.core.encryption import encrypt_data, decrypt_data
+from app.core.routing_table import routing_table
+from app.core.model_info import show_cache
+from app.core.connection_pools import backend_pools
 import httpx
 import logging
 import datetime
@@ -50,6 +53,7 @@ async def create_server(db: AsyncSession, server: ServerCreate) -> OllamaServer:
     db.add(db_server)
     await db.commit()
     await db.refresh(db_server)
+    await routing_table.invalidate()
     return db_server
 
 async def update_server(db: AsyncSession, server_id: int, server_update: ServerUpdate) -> OllamaServer | None:
@@ -76,6 +80,7 @@ async def update_server(db: AsyncSession, server_id: int, server_update: ServerU
             
     await db.commit()
     await db.refresh(db_server)
+    await routing_table.invalidate()
     return db_server
 
 
@@ -85,6 +90,7 @@ async def delete_server(db: AsyncSession, server_id: int) -> OllamaServer | None
     if server:
         await db.delete(server)
         await db.commit()
+        await routing_table.invalidate()
     return server
 
 async def fetch_and_update_models(db: AsyncSession, server_id: int) -> dict:
@@ -102,47 +108,56 @@ async def fetch_and_update_models(db: AsyncSession, server_id: int) -> dict:
 
     try:
         models = []
-        async with httpx.AsyncClient(timeout=10.0, headers=headers) as client:
-            if server.server_type == "vllm":
-                endpoint_url = f"{server.url.rstrip('/')}/v1/models"
-                response = await client.get(endpoint_url)
-                response.raise_for_status()
-                data = response.json()
-                models_data = data.get("data", [])
-                for model in models_data:
-                    model_id = model.get("id")
-                    if not model_id: continue
-                    
-                    family = model_id.split(':')[0].split('-')[0] # Best guess for family
-
-                    models.append({
-                        "name": model_id,
-                        "size": 0,  # Not available from vLLM API
-                        "modified_at": datetime.datetime.fromtimestamp(
-                            model.get("created", 0), tz=datetime.timezone.utc
-                        ).isoformat(),
-                        "digest": model_id, # Use ID as a stand-in for digest
-                        "details": {
-                            "parent_model": "",
-                            "format": "vllm",
-                            "family": family,
-                            "families": [family] if family else None,
-                            "parameter_size": "N/A",
-                            "quantization_level": "N/A"
-                        }
-                    })
-            else:  # Default to "ollama"
-                endpoint_url = f"{server.url.rstrip('/')}/api/tags"
-                response = await client.get(endpoint_url)
-                response.raise_for_status()
-                data = response.json()
-                models = data.get("models", [])
+        client = backend_pools.client_for(server)
+        if server.server_type == "vllm":
+            endpoint_url = f"{server.url.rstrip('/')}/v1/models"
+            response = await client.get(endpoint_url, headers=headers, timeout=10.0)
+            response.raise_for_status()
+            data = response.json()
+            models_data = data.get("data", [])
+            for model in models_data:
+                model_id = model.get("id")
+                if not model_id: continue
+                
+                family = model_id.split(':')[0].split('-')[0] # Best guess for family
+
+                models.append({
+                    "name": model_id,
+                    "size": 0,  # Not available from vLLM API
+                    "modified_at": datetime.datetime.fromtimestamp(
+                        model.get("created", 0), tz=datetime.timezone.utc
+                    ).isoformat(),
+                    "digest": model_id, # Use ID as a stand-in for digest
+                    "details": {
+                        "parent_model": "",
+                        "format": "vllm",
+                        "family": family,
+                        "families": [family] if family else None,
+                        "parameter_size": "N/A",
+                        "quantization_level": "N/A"
+                    }
+                })
+        else:  # Default to "ollama"
+            endpoint_url = f"{server.url.rstrip('/')}/api/tags"
+            response = await client.get(endpoint_url, headers=headers, timeout=10.0)
+            response.raise_for_status()
+            data = response.json()
+            models = data.get("models", [])
+
+            # Cache /api/show for models not seen before, so clients asking about them get an instant answer
+            try:
+                added = await show_cache.warm(client, server.url.rstrip('/'), headers, models)
+                if added:
+                    logger.info(f"Cached /api/show for {added} new model(s) on '{server.name}'")
+            except Exception as e:
+                logger.warning(f"Could not cache /api/show for models on '{server.name}': {e}")
         
         server.available_models = models
         server.models_last_updated = datetime.datetime.utcnow()
         server.last_error = None
         await db.commit()
         await db.refresh(server)
+        await routing_table.invalidate()
 
         logger.info(f"Successfully fetched {len(models)} models from {server.server_type} server '{server.name}'")
         return {"success": True, "models": models, "error": None}
@@ -153,6 +168,7 @@ async def fetch_and_update_models(db: AsyncSession, server_id: int) -> dict:
         server.last_error = error_msg
         server.available_models = None
         await db.commit()
+        await routing_table.invalidate()
         return {"success": False, "error": error_msg, "models": []}
     except Exception as e:
         error_msg = f"Unexpected error: {str(e)}"
@@ -160,6 +176,7 @@ async def fetch_and_update_models(db: AsyncSession, server_id: int) -> dict:
         server.last_error = error_msg
         server.available_models = None
         await db.commit()
+        await routing_table.invalidate()
         return {"success": False, "error": error_msg, "models": []}
 
 
@@ -4,6 +4,7 @@ from sqlalchemy import func
 from app.database.models import User, APIKey, UsageLog
 from app.schema.user import UserCreate
 from app.core.security import get_password_hash
+from app.core.auth_cache import api_key_cache
 from typing import Optional
 
 
@@ -104,6 +105,10 @@ async def update_user(db: AsyncSession, user_id: int, username: str, password: O
 async def delete_user(db: AsyncSession, user_id: int) -> User | None:
     user = await get_user_by_id(db, user_id=user_id)
     if user:
+        result = await db.execute(select(APIKey.key_prefix).filter(APIKey.user_id == user_id))
+        key_prefixes = result.scalars().all()
         await db.delete(user)
         await db.commit()
+        for prefix in key_prefixes:
+            await api_key_cache.invalidate(prefix)
     return user
\ No newline at end of file
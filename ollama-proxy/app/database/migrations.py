@@ -153,6 +153,30 @@ async def migrate_api_keys_table(engine: AsyncEngine) -> None:
         "INTEGER"
     )
 
+    # Add token_limit_per_minute column if missing
+    await add_column_if_missing(
+        engine,
+        "api_keys",
+        "token_limit_per_minute",
+        "INTEGER"
+    )
+
+    # Add token_limit_per_day column if missing
+    await add_column_if_missing(
+        engine,
+        "api_keys",
+        "token_limit_per_day",
+        "INTEGER"
+    )
+
+    # Add priority_class column if missing
+    await add_column_if_missing(
+        engine,
+        "api_keys",
+        "priority_class",
+        "VARCHAR DEFAULT 'interactive' NOT NULL"
+    )
+
     logger.info("api_keys table migration complete")
 
 
@@ -182,6 +206,30 @@ async def migrate_usage_logs_table(engine: AsyncEngine) -> None:
         "VARCHAR"
     )
 
+    # Add token count columns if missing
+    await add_column_if_missing(
+        engine,
+        "usage_logs",
+        "prompt_tokens",
+        "INTEGER"
+    )
+    await add_column_if_missing(
+        engine,
+        "usage_logs",
+        "completion_tokens",
+        "INTEGER"
+    )
+
+    # Add latency telemetry columns if missing
+    for column, column_type in (
+        ("queue_ms", "INTEGER"),
+        ("ttfb_ms", "INTEGER"),
+        ("ttft_ms", "INTEGER"),
+        ("total_ms", "INTEGER"),
+        ("tokens_per_second", "FLOAT"),
+    ):
+        await add_column_if_missing(engine, "usage_logs", column, column_type)
+
     # Create index on model column if it doesn't exist
     # Note: SQLite will silently ignore if index already exists
     async with engine.begin() as conn:
@@ -387,10 +435,20 @@ async def run_all_migrations(engine: AsyncEngine) -> None:
                 "is_revoked": "BOOLEAN DEFAULT 0 NOT NULL",
                 "rate_limit_requests": "INTEGER",
                 "rate_limit_window_minutes": "INTEGER",
+                "priority_class": "VARCHAR DEFAULT 'interactive' NOT NULL",
+                "token_limit_per_minute": "INTEGER",
+                "token_limit_per_day": "INTEGER",
             },
             "usage_logs": {
                 "model": "VARCHAR",
                 "server_id": "INTEGER",
+                "prompt_tokens": "INTEGER",
+                "completion_tokens": "INTEGER",
+                "queue_ms": "INTEGER",
+                "ttfb_ms": "INTEGER",
+                "ttft_ms": "INTEGER",
+                "total_ms": "INTEGER",
+                "tokens_per_second": "FLOAT",
             },
             "model_metadata": {
                 "id": "INTEGER NOT NULL PRIMARY KEY",
@@ -433,6 +491,38 @@ async def run_all_migrations(engine: AsyncEngine) -> None:
         raise
 
 
+async def backfill_usage_rollups(engine: AsyncEngine) -> None:
+    """
+    Populates usage_rollups_hourly from the raw usage_logs the first time the
+    rollup table is created on a database that already has history.
+    Must run after Base.metadata.create_all().
+    """
+    async with engine.begin() as conn:
+        result = await conn.execute(text("SELECT 1 FROM usage_rollups_hourly LIMIT 1"))
+        if result.fetchone() is not None:
+            logger.debug("usage_rollups_hourly already populated, skipping backfill")
+            return
+
+        logger.info("Backfilling usage_rollups_hourly from usage_logs (one-time)...")
+        # The hour format matches how SQLAlchemy stores DATETIME values in SQLite,
+        # so backfilled buckets and incrementally written ones share the same key.
+        # The NOT EXISTS guard keeps concurrently starting workers from double counting.
+        result = await conn.execute(text("""
+            INSERT INTO usage_rollups_hourly (hour, api_key_id, server_id, model, status_class, request_count)
+            SELECT strftime('%Y-%m-%d %H:00:00.000000', request_timestamp),
+                   api_key_id,
+                   COALESCE(server_id, 0),
+                   COALESCE(model, ''),
+                   status_code / 100,
+                   COUNT(*)
+            FROM usage_logs
+            WHERE request_timestamp IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM usage_rollups_hourly)
+            GROUP BY 1, 2, 3, 4, 5
+        """))
+        logger.info(f"Backfilled {result.rowcount} hourly usage rollup bucket(s)")
+
+
 async def create_missing_indexes(engine: AsyncEngine) -> None:
     """
     Create any missing indexes that should exist.
@@ -442,6 +532,7 @@ async def create_missing_indexes(engine: AsyncEngine) -> None:
 
     indexes = [
         ("ix_usage_logs_model", "usage_logs", "model"),
+        ("ix_usage_logs_request_timestamp", "usage_logs", "request_timestamp"),
         ("ix_model_metadata_model_name", "model_metadata", "model_name"),
     ]
 
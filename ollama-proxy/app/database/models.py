@@ -2,6 +2,7 @@ import datetime
 from sqlalchemy import (
     Column,
     Integer,
+    Float,
     String,
     Boolean,
     DateTime,
@@ -42,9 +43,15 @@ class APIKey(Base):
     
     rate_limit_requests = Column(Integer, nullable=True)
     rate_limit_window_minutes = Column(Integer, nullable=True)
+    token_limit_per_minute = Column(Integer, nullable=True)
+    token_limit_per_day = Column(Integer, nullable=True)
+
+    # Admission control class: "interactive" or "batch"
+    priority_class = Column(String, default="interactive", nullable=False)
 
     user = relationship("User", back_populates="api_keys")
     usage_logs = relationship("UsageLog", back_populates="api_key", cascade="all, delete-orphan")
+    usage_rollups = relationship("UsageRollupHourly", cascade="all, delete-orphan")
 
     __table_args__ = (UniqueConstraint("user_id", "key_name", name="uq_user_key_name"),)
 
@@ -59,11 +66,41 @@ class UsageLog(Base):
     request_timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     server_id = Column(Integer, ForeignKey("ollama_servers.id"), nullable=True)
     model = Column(String, nullable=True, index=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    # Latency telemetry: time before the request went upstream, backend time to
+    # first byte, time to first token and total time (ms), and generation speed
+    queue_ms = Column(Integer, nullable=True)
+    ttfb_ms = Column(Integer, nullable=True)
+    ttft_ms = Column(Integer, nullable=True)
+    total_ms = Column(Integer, nullable=True)
+    tokens_per_second = Column(Float, nullable=True)
 
     api_key = relationship("APIKey", back_populates="usage_logs")
     server = relationship("OllamaServer")
 
 
+class UsageRollupHourly(Base):
+    """
+    Pre-aggregated request counts per hour, maintained incrementally as usage
+    logs are written so the statistics pages never scan usage_logs.
+    server_id 0 and model '' stand in for "none" so the unique key can be upserted.
+    """
+    __tablename__ = "usage_rollups_hourly"
+
+    id = Column(Integer, primary_key=True, index=True)
+    hour = Column(DateTime, nullable=False, index=True)
+    api_key_id = Column(Integer, ForeignKey("api_keys.id"), nullable=False, index=True)
+    server_id = Column(Integer, nullable=False, default=0)
+    model = Column(String, nullable=False, default="")
+    status_class = Column(Integer, nullable=False)
+    request_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint("hour", "api_key_id", "server_id", "model", "status_class", name="uq_usage_rollup_bucket"),
+    )
+
+
 class OllamaServer(Base):
     __tablename__ = "ollama_servers"
 
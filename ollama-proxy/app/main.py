@@ -27,14 +27,28 @@ from starlette.responses import RedirectResponse, Response
 
 from app.core.config import settings
 from app.core.logging_config import setup_logging
+from app.core.invalidation_bus import invalidation_bus
+from app.core.usage_log_writer import UsageLogWriter
+from app.core.load_balancer import LoadBalancer
+from app.core.resident_models import ResidentModelTracker
+from app.core.circuit_breaker import CircuitBreakerRegistry, CircuitBreakerConfig
+from app.core.retry import RetryBudgets
+from app.core.admission import AdmissionController, worker_count
+from app.core.embed_batcher import EmbeddingBatcher
+from app.core.embedding_cache import EmbeddingCache
+from app.core.response_cache import ResponseCache
+from app.core.connection_pools import backend_pools
+from app.core.routing_table import routing_table
+from app.core.rate_limit import RateLimiter
 from app.api.v1.routes.health import router as health_router
+from app.api.v1.routes.metrics import router as metrics_router
 from app.api.v1.routes.proxy import router as proxy_router
 from app.api.v1.routes.admin import router as admin_router
 from app.api.v1.routes.playground_chat import router as playground_chat_router
 from app.api.v1.routes.playground_embedding import router as playground_embedding_router
 from app.database.session import AsyncSessionLocal, engine
 from app.database.base import Base
-from app.database.migrations import run_all_migrations
+from app.database.migrations import run_all_migrations, backfill_usage_rollups
 from app.crud import user_crud, server_crud, settings_crud
 from app.schema.user import UserCreate
 from app.schema.server import ServerCreate
@@ -65,6 +79,9 @@ async def init_db():
     # Then create any missing tables
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+
+    # Seed the statistics rollups from existing history on first upgrade
+    await backfill_usage_rollups(engine)
     
     _db_initialized = True
     logger.info("Database schema is ready.")
@@ -121,6 +138,25 @@ async def periodic_model_refresh(app: FastAPI) -> None:
             logger.error(f"Error in periodic model refresh: {e}", exc_info=True)
 
 
+async def periodic_resident_model_poll(app: FastAPI) -> None:
+    """
+    Background task that keeps track of which models are loaded on each server.
+    """
+    import asyncio
+
+    tracker: ResidentModelTracker = app.state.resident_models
+    while True:
+        try:
+            await tracker.poll()
+            await asyncio.sleep(app.state.settings.resident_model_poll_seconds)
+        except asyncio.CancelledError:
+            logger.info("Resident model poll task cancelled")
+            break
+        except Exception as e:
+            logger.error(f"Error polling resident models: {e}", exc_info=True)
+            await asyncio.sleep(app.state.settings.resident_model_poll_seconds)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # ---------- Startup ----------
@@ -158,6 +194,16 @@ async def lifespan(app: FastAPI):
     limits = httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=60.0)
     app.state.http_client = httpx.AsyncClient(timeout=timeout, limits=limits)
 
+    # Proxied traffic uses one pool per backend server; the shared client above serves admin and playground calls
+    backend_pools.configure(
+        max_connections=app.state.settings.backend_pool_max_connections,
+        max_keepalive_connections=app.state.settings.backend_pool_max_keepalive,
+        keepalive_expiry_seconds=app.state.settings.backend_pool_keepalive_expiry_seconds,
+        pool_timeout_seconds=app.state.settings.backend_pool_timeout_seconds,
+        vllm_http2=app.state.settings.vllm_http2_enabled,
+    )
+
+    redis_client = None
     try:
         db_settings: AppSettingsModel = app.state.settings
         if db_settings.redis_username and db_settings.redis_password:
@@ -168,23 +214,80 @@ async def lifespan(app: FastAPI):
             credentials = ""
         redis_url = f"redis://{credentials}{db_settings.redis_host}:{db_settings.redis_port}/0"
 
-        app.state.redis = redis.from_url(redis_url, encoding="utf-8", decode_responses=True)
-        await app.state.redis.ping()
+        redis_client = redis.from_url(redis_url, encoding="utf-8", decode_responses=True)
+        await redis_client.ping()
+        app.state.redis = redis_client
         logger.info("Successfully connected to Redis.")
     except Exception as exc:
-        logger.warning(f"Redis not available – rate limiting disabled. Reason: {exc}")
+        logger.warning(f"Redis not available – rate limits are enforced per worker until it answers. Reason: {exc}")
         app.state.redis = None
 
+    # Per-key request rate limits (GCRA in Redis, local token buckets while Redis is down).
+    # The limiter keeps the client even if Redis did not answer yet and reconnects later.
+    app.state.rate_limits = RateLimiter(redis_client, connected=app.state.redis is not None)
+
+    # Backend load tracking used to pick servers (optionally shared through Redis)
+    app.state.load_balancer = LoadBalancer(app.state.redis, app.state.settings.load_balancing_shared_state)
+    app.state.resident_models = ResidentModelTracker()
+    app.state.circuit_breakers = CircuitBreakerRegistry(CircuitBreakerConfig.from_settings(app.state.settings))
+    app.state.retry_budgets = RetryBudgets(
+        ratio=app.state.settings.retry_budget_ratio,
+        min_per_second=app.state.settings.retry_budget_min_per_second,
+    )
+    app.state.admission = AdmissionController(
+        slots_per_server=app.state.settings.backend_max_concurrency,
+        max_queue_seconds=app.state.settings.admission_max_queue_seconds,
+        workers=worker_count(),
+    )
+    app.state.embed_batcher = EmbeddingBatcher(
+        max_batch_size=app.state.settings.embed_batch_max_size,
+        max_wait_ms=app.state.settings.embed_batch_max_wait_ms,
+    )
+    app.state.response_cache = ResponseCache(
+        max_entries=app.state.settings.response_cache_max_entries,
+        ttl_seconds=app.state.settings.response_cache_ttl_seconds,
+    )
+    # Cached vectors are stored as raw float64 bytes, so Redis is read without decoding
+    app.state.embedding_cache = EmbeddingCache(
+        redis.from_url(redis_url) if app.state.redis else None,
+        max_entries=app.state.settings.embedding_cache_max_entries,
+        redis_enabled=app.state.settings.embedding_cache_redis_enabled,
+        redis_ttl_seconds=app.state.settings.embedding_cache_redis_ttl_hours * 3600,
+    )
+
+    # Start the batched usage-log writer
+    app.state.usage_log_writer = UsageLogWriter(
+        batch_size=app.state.settings.usage_log_batch_size,
+        flush_interval_ms=app.state.settings.usage_log_flush_interval_ms,
+        max_queue_size=app.state.settings.usage_log_queue_size,
+    )
+    app.state.usage_log_writer.start()
+
     import asyncio
     refresh_task = asyncio.create_task(periodic_model_refresh(app))
     app.state.refresh_task = refresh_task
 
+    # Share cache invalidations (revoked keys, edited servers) between workers
+    invalidation_bus.attach_redis(app.state.redis)
+    if app.state.redis:
+        app.state.invalidation_task = asyncio.create_task(invalidation_bus.listen())
+
     # Do initial model refresh on startup
     logger.info("Performing initial model refresh on startup...")
     async with AsyncSessionLocal() as db:
         initial_results = await server_crud.refresh_all_server_models(db)
     logger.info(f"Initial model refresh: {initial_results['success']}/{initial_results['total']} servers updated")
 
+    # Open connections to every backend before the first requests arrive
+    try:
+        snapshot = await routing_table.get()
+        await backend_pools.prewarm(snapshot.servers, app.state.settings.backend_pool_prewarm_connections)
+    except Exception as e:
+        logger.warning(f"Could not pre-warm backend connections: {e}")
+
+    # Start polling loaded models once the routing table has the refreshed servers
+    app.state.resident_model_task = asyncio.create_task(periodic_resident_model_poll(app))
+
     yield
 
     # ---------- Shutdown ----------
@@ -195,10 +298,29 @@ async def lifespan(app: FastAPI):
             await app.state.refresh_task
         except asyncio.CancelledError:
             pass
+    if hasattr(app.state, 'resident_model_task'):
+        app.state.resident_model_task.cancel()
+        try:
+            await app.state.resident_model_task
+        except asyncio.CancelledError:
+            pass
+    if hasattr(app.state, 'invalidation_task'):
+        app.state.invalidation_task.cancel()
+        try:
+            await app.state.invalidation_task
+        except asyncio.CancelledError:
+            pass
+    invalidation_bus.attach_redis(None)
+
+    # Flush any usage logs still buffered in memory
+    await app.state.usage_log_writer.stop()
 
     await app.state.http_client.aclose()
-    if app.state.redis:
-        await app.state.redis.close()
+    await backend_pools.aclose()
+    if redis_client:
+        await redis_client.close()
+    if app.state.embedding_cache.redis_client:
+        await app.state.embedding_cache.redis_client.close()
 
 app = FastAPI(
     title=settings.APP_NAME,
@@ -230,8 +352,16 @@ async def add_security_headers(request: Request, call_next):
     response.headers["Content-Security-Policy"] = csp_policy
     return response
 
+@app.middleware("http")
+async def add_rate_limit_headers(request: Request, call_next):
+    response = await call_next(request)
+    for name, value in getattr(request.state, "rate_limit_headers", {}).items():
+        response.headers.setdefault(name, value)
+    return response
+
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 app.include_router(health_router, prefix="/api/v1", tags=["Health"])
+app.include_router(metrics_router, tags=["Metrics"])
 app.include_router(proxy_router, prefix="/api", tags=["Ollama Proxy"])
 app.include_router(admin_router, prefix="/admin", tags=["Admin UI"], include_in_schema=False)
 app.include_router(playground_chat_router, prefix="/admin", tags=["Admin UI"], include_in_schema=False)
@@ -1,6 +1,6 @@
 # 📁 app/schema/settings.py
 from pydantic import BaseModel, Field, field_validator, ConfigDict
-from typing import List, Optional, Dict
+from typing import List, Literal, Optional, Dict
 
 class AppSettingsModel(BaseModel):
     # This prevents the Pydantic warning about "model_" prefixed fields.
@@ -37,12 +37,179 @@ class AppSettingsModel(BaseModel):
 
     rate_limit_requests: int = 100
     rate_limit_window_minutes: int = 1
+    token_limit_per_minute: int = Field(
+        default=0,
+        ge=0,
+        description="Default prompt + completion tokens an API key may use per minute (0 = unlimited)"
+    )
+    token_limit_per_day: int = Field(
+        default=0,
+        ge=0,
+        description="Default prompt + completion tokens an API key may use per UTC day (0 = unlimited)"
+    )
 
     allowed_ips: str = ""
     denied_ips: str = ""
+    metrics_require_api_key: bool = Field(
+        default=False,
+        description="Require a valid API key (Authorization: Bearer) on /metrics. Without it the endpoint is only limited by the IP lists and exposes server names, model names and traffic volumes"
+    )
 
     model_update_interval_minutes: int = 10
 
+    load_balancing_strategy: Literal["round_robin", "least_in_flight", "power_of_two", "ewma_latency"] = Field(
+        default="round_robin",
+        description="How the proxy picks a backend among the servers that host the requested model"
+    )
+    load_balancing_shared_state: bool = Field(
+        default=False,
+        description="Share backend in-flight counts and latency between workers and proxy nodes through Redis"
+    )
+
+    # Per-server circuit breaker
+    circuit_breaker_enabled: bool = Field(
+        default=True,
+        description="Stop sending requests to a failing server for a while instead of retrying it on every request"
+    )
+    circuit_breaker_failure_threshold: int = Field(
+        default=5,
+        ge=1,
+        le=100,
+        description="Consecutive failed requests that open a server's circuit"
+    )
+    circuit_breaker_error_rate: float = Field(
+        default=0.5,
+        ge=0.05,
+        le=1.0,
+        description="Error rate over the last minute (with at least 10 requests) that opens a server's circuit"
+    )
+    circuit_breaker_open_seconds: int = Field(
+        default=30,
+        ge=1,
+        le=3600,
+        description="How long an open circuit skips its server before a single trial request is let through"
+    )
+
+    # Admission control
+    admission_control_enabled: bool = Field(
+        default=False,
+        description="Queue inference requests in the proxy when every candidate server's slots are busy, sharing them fairly between API keys"
+    )
+    backend_max_concurrency: int = Field(
+        default=4,
+        ge=1,
+        le=256,
+        description="Requests each backend runs at once across all workers (split evenly between them, at least one each); match OLLAMA_NUM_PARALLEL on the Ollama servers"
+    )
+    admission_max_queue_seconds: int = Field(
+        default=30,
+        ge=1,
+        le=600,
+        description="How long a request may wait for a backend slot before it is rejected with 429"
+    )
+
+    # Embedding fan-out
+    embed_fanout_chunk_size: int = Field(
+        default=64,
+        ge=0,
+        le=10000,
+        description="/api/embed inputs with more texts than this are split into chunks of this size and embedded in parallel on every server hosting the model (0 = off)"
+    )
+    embed_fanout_max_parallel: int = Field(
+        default=8,
+        ge=1,
+        le=256,
+        description="Chunks of a single /api/embed request sent at once"
+    )
+
+    # Embedding micro-batching
+    embed_batching_enabled: bool = Field(
+        default=False,
+        description="Combine concurrent single-text /api/embed requests for the same model into one /api/embed call"
+    )
+    embed_batching_legacy_enabled: bool = Field(
+        default=False,
+        description="Also batch single-prompt /api/embeddings requests through /api/embed. This changes their vectors: /api/embed returns them L2-normalized, /api/embeddings does not"
+    )
+    embed_batch_max_size: int = Field(
+        default=32,
+        ge=2,
+        le=512,
+        description="Prompts in one batch; a full batch is sent right away"
+    )
+    embed_batch_max_wait_ms: int = Field(
+        default=5,
+        ge=1,
+        le=200,
+        description="How long the first request of a batch waits for others to join"
+    )
+
+    # Embedding cache
+    embedding_cache_enabled: bool = Field(
+        default=True,
+        description="Answer /api/embed and /api/embeddings texts already embedded by the same model (same digest) from a cache, sending only new texts upstream"
+    )
+    embedding_cache_max_entries: int = Field(
+        default=10000,
+        ge=0,
+        le=10000000,
+        description="Vectors kept in each worker's memory (8 bytes per dimension each, about 80 MB at 1024 dimensions for the default)"
+    )
+    embedding_cache_redis_enabled: bool = Field(
+        default=False,
+        description="Also keep cached vectors in Redis, shared by all workers and kept across restarts"
+    )
+    embedding_cache_redis_ttl_hours: int = Field(
+        default=168,
+        ge=1,
+        le=8760,
+        description="How long a vector stays in Redis after it was last embedded"
+    )
+
+    # Deterministic response cache
+    response_cache_enabled: bool = Field(
+        default=False,
+        description="Cache /api/generate and /api/chat responses for requests with temperature 0 or a fixed seed, and let identical concurrent requests share one generation"
+    )
+    response_cache_max_entries: int = Field(
+        default=1000,
+        ge=0,
+        le=100000,
+        description="Responses kept in each worker's memory (responses over 1 MB are never kept)"
+    )
+    response_cache_ttl_seconds: int = Field(
+        default=300,
+        ge=1,
+        le=604800,
+        description="How long a cached response is replayed before the request is sent upstream again"
+    )
+
+    # Conversation affinity
+    affinity_routing_enabled: bool = Field(
+        default=False,
+        description="Keep the turns of a chat (or requests with the same X-Session-ID header) on the same backend"
+    )
+    affinity_load_factor: float = Field(
+        default=1.25,
+        ge=1.0,
+        le=10.0,
+        description="A pinned backend is skipped while it has more than this multiple of the average in-flight load"
+    )
+
+    # Warm-model routing
+    resident_model_poll_seconds: int = Field(
+        default=15,
+        ge=2,
+        le=600,
+        description="How often each Ollama server's loaded models (/api/ps) are polled"
+    )
+    warm_routing_max_in_flight: int = Field(
+        default=4,
+        ge=0,
+        le=1000,
+        description="In-flight requests at which a server with the model loaded stops being preferred (0 = always prefer)"
+    )
+
     # Retry configuration for backend requests
     max_retries: int = Field(
         default=5,
@@ -62,7 +229,83 @@ class AppSettingsModel(BaseModel):
         le=5000,
         description="Base delay in milliseconds for exponential backoff between retries"
     )
+    retry_budget_ratio: float = Field(
+        default=0.2,
+        ge=0.0,
+        le=1.0,
+        description="Retries (and failovers) allowed per successful request, tracked per backend and globally"
+    )
+    retry_budget_min_per_second: float = Field(
+        default=1.0,
+        ge=0.0,
+        le=100.0,
+        description="Retries allowed per second regardless of traffic, so low-volume deployments can still retry"
+    )
     
+    # Backend connection pools (one per server)
+    backend_pool_max_connections: int = Field(
+        default=64,
+        ge=1,
+        le=1000,
+        description="Connections the proxy may open to each backend server, streams included"
+    )
+    backend_pool_max_keepalive: int = Field(
+        default=20,
+        ge=0,
+        le=1000,
+        description="Idle connections kept open to each backend server for reuse"
+    )
+    backend_pool_keepalive_expiry_seconds: int = Field(
+        default=60,
+        ge=1,
+        le=3600,
+        description="How long an idle connection is kept before it is closed"
+    )
+    backend_pool_timeout_seconds: int = Field(
+        default=60,
+        ge=1,
+        le=600,
+        description="How long a request waits for a free connection to its backend before failing"
+    )
+    backend_pool_prewarm_connections: int = Field(
+        default=2,
+        ge=0,
+        le=100,
+        description="Connections opened to each backend server at startup so the first requests do not pay for connecting (0 = off)"
+    )
+    vllm_http2_enabled: bool = Field(
+        default=False,
+        description="Talk HTTP/2 to vLLM servers that offer it (over HTTPS), multiplexing requests over fewer connections"
+    )
+
+    # Verified API key cache
+    api_key_cache_ttl_seconds: int = Field(
+        default=60,
+        ge=0,
+        le=3600,
+        description="How long a verified API key is trusted without re-checking its hash (0 disables the cache)"
+    )
+
+    # Batched usage-log writer (requires a restart)
+    usage_log_batch_size: int = Field(
+        default=200,
+        ge=1,
+        le=2000,
+        description="Maximum number of usage-log rows written per INSERT"
+    )
+    usage_log_flush_interval_ms: int = Field(
+        default=500,
+        ge=10,
+        le=60000,
+        description="Maximum time a usage-log row waits in memory before being flushed"
+    )
+    usage_log_queue_size: int = Field(
+        default=10000,
+        ge=100,
+        le=1000000,
+        description="Maximum number of usage-log rows buffered in memory before requests wait"
+    )
+
     # --- HTTPS/SSL Settings ---
     ssl_keyfile: Optional[str] = Field(default=None, description="Path to the SSL private key file (e.g., key.pem). Requires a restart.")
     ssl_certfile: Optional[str] = Field(default=None, description="Path to the SSL certificate file (e.g., cert.pem). Requires a restart.")
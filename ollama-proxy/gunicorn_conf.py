@@ -1,5 +1,7 @@
 import os
 import json
+import shutil
+import tempfile
 import sqlalchemy
 from pathlib import Path
 from app.core.logging_config import LOGGING_CONFIG
@@ -17,6 +19,25 @@ errorlog = "-"   # Direct error logs to stdout
 # Use our custom JSON logging config
 logconfig_dict = LOGGING_CONFIG
 
+# --- Prometheus metrics shared by all workers ---
+# Set before the workers import the app, so every worker writes its metrics to this directory
+prometheus_multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "ollama_proxy_metrics")
+)
+
+
+def on_starting(server):
+    # Values left over from a previous run would be added to the new ones
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+    # Admission control splits each backend's slots between the workers (app.core.admission.WORKERS_ENV)
+    os.environ["OLLAMA_PROXY_WORKERS"] = str(server.cfg.workers)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
 # --- Load SSL settings from DB for Gunicorn ---
 keyfile = None
 certfile = None